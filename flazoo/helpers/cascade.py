@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger(__name__)
+
+
+def _get_logits(outputs: Any) -> torch.Tensor:
+    """
+    Logits from a model output, either a `ModelOutput` with `logits` or a tuple (without loss).
+    """
+    if hasattr(outputs, "logits"):
+        return outputs.logits
+    if isinstance(outputs, (tuple, list)):
+        return outputs[0]
+    return outputs
+
+
+def max_softmax_confidence(logits: torch.Tensor) -> torch.Tensor:
+    """
+    Default confidence of a prediction: the highest softmax probability, [B, num_classes] -> [B]
+    """
+    return logits.float().softmax(dim=-1).amax(dim=-1)
+
+
+@dataclass
+class CascadeOutput:
+    """
+    logits: [B, num_classes], from the small model, or from the large one for the escalated samples
+    confidence: [B], confidence of the small model
+    escalated: [B], True for the samples answered by the large model
+    """
+
+    logits: torch.Tensor
+    confidence: torch.Tensor
+    escalated: torch.BoolTensor
+
+
+class ModelCascade:
+    """
+    Small-to-large cascade for classification: every sample goes through the small model first,
+    and only the samples with a confidence below `threshold` are escalated to the large model.
+
+    The escalated samples are re-batched for the large model:
+    - `__call__` runs one batch, its escalated samples are sent in chunks of at most `large_batch_size`
+    - `run` streams batches, and buffers the escalated samples across them until a full large batch is ready,
+      the outputs are yielded in input order once all the samples of a batch are answered
+
+    Args:
+        small_model: cheap classifier, e.g. a 6-layer DeltaNet
+        large_model: expensive classifier with the same label space
+        threshold: confidence threshold, see `calibrate_threshold`
+        large_batch_size: batch size of the large model, defaults to the size of the incoming batches
+        confidence_fn: logits -> confidence, defaults to the highest softmax probability
+    """
+
+    def __init__(
+        self,
+        small_model: nn.Module,
+        large_model: nn.Module,
+        threshold: float,
+        large_batch_size: Optional[int] = None,
+        confidence_fn: Callable[[torch.Tensor], torch.Tensor] = max_softmax_confidence,
+    ):
+        self.small_model = small_model
+        self.large_model = large_model
+        self.threshold = threshold
+        self.large_batch_size = large_batch_size
+        self.confidence_fn = confidence_fn
+
+    @torch.no_grad()
+    def _run_small(
+        self, pixel_values: torch.Tensor, **kwargs
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.BoolTensor]:
+        logits = _get_logits(self.small_model(pixel_values, **kwargs))
+        confidence = self.confidence_fn(logits)
+        return logits, confidence, confidence < self.threshold
+
+    @torch.no_grad()
+    def _run_large(self, pixel_values: torch.Tensor, **kwargs) -> torch.Tensor:
+        return _get_logits(self.large_model(pixel_values, **kwargs))
+
+    @torch.no_grad()
+    def __call__(self, pixel_values: torch.Tensor, **kwargs) -> CascadeOutput:
+        logits, confidence, escalated = self._run_small(pixel_values, **kwargs)
+        # one host sync to size the escalated batch
+        indices = escalated.nonzero().squeeze(-1)
+        if indices.numel() > 0:
+            logits = logits.clone()
+            chunk_size = self.large_batch_size or pixel_values.shape[0]
+            for chunk in indices.split(chunk_size):
+                logits[chunk] = self._run_large(pixel_values[chunk], **kwargs).to(
+                    logits.dtype
+                )
+        return CascadeOutput(logits=logits, confidence=confidence, escalated=escalated)
+
+    @torch.no_grad()
+    def run(self, batches: Iterable[torch.Tensor], **kwargs) -> Iterator[CascadeOutput]:
+        """
+        Run the cascade over a stream of batches, with full batches for the large model.
+        """
+        pending = deque()  # outputs of the small model waiting for escalated samples
+        buffer, owners = [], []  # escalated samples, and (pending output, row) for each of them
+        large_batch_size = self.large_batch_size
+
+        def flush(size: int):
+            inputs = torch.cat(buffer[:size], dim=0)
+            large_logits = self._run_large(inputs, **kwargs)
+            for row, (output, index) in enumerate(owners[:size]):
+                output["logits"][index] = large_logits[row].to(output["logits"].dtype)
+                output["remaining"] -= 1
+            del buffer[:size], owners[:size]
+
+        for pixel_values in batches:
+            if large_batch_size is None:
+                large_batch_size = pixel_values.shape[0]
+            logits, confidence, escalated = self._run_small(pixel_values, **kwargs)
+            escalated_indices = escalated.nonzero().squeeze(-1)
+            indices = escalated_indices.tolist()
+            output = {
+                "logits": logits.clone() if indices else logits,
+                "confidence": confidence,
+                "escalated": escalated,
+                "remaining": len(indices),
+            }
+            pending.append(output)
+            # copy the escalated rows once, slices of the input would keep the whole batch alive until the flush
+            escalated_rows = pixel_values.index_select(0, escalated_indices)
+            for row, index in enumerate(indices):
+                buffer.append(escalated_rows[row : row + 1])
+                owners.append((output, index))
+
+            while len(buffer) >= large_batch_size:
+                flush(large_batch_size)
+            while pending and pending[0]["remaining"] == 0:
+                yield self._to_output(pending.popleft())
+
+        if buffer:
+            flush(len(buffer))
+        while pending:
+            yield self._to_output(pending.popleft())
+
+    @staticmethod
+    def _to_output(output: Dict[str, Any]) -> CascadeOutput:
+        return CascadeOutput(
+            logits=output["logits"],
+            confidence=output["confidence"],
+            escalated=output["escalated"],
+        )
+
+
+@torch.no_grad()
+def collect_predictions(
+    model: nn.Module,
+    dataloader: Iterable[Tuple[torch.Tensor, torch.Tensor]],
+    confidence_fn: Callable[[torch.Tensor], torch.Tensor] = max_softmax_confidence,
+    device: Optional[torch.device] = None,
+) -> Dict[str, torch.Tensor]:
+    """
+    Run a model over a labeled calibration set.
+
+    Args:
+        dataloader: yields (pixel_values, labels) batches
+    Returns:
+        A dict with the `confidence` and `correct` of every sample, on CPU
+    """
+    confidences, corrects = [], []
+    for pixel_values, labels in dataloader:
+        if device is not None:
+            pixel_values, labels = pixel_values.to(device), labels.to(device)
+        logits = _get_logits(model(pixel_values))
+        confidences.append(confidence_fn(logits).cpu())
+        corrects.append((logits.argmax(dim=-1) == labels).cpu())
+    return {"confidence": torch.cat(confidences), "correct": torch.cat(corrects)}
+
+
+def calibrate_threshold(
+    confidence: torch.Tensor,
+    small_correct: torch.BoolTensor,
+    target_accuracy: float,
+    large_correct: Optional[torch.BoolTensor] = None,
+) -> Dict[str, float]:
+    """
+    Pick the lowest confidence threshold, i.e. the fewest escalations, for which the cascade reaches `target_accuracy`
+    on a calibration set.
+
+    Args:
+        confidence: [N], confidence of the small model
+        small_correct: [N], whether the small model is right
+        target_accuracy: accuracy to reach
+        large_correct: [N], whether the large model is right. If None, the target is the accuracy of the small model
+            on the samples it keeps (selective accuracy), e.g. before the large model is available.
+    Returns:
+        A dict with the `threshold`, the `accuracy` reached and the `escalation_rate` on the calibration set.
+        The threshold is `inf` (escalate everything) if the target cannot be reached.
+    """
+    num_samples = confidence.numel()
+    confidence = confidence.float().flatten().cpu()
+    order = confidence.argsort(descending=True)
+    confidence = confidence[order]
+    small_correct = small_correct.flatten().cpu()[order].float()
+
+    # keeping the k most confident samples for k = 1..N
+    kept_correct = small_correct.cumsum(0)
+    num_kept = torch.arange(1, num_samples + 1, dtype=torch.float)
+    if large_correct is None:
+        accuracy = kept_correct / num_kept
+    else:
+        large_correct = large_correct.flatten().cpu()[order].float()
+        escalated_correct = large_correct.sum() - large_correct.cumsum(0)
+        accuracy = (kept_correct + escalated_correct) / num_samples
+
+    # a threshold keeps all the samples with the same confidence, only cut between distinct values
+    valid = torch.ones(num_samples, dtype=torch.bool)
+    valid[:-1] = confidence[:-1] != confidence[1:]
+    candidates = (valid & (accuracy >= target_accuracy)).nonzero().squeeze(-1)
+    if candidates.numel() == 0:
+        logger.warning(
+            f"Target accuracy {target_accuracy} cannot be reached by the cascade, every sample is escalated"
+        )
+        return {
+            "threshold": float("inf"),
+            "accuracy": (
+                large_correct.mean().item()
+                if large_correct is not None
+                else float("nan")
+            ),
+            "escalation_rate": 1.0,
+        }
+
+    k = candidates.max().item()
+    return {
+        "threshold": confidence[k].item(),
+        "accuracy": accuracy[k].item(),
+        "escalation_rate": 1.0 - (k + 1) / num_samples,
+    }
+
+
+def calibrate_cascade(
+    small_model: nn.Module,
+    large_model: nn.Module,
+    dataloader: Iterable[Tuple[torch.Tensor, torch.Tensor]],
+    target_accuracy: float,
+    large_batch_size: Optional[int] = None,
+    confidence_fn: Callable[[torch.Tensor], torch.Tensor] = max_softmax_confidence,
+    device: Optional[torch.device] = None,
+) -> ModelCascade:
+    """
+    Build a `ModelCascade` whose threshold reaches `target_accuracy` on a labeled calibration set.
+    The dataloader is iterated once per model, and must yield the samples in the same order both times.
+    """
+    small = collect_predictions(small_model, dataloader, confidence_fn, device)
+    large = collect_predictions(large_model, dataloader, confidence_fn, device)
+    stats = calibrate_threshold(
+        small["confidence"],
+        small["correct"],
+        target_accuracy,
+        large_correct=large["correct"],
+    )
+    logger.info(
+        f"Cascade threshold {stats['threshold']:.4f}: accuracy {stats['accuracy']:.4f}, "
+        f"escalation rate {stats['escalation_rate']:.4f}"
+    )
+    return ModelCascade(
+        small_model,
+        large_model,
+        stats["threshold"],
+        large_batch_size=large_batch_size,
+        confidence_fn=confidence_fn,
+    )
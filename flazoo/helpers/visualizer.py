@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 from mpl_toolkits.axes_grid1 import make_axes_locatable
@@ -7,7 +8,11 @@ import numpy as np
 from typing import Dict, List, Optional, Tuple, Union, Any
 import os
 import math
+import warnings
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
+from einops import rearrange
 
 
 class VisualizationStyle(Enum):
@@ -26,6 +31,162 @@ class VisualizationStyle(Enum):
     DARK = "dark"  # Dark mode with bright highlights
 
 
+def softmax_attention_rows(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    query_indices: torch.Tensor,
+    scale: Optional[float] = None,
+    block_size: Optional[int] = None,
+    chunk_size: int = 1024,
+) -> torch.Tensor:
+    """
+    Rows of softmax(q @ k^T * scale) for the selected queries, without materializing the [L, L] map.
+
+    Args:
+        q: [heads, L, d]
+        k: [heads, L, d]
+        query_indices: [n] positions of the queries to extract
+        scale: defaults to d ** -0.5
+        block_size: if set, only keys in the same 1D block as the query are attended (Block1DAttention)
+        chunk_size: number of keys whose logits are computed at a time
+
+    Returns:
+        rows: [heads, n, L] in float32
+    """
+    scale = q.shape[-1] ** -0.5 if scale is None else scale
+    q_sel = q[:, query_indices].float() * scale
+    seq_len = k.shape[1]
+    logits = q_sel.new_empty(q_sel.shape[0], q_sel.shape[1], seq_len)
+    for start in range(0, seq_len, chunk_size):
+        end = min(start + chunk_size, seq_len)
+        logits[..., start:end] = q_sel @ k[:, start:end].float().transpose(-1, -2)
+    if block_size is not None:
+        key_block = torch.arange(seq_len, device=k.device) // block_size
+        same_block = (query_indices[:, None] // block_size) == key_block[None, :]
+        logits = logits.masked_fill(~same_block, float("-inf"))
+    return logits.softmax(dim=-1)
+
+
+def linear_attention_rows(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    query_indices: torch.Tensor,
+    beta: Optional[torch.Tensor] = None,
+    decay: Optional[torch.Tensor] = None,
+    scale: Optional[float] = None,
+    chunk_size: int = 1024,
+) -> torch.Tensor:
+    """
+    Rows of the (causal) token mixing matrix A of a linear recurrent layer, o_i = sum_j A_ij v_j,
+    for the selected queries, without materializing the [L, L] matrix.
+
+    - Linear attention (beta=None, decay=None):  S_t = S_{t-1} + v_t k_t^T,  A_ij = q_i . k_j
+    - Delta rule (beta):  S_t = alpha_t S_{t-1} (I - beta_t k_t k_t^T) + beta_t v_t k_t^T,
+        where alpha_t = decay_t (gated delta rule) or 1.
+        A_ij is obtained by pulling q_i back through the transitions, from i down to j:
+            u = q_i;  for m = i, ..., 0:  A_im = beta_m k_m . u;  u = alpha_m (u - A_im k_m)
+
+    Args:
+        q: [heads, L, d]
+        k: [heads, L, d]
+        query_indices: [n] positions of the queries to extract
+        beta: [heads, L], delta rule writing strength
+        decay: [heads, L], multiplicative decay alpha_t of the state
+        scale: defaults to d ** -0.5
+        chunk_size: number of keys processed at a time, the delta rule solves a [chunk_size, chunk_size] system
+            per head for each of them
+
+    Returns:
+        rows: [heads, n, L] in float32
+    """
+    scale = q.shape[-1] ** -0.5 if scale is None else scale
+    num_heads, seq_len, _ = k.shape
+    u = q[:, query_indices].float() * scale  # [h, n, d]
+    rows = u.new_zeros(num_heads, u.shape[1], seq_len)
+    last = int(query_indices.max()) + 1
+
+    if beta is None and decay is None:
+        for start in range(0, last, chunk_size):
+            end = min(start + chunk_size, last)
+            rows[..., start:end] = u @ k[:, start:end].float().transpose(-1, -2)
+        causal = torch.arange(seq_len, device=k.device)[None, :] <= query_indices[:, None]
+        return rows * causal
+
+    if beta is None:
+        beta = k.new_ones(num_heads, seq_len)
+    # walk the chunks of keys backwards; within a chunk [start, end), the recursion over its keys is
+    # a unit upper triangular system in the a_m, solved for all queries at once:
+    #   a_m = beta_m (G(m+1, p) k_m . u - sum_{m < j <= p} G(m+1, j) (k_m . k_j) a_j)
+    # where p is the last key of the chunk seen by the query and G(i, j) = alpha_i ... alpha_j
+    for end in range(last, 0, -chunk_size):
+        start = max(end - chunk_size, 0)
+        size = end - start
+        k_chunk = k[:, start:end].float()  # [h, c, d]
+        beta_chunk = beta[:, start:end].float()  # [h, c]
+        # cum[:, t] = log(alpha_0 ... alpha_{t-1}) within the chunk, so G(i, j) = exp(cum[:, j + 1] - cum[:, i])
+        cum = k_chunk.new_zeros(num_heads, size + 1, dtype=torch.float64)
+        if decay is not None:
+            log_decay = decay[:, start:end].double().clamp_min(1e-30).log()
+            cum[:, 1:] = log_decay.cumsum(-1)
+        positions = torch.arange(size, device=k.device)
+        # last key of the chunk seen by each query, -1 if the query is before the chunk
+        last_key = (query_indices - start).clamp(max=size - 1)  # [n]
+        active = last_key >= 0
+        seen = positions[:, None] <= last_key[None, :]  # [c, n]
+        gather = (last_key.clamp(min=0) + 1)[None, :].expand(num_heads, -1)
+        cum_last = cum.gather(1, gather)  # [h, n]
+        # G(m + 1, p) for each key m and query
+        decay_q = (
+            (cum_last[:, None, :] - cum[:, 1:, None])
+            .masked_fill(~seen, float("-inf"))
+            .exp()
+            .float()
+        )
+        rhs = beta_chunk[..., None] * decay_q * (k_chunk @ u.transpose(-1, -2))  # [h, c, n]
+        # G(m + 1, j) (k_m . k_j) for j > m
+        upper = positions[None, :] > positions[:, None]
+        decay_k = (
+            (cum[:, None, 1:] - cum[:, 1:, None])
+            .masked_fill(~upper, float("-inf"))
+            .exp()
+            .float()
+        )
+        mixing = (k_chunk @ k_chunk.transpose(-1, -2)) * decay_k
+        system = torch.eye(size, device=k.device) + beta_chunk[..., None] * mixing
+        a = torch.linalg.solve_triangular(system, rhs, upper=True, unitriangular=True)
+        rows[..., start:end] = a.transpose(-1, -2)
+        # pull the queries back through the whole chunk: u <- G(0, p) u - sum_j G(0, j) a_j k_j
+        decay_u = (cum_last - cum[:, :1]).exp().float()  # [h, n]
+        decay_a = (cum[:, 1:] - cum[:, :1]).exp().float()  # [h, c]
+        u_next = decay_u[..., None] * u - (a * decay_a[..., None]).transpose(-1, -2) @ k_chunk
+        u = torch.where(active[None, :, None], u_next, u)
+    return rows
+
+
+def attention_to_rgba(attention: np.ndarray, cmap) -> np.ndarray:
+    """
+    Vectorized colormap of a stack of attention maps, each map normalized to [0, 1] on its own.
+
+    Args:
+        attention: [..., H, W] float array
+        cmap: matplotlib colormap or colormap name
+
+    Returns:
+        [..., H, W, 4] uint8 RGBA array
+    """
+    if isinstance(cmap, str):
+        cmap = mpl.colormaps[cmap]
+    lo = attention.min(axis=(-2, -1), keepdims=True)
+    hi = attention.max(axis=(-2, -1), keepdims=True)
+    normed = (attention - lo) / np.maximum(hi - lo, 1e-12)
+    return cmap(normed, bytes=True)
+
+
+def _render_attention_figure(kwargs):
+    # runs in a worker process, the model is not needed (nor pickled) for rendering
+    return ModelVisualizer(model=None)._visualize_single_attention(**kwargs)
+
+
 class ModelVisualizer:
     """
     Wrapper class for visualizing internal outputs from FLA models.
@@ -42,8 +203,13 @@ class ModelVisualizer:
         self.model = model
         self.hooks = []
         self.attention_outputs = {}
+        # inputs of the attention modules that return no map (e.g. FLA layers), to reconstruct it
+        self.attention_inputs = {}
         self.target_layers = []
         self.target_batch_idx = None
+        self.non_blocking = False
+        # (layer, shape, dtype) -> pinned buffer of the non-blocking copies, reused across forward passes
+        self._pinned_buffers = {}
 
     def register_attention_hooks(self, layer_indices: List[int]):
         """
@@ -74,7 +240,9 @@ class ModelVisualizer:
                 raise ValueError(f"Layer {layer_idx} does not have an attention module")
 
             # Register the hook
-            hook = block.attn.register_forward_hook(self._make_hook_fn(layer_idx))
+            hook = block.attn.register_forward_hook(
+                self._make_hook_fn(layer_idx), with_kwargs=True
+            )
             self.hooks.append(hook)
 
     def _make_hook_fn(self, layer_idx: int):
@@ -88,31 +256,293 @@ class ModelVisualizer:
             A hook function
         """
 
-        def hook_fn(module, input, output):
+        def hook_fn(module, args, kwargs, output):
             # Most attention modules return (output, attentions, past_key_values)
             if isinstance(output, tuple) and len(output) >= 2 and output[1] is not None:
                 # Store the attention outputs
                 if self.target_batch_idx is not None:
                     # Only store for the target batch index
                     if output[1].dim() == 4:  # [batch, heads, seq_len, seq_len]
-                        self.attention_outputs[layer_idx] = (
-                            output[1][self.target_batch_idx].detach().cpu()
+                        self.attention_outputs[layer_idx] = self._to_cpu(
+                            output[1][self.target_batch_idx], layer_idx
                         )
                     else:
                         # Handle other attention output formats
-                        self.attention_outputs[layer_idx] = output[1].detach().cpu()
+                        self.attention_outputs[layer_idx] = self._to_cpu(
+                            output[1], layer_idx
+                        )
                 else:
                     # Store all batch items
-                    self.attention_outputs[layer_idx] = output[1].detach().cpu()
+                    self.attention_outputs[layer_idx] = self._to_cpu(
+                        output[1], layer_idx
+                    )
+            else:
+                # FLA layers return no map, keep the input of the target item to reconstruct it
+                hidden_states = kwargs.get("hidden_states", args[0] if args else None)
+                batch_idx = 0 if self.target_batch_idx is None else self.target_batch_idx
+                self.attention_inputs[layer_idx] = hidden_states[
+                    batch_idx : batch_idx + 1
+                ].detach()
 
         return hook_fn
 
+    def _to_cpu(self, tensor: torch.Tensor, layer_idx: int) -> torch.Tensor:
+        """
+        Copy a captured tensor to the CPU. With `non_blocking`, CUDA tensors are copied asynchronously
+        into pinned memory, so the forward pass is not stalled; call `_wait_for_copies` before reading them.
+        The pinned buffer of a layer is reused by the next captures of the same shape, which overwrite it.
+        """
+        tensor = tensor.detach()
+        if not self.non_blocking or tensor.device.type != "cuda":
+            return tensor.cpu()
+        key = (layer_idx, tuple(tensor.shape), tensor.dtype)
+        buffer = self._pinned_buffers.get(key)
+        if buffer is None:
+            buffer = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+            self._pinned_buffers[key] = buffer
+        buffer.copy_(tensor, non_blocking=True)
+        return buffer
+
+    def _wait_for_copies(self, stream: Optional[torch.cuda.Stream] = None):
+        """
+        Wait for the pending non-blocking copies issued on `stream` (the current stream by default).
+        Only the calling thread waits, the work queued afterwards on other streams is not synchronized.
+        """
+        if self.non_blocking and torch.cuda.is_available():
+            event = torch.cuda.Event()
+            event.record(stream)
+            event.synchronize()
+
+    def _reconstruct_attention_maps(
+        self, max_query_rows: Optional[int], chunk_size: int
+    ) -> Dict[int, torch.Tensor]:
+        """
+        Recompute the maps of the layers captured in `attention_inputs` (the ones that return no map),
+        on a side CUDA stream so that the model's stream is not blocked, with non-blocking copies to the CPU.
+
+        Returns:
+            Dict mapping layer index to a CPU tensor [heads, rows, L], rows = min(L, max_query_rows)
+        """
+        maps = {}
+        if not self.attention_inputs:
+            return maps
+        device = next(iter(self.attention_inputs.values())).device
+        stream = None
+        if device.type == "cuda":
+            stream = torch.cuda.Stream(device)
+            # the captured inputs are written by the forward pass on the current stream
+            stream.wait_stream(torch.cuda.current_stream(device))
+        context = (
+            torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext()
+        )
+        with torch.no_grad(), context:
+            for layer_idx, hidden_states in self.attention_inputs.items():
+                seq_len = hidden_states.shape[1]
+                if max_query_rows is not None and seq_len > max_query_rows:
+                    # evenly spaced query rows
+                    query_indices = torch.linspace(
+                        0, seq_len - 1, max_query_rows, device=device
+                    ).long()
+                else:
+                    query_indices = torch.arange(seq_len, device=device)
+                try:
+                    attention = self._attention_rows(
+                        self.model.encoder.blocks[layer_idx].attn,
+                        hidden_states,
+                        query_indices,
+                        chunk_size=chunk_size,
+                    )
+                except NotImplementedError as e:
+                    print(f"No attention map for layer {layer_idx}: {e}")
+                    continue
+                maps[layer_idx] = self._to_cpu(attention.float(), layer_idx)
+        self._wait_for_copies(stream)
+        return maps
+
+    def extract_attention_rows(
+        self,
+        input_data: torch.Tensor,
+        query_indices: Union[List[int], torch.Tensor],
+        layer_indices: Optional[List[int]] = None,
+        head_indices: Optional[List[int]] = None,
+        batch_idx: int = 0,
+        chunk_size: int = 1024,
+        **model_kwargs,
+    ) -> Dict[int, torch.Tensor]:
+        """
+        Reconstruct attention rows of selected query patches, on demand and with O(n * L) memory.
+
+        FLA layers (and most hybrid layers) do not return attention maps, and a full softmax map is O(L^2) per head.
+        Instead, the input of each selected attention module is captured and the rows are recomputed from it:
+            - softmax attention layers: softmax(q k^T) from the module's q/k projections (and rotary embedding)
+            - DeltaNet / GatedDeltaNet: the equivalent delta rule token mixing matrix
+            - other FLA layers are not supported (NotImplementedError), their gating is not modelled
+
+        Indices refer to positions in the sequence seen by the layer, i.e. after the scan of the block
+        (identical to patch indices for uni-scan).
+
+        Args:
+            input_data: Input tensor to the model
+            query_indices: Positions of the query patches to extract
+            layer_indices: Layers to extract from, defaults to the layers registered with `register_attention_hooks`
+            head_indices: Heads to keep, defaults to all heads
+            batch_idx: Batch item to extract
+            chunk_size: Number of keys processed at a time
+            **model_kwargs: Extra arguments for the model forward
+
+        Returns:
+            Dict mapping layer index to a CPU float32 tensor [heads, len(query_indices), L]
+        """
+        if layer_indices is None:
+            layer_indices = self.target_layers
+        blocks = self.model.encoder.blocks
+        captured = {}
+
+        def make_capture_fn(layer_idx):
+            def capture_fn(module, args, kwargs):
+                hidden_states = kwargs.get("hidden_states", args[0] if args else None)
+                captured[layer_idx] = hidden_states[batch_idx : batch_idx + 1].detach()
+
+            return capture_fn
+
+        handles = [
+            blocks[layer_idx].attn.register_forward_pre_hook(
+                make_capture_fn(layer_idx), with_kwargs=True
+            )
+            for layer_idx in layer_indices
+        ]
+        try:
+            with torch.no_grad():
+                self.model(input_data, **model_kwargs)
+        finally:
+            for handle in handles:
+                handle.remove()
+
+        rows = {}
+        with torch.no_grad():
+            for layer_idx, hidden_states in captured.items():
+                query = torch.as_tensor(
+                    query_indices, dtype=torch.long, device=hidden_states.device
+                )
+                layer_rows = self._attention_rows(
+                    blocks[layer_idx].attn, hidden_states, query, chunk_size
+                )
+                if head_indices is not None:
+                    layer_rows = layer_rows[head_indices]
+                rows[layer_idx] = layer_rows.cpu()
+        return rows
+
+    def _attention_rows(
+        self,
+        module: nn.Module,
+        hidden_states: torch.Tensor,
+        query_indices: torch.Tensor,
+        chunk_size: int,
+    ) -> torch.Tensor:
+        """
+        Recompute attention rows [heads, n, L] of one attention module from its input [1, L, D].
+        """
+        if not (hasattr(module, "q_proj") and hasattr(module, "k_proj")):
+            raise NotImplementedError(
+                f"Attention rows can not be reconstructed for {type(module).__name__}"
+            )
+
+        if type(module).__module__.startswith("flazoo.layers.attentions"):
+            # softmax attention
+            if getattr(module, "norm_first", False):
+                hidden_states = module.norm(hidden_states)
+            q = rearrange(
+                module.q_proj(hidden_states), "b l (h d) -> b l h d", h=module.num_heads
+            )
+            k = rearrange(
+                module.k_proj(hidden_states),
+                "b l (h d) -> b l h d",
+                h=module.num_kv_heads,
+            )
+            if getattr(module, "use_rope", False):
+                q, k = module.rotary(
+                    q, k, seqlen_offset=0, max_seqlen=q.shape[1], cu_seqlens=None
+                )
+            q, k = q[0].transpose(0, 1), k[0].transpose(0, 1)  # [h, l, d]
+            k = k.repeat_interleave(module.num_heads // module.num_kv_heads, dim=0)
+            block_size = None
+            if type(module).__name__ == "Block1DAttention":
+                block_size = module.block_size
+            elif type(module).__name__ != "FullAttention":
+                warnings.warn(
+                    f"{type(module).__name__} attends to a local window, "
+                    "the extracted rows are those of global attention"
+                )
+            return softmax_attention_rows(
+                q, k, query_indices, block_size=block_size, chunk_size=chunk_size
+            )
+
+        if type(module).__module__.startswith("flazoo.layers.lact"):
+            raise NotImplementedError(
+                "LaCT fast weights are not linear in the keys, attention rows are not defined"
+            )
+
+        if type(module).__name__ not in ("DeltaNet", "GatedDeltaNet"):
+            # gated / decayed layers (GLA, RetNet, HGRN2, GSA, RWKV, ...) would need their own gating to be modelled,
+            # their plain q . k rows are not the token mixing of the layer
+            raise NotImplementedError(
+                f"Attention rows can not be reconstructed for {type(module).__name__}, "
+                "only for softmax attention, DeltaNet and GatedDeltaNet"
+            )
+
+        # FLA layers, following the projections of fla's DeltaNet / GatedDeltaNet
+        q = module.q_proj(hidden_states)
+        k = module.k_proj(hidden_states)
+        qk_activation = getattr(module, "qk_activation", "silu")
+        if getattr(module, "use_short_conv", False):
+            q, _ = module.q_conv1d(x=q)
+            k, _ = module.k_conv1d(x=k)
+        elif qk_activation == "silu":
+            q, k = F.silu(q), F.silu(k)
+        head_dim = getattr(module, "head_k_dim", getattr(module, "head_dim", None))
+        q = rearrange(q[0], "l (h d) -> h l d", d=head_dim)
+        k = rearrange(k[0], "l (h d) -> h l d", d=head_dim)
+        if qk_activation == "relu":
+            q, k = q.relu(), k.relu()
+        elif qk_activation == "elu":
+            q, k = F.elu(q) + 1, F.elu(k) + 1
+
+        beta, decay = None, None
+        if hasattr(module, "b_proj"):
+            qk_norm = getattr(module, "qk_norm", "l2")
+            if qk_norm == "l2":
+                q, k = F.normalize(q.float(), dim=-1), F.normalize(k.float(), dim=-1)
+            elif qk_norm == "sum":
+                q, k = q / q.sum(-1, keepdim=True), k / k.sum(-1, keepdim=True)
+            if getattr(module, "use_beta", True):
+                beta = module.b_proj(hidden_states)[0].float().sigmoid().transpose(0, 1)
+            else:
+                beta = k.new_ones(k.shape[0], k.shape[1])
+            if getattr(module, "allow_neg_eigval", False):
+                beta = beta * 2.0
+            if hasattr(module, "A_log") and hasattr(module, "a_proj"):
+                g = -module.A_log.float().exp() * F.softplus(
+                    module.a_proj(hidden_states)[0].float() + module.dt_bias
+                )
+                decay = g.exp().transpose(0, 1)
+            if k.shape[0] != beta.shape[0]:
+                # grouped value heads share the key heads
+                groups = beta.shape[0] // k.shape[0]
+                q = q.repeat_interleave(groups, dim=0)
+                k = k.repeat_interleave(groups, dim=0)
+
+        return linear_attention_rows(
+            q, k, query_indices, beta=beta, decay=decay, chunk_size=chunk_size
+        )
+
     def remove_hooks(self):
         """Remove all registered hooks."""
         for hook in self.hooks:
             hook.remove()
         self.hooks = []
         self.attention_outputs = {}
+        self.attention_inputs = {}
+        self._pinned_buffers = {}
 
     def set_target_batch(self, batch_idx: Optional[int] = None):
         """
@@ -145,6 +575,7 @@ class ModelVisualizer:
         """
         # Clear previous attention outputs
         self.attention_outputs = {}
+        self.attention_inputs = {}
 
         # Ensure output directory exists
         os.makedirs(output_dir, exist_ok=True)
@@ -190,6 +621,104 @@ class ModelVisualizer:
             else:
                 print(f"Unsupported attention shape: {attention.shape}")
 
+    def visualize_attention_batch(
+        self,
+        input_data: torch.Tensor,
+        output_dir: str = "attention_vis",
+        filename_prefix: str = "attention",
+        style: Union[str, VisualizationStyle] = VisualizationStyle.STANDARD,
+        fast_png: bool = True,
+        num_workers: int = 4,
+        dpi: int = 300,
+        max_query_rows: Optional[int] = 256,
+        chunk_size: int = 1024,
+    ) -> List[str]:
+        """
+        Batch version of `visualize_attention` for dumping many layers x heads.
+
+        The hooks copy the maps with non-blocking pinned copies, and rendering happens off the forward path:
+            - fast_png=True: maps are colored in one vectorized colormap lookup and written as PNGs directly,
+                one image per head (`{prefix}_layer{l}_head{h}.png`) plus the head average
+                (`{prefix}_layer{l}_avg.png`), without creating any matplotlib figure.
+            - fast_png=False: the usual figures of `visualize_attention` are rendered in a pool of
+                `num_workers` processes.
+        Layers that return no attention map (FLA layers) get it reconstructed from their input, see `_attention_rows`.
+        This recomputation runs on the model's device, on a side CUDA stream, and costs O(heads * rows * L) memory
+        and compute per layer (plus a chunk_size x chunk_size triangular solve per chunk of keys for delta rule
+        layers), so only `max_query_rows` evenly spaced query rows are recomputed by default.
+
+        Args:
+            input_data: Input tensor to the model
+            output_dir: Directory to save visualizations
+            filename_prefix: Prefix for saved files
+            style: Visualization style preset or custom colormap name
+            fast_png: Whether to write raw colormapped PNGs instead of matplotlib figures
+            num_workers: Number of rendering processes for fast_png=False
+            dpi: Resolution of saved figures for fast_png=False
+            max_query_rows: Number of query rows recomputed for the layers without attention maps, None for all of them
+            chunk_size: Number of keys processed at a time by the recomputation
+
+        Returns:
+            The list of written files
+        """
+        self.attention_outputs = {}
+        self.attention_inputs = {}
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.non_blocking = True
+        try:
+            with torch.no_grad():
+                self.model(input_data, output_attentions=True)
+            reconstructed = self._reconstruct_attention_maps(max_query_rows, chunk_size)
+            self._wait_for_copies()
+        finally:
+            self.non_blocking = False
+
+        batch_idx = 0 if self.target_batch_idx is None else self.target_batch_idx
+        attentions = {}
+        for layer_idx, attention in self.attention_outputs.items():
+            if attention.dim() == 4:  # [batch, heads, seq_len, seq_len]
+                attention = attention[batch_idx]
+            if attention.dim() != 3:
+                print(f"Unsupported attention shape: {attention.shape}")
+                continue
+            attentions[layer_idx] = attention.float()
+        for layer_idx, attention in reconstructed.items():
+            attentions.setdefault(layer_idx, attention)
+
+        written = []
+        if fast_png:
+            cmap = self._get_style_params(style)[0]
+            if isinstance(cmap, tuple):
+                cmap = self._create_custom_colormap(*cmap)
+            for layer_idx, attention in attentions.items():
+                maps = torch.cat([attention, attention.mean(dim=0, keepdim=True)])
+                rgba = attention_to_rgba(maps.numpy(), cmap)
+                names = [f"head{head_idx}" for head_idx in range(attention.size(0))]
+                for image, name in zip(rgba, names + ["avg"]):
+                    filename = f"{filename_prefix}_layer{layer_idx}_{name}.png"
+                    path = os.path.join(output_dir, filename)
+                    mpl.image.imsave(path, image)
+                    written.append(path)
+            return written
+
+        jobs = [
+            dict(
+                attention=attention,
+                layer_idx=layer_idx,
+                output_dir=output_dir,
+                filename_prefix=filename_prefix,
+                style=style,
+                show_plots=False,
+                dpi=dpi,
+            )
+            for layer_idx, attention in attentions.items()
+        ]
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            for paths in pool.map(_render_attention_figure, jobs):
+                written.extend(paths)
+        return written
+
     def _visualize_single_attention(
         self,
         attention: torch.Tensor,
@@ -211,6 +740,9 @@ class ModelVisualizer:
             style: Visualization style preset or custom colormap name
             show_plots: Whether to display plots
             dpi: Resolution of saved images
+
+        Returns:
+            The paths of the saved figures
         """
         num_heads = attention.size(0)
 
@@ -271,8 +803,9 @@ class ModelVisualizer:
 
         # Save the figure
         filename = f"{filename_prefix}_layer{layer_idx}.png"
+        path = os.path.join(output_dir, filename)
         plt.savefig(
-            os.path.join(output_dir, filename),
+            path,
             dpi=dpi,
             bbox_inches="tight",
             facecolor=bg_color,
@@ -318,8 +851,9 @@ class ModelVisualizer:
         plt.tight_layout()
 
         avg_filename = f"{filename_prefix}_layer{layer_idx}_avg.png"
+        avg_path = os.path.join(output_dir, avg_filename)
         plt.savefig(
-            os.path.join(output_dir, avg_filename),
+            avg_path,
             dpi=dpi,
             bbox_inches="tight",
             facecolor=bg_color,
@@ -330,6 +864,8 @@ class ModelVisualizer:
         else:
             plt.close()
 
+        return [path, avg_path]
+
     def _get_style_params(self, style):
         """Get visualization parameters for the selected style.
 
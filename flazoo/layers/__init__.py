@@ -8,6 +8,12 @@ from .attentions import (
 
 from .lact import BidirectionalLaCTSwiGLU
 
+from .short_conv import FusedShortConvolution
+
+from .reversible import ReversibleFunction
+
+from .checkpointing import CheckpointPolicy
+
 from .attentions import get_attn, get_fla_attn
 
 from .cross_attentions import (
@@ -20,6 +26,9 @@ __all__ = [
     "FullAttention",
     "SlidingTileAttention3D",
     "BidirectionalLaCTSwiGLU",
+    "FusedShortConvolution",
+    "ReversibleFunction",
+    "CheckpointPolicy",
     "get_attn",
     "get_fla_attn",
     "DeltaNetCrossAttentionHF",
@@ -95,6 +95,37 @@ ATTN_LISTS = [
     "na2d_attn",
 ]
 
+# attention types that accept packed sequences through `cu_seqlens`
+PACKED_ATTN_LISTS = [
+    "full_attn",
+    "block1d_attn",
+]
+
+# fla_attn_types whose layers pass `cu_seqlens` to their kernels; the others (abc, hgrn in chunk mode, lact,
+# lightnet, linear_attention) ignore or reject it, and would mix the packed sequences through their state
+PACKED_FLA_ATTN_LISTS = [
+    "deltanet",
+    "mesanet",
+    "gated_deltanet",
+    "gated_deltaproduct",
+    "fox",
+    "gla",
+    "bitnet",
+    "gsa",
+    "hgrn2",
+    "retnet",
+    "rwkv6",
+    "rwkv7",
+]
+
+# attention types that fold the sequence into a 2D/3D grid
+GRID_ATTN_LISTS = [
+    "block2d_attn",
+    "sta2d_attn",
+    "sta3d_attn",
+    "na2d_attn",
+]
+
 FLA_ATTN_LISTS = [
     "deltanet",
     "mesanet",
@@ -205,21 +236,43 @@ class FullAttention(nn.Module):
             self.v_proj(hidden_states), "... (h d) -> ... h d", h=self.num_kv_heads
         )
 
+        # packed sequences [1, T, D], each attends to itself only
+        cu_seqlens = kwargs.get("cu_seqlens", None)
+
         if self.use_rope:
-            q, k = self.rotary(q, k, seqlen_offset=0, max_seqlen=q_len, cu_seqlens=None)
+            q, k = self.rotary(
+                q, k, seqlen_offset=0, max_seqlen=q_len, cu_seqlens=cu_seqlens
+            )
 
         if flash_attn_func is None:
             raise ImportError(
                 "Please install Flash Attention via `pip install flash-attn --no-build-isolation` first"
             )
 
-        o = flash_attn_func(
-            q,
-            k,
-            v,
-            causal=False,  # use non-causal attention for vision
-            window_size=(-1, -1),
-        )
+        if cu_seqlens is not None:
+            cu_seqlens = cu_seqlens.to(torch.int32)
+            max_seqlen = kwargs.get("max_seqlen", None)
+            if max_seqlen is None:
+                max_seqlen = int((cu_seqlens[1:] - cu_seqlens[:-1]).max())
+            o = flash_attn_varlen_func(
+                q.squeeze(0),
+                k.squeeze(0),
+                v.squeeze(0),
+                cu_seqlens_q=cu_seqlens,
+                cu_seqlens_k=cu_seqlens,
+                max_seqlen_q=max_seqlen,
+                max_seqlen_k=max_seqlen,
+                causal=False,  # use non-causal attention for vision
+                window_size=(-1, -1),
+            )
+        else:
+            o = flash_attn_func(
+                q,
+                k,
+                v,
+                causal=False,  # use non-causal attention for vision
+                window_size=(-1, -1),
+            )
         o = o.reshape(batch_size, q_len, self.hidden_size)
         o = self.o_proj(o)
 
@@ -302,14 +355,16 @@ class Block1DAttention(nn.Module):
             self.v_proj(hidden_states), "b s (h d) -> (b s) h d", h=self.num_kv_heads
         )
 
-        # calculate cu_seqlens
+        # calculate cu_seqlens, packed sequences come with their own
 
-        cu_seqlens = (
-            torch.arange(
-                0, batch_size + 1, dtype=torch.int32, device=hidden_states.device
+        cu_seqlens = kwargs.get("cu_seqlens", None)
+        if cu_seqlens is None:
+            cu_seqlens = (
+                torch.arange(
+                    0, batch_size + 1, dtype=torch.int32, device=hidden_states.device
+                )
+                * q_len
             )
-            * q_len
-        )
 
         cu_chunk = _calc_chunks(cu_seqlens, self.block_size)
 
@@ -1741,9 +1796,11 @@ def get_fla_attn(config, layer_idx):
         return BidirectionalLaCTSwiGLU(
             dim=config.hidden_size,
             head_dim=config.hidden_size // config.num_heads,
-            use_muon=False,
+            use_muon=getattr(config, "lact_use_muon", False),
             use_short_conv=config.use_short_conv,
             conv_size=config.conv_size,
+            chunk_size=getattr(config, "lact_chunk_size", None),
+            muon_tol=getattr(config, "lact_muon_tol", None),
         )
 
     elif fla_attn_type == "lightnet":
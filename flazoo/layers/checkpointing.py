@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+from dataclasses import dataclass, fields
+from typing import Any, Callable, Dict, Optional, Union
+
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+from flazoo.models.utils import add_norm
+
+CHECKPOINT_MODES = ("save", "recompute", "offload")
+
+
+@dataclass
+class CheckpointPolicy:
+    """
+    What to do with the activations saved for backward by each sub-module of a block:
+        "save": keep them on the device, as usual
+        "recompute": drop them and recompute the sub-module in backward
+        "offload": move them to pinned CPU memory, and back in backward
+
+    Sub-modules:
+        token_mixer: scan, attention and merge
+        channel_mixer: the MLP / SwiGLU
+        norms: the layer norms before both of them. A norm with the same mode as its branch shares its region,
+            e.g. with both on "recompute" only the block input is kept instead of the normalized one.
+    """
+
+    token_mixer: str = "save"
+    channel_mixer: str = "save"
+    norms: str = "save"
+
+    def __post_init__(self):
+        for field in fields(self):
+            if getattr(self, field.name) not in CHECKPOINT_MODES:
+                raise ValueError(
+                    f"{field.name} must be one of {CHECKPOINT_MODES}, got {getattr(self, field.name)}"
+                )
+
+    @classmethod
+    def from_config(
+        cls, policy: Optional[Union["CheckpointPolicy", Dict[str, str]]]
+    ) -> Optional["CheckpointPolicy"]:
+        if policy is None or isinstance(policy, cls):
+            return policy
+        if isinstance(policy, dict):
+            return cls(**policy)
+        raise ValueError(f"Unknown checkpoint policy: {policy}")
+
+    def apply(self, mode: str, fn: Callable, *args, **kwargs) -> Any:
+        if mode == "save" or not torch.is_grad_enabled():
+            return fn(*args, **kwargs)
+        if mode == "recompute":
+            return checkpoint(fn, *args, use_reentrant=False, **kwargs)
+        with torch.autograd.graph.save_on_cpu(pin_memory=torch.cuda.is_available()):
+            return fn(*args, **kwargs)
+
+    def run_branch(
+        self,
+        name: str,
+        norm: nn.Module,
+        fn: Callable,
+        hidden_states: torch.Tensor,
+        residual: Optional[torch.Tensor] = None,
+        **kwargs,
+    ) -> Any:
+        """
+        Run `fn(norm(hidden_states), **kwargs)`, the branch `name` of a block, with the modes of the policy.
+        With `residual`, the norm is applied to `residual + hidden_states` in one pass (see `add_norm`),
+        and the output is `(fn(...), residual + hidden_states)`.
+        """
+        mode = getattr(self, name)
+        if residual is None:
+            if self.norms == mode:
+                return self.apply(mode, lambda x: fn(norm(x), **kwargs), hidden_states)
+            return self.apply(
+                mode, fn, self.apply(self.norms, norm, hidden_states), **kwargs
+            )
+
+        def branch(x, r):
+            x, r = add_norm(norm, x, r)
+            return fn(x, **kwargs), r
+
+        if self.norms == mode:
+            return self.apply(mode, branch, hidden_states, residual)
+        hidden_states, residual = self.apply(
+            self.norms, add_norm, norm, hidden_states, residual
+        )
+        return self.apply(mode, fn, hidden_states, **kwargs), residual
+
+
+def sequence_chunked_forward(
+    fn: Callable[[torch.Tensor], torch.Tensor],
+    hidden_states: torch.Tensor,
+    chunk_size: Optional[int],
+) -> torch.Tensor:
+    """
+    Apply a token-wise `fn` (e.g. norm + MLP) on slices of `chunk_size` tokens along the sequence,
+    so that its intermediate activations only exist for one slice at a time.
+    With autograd, every slice is checkpointed: only its input is kept and the intermediate is recomputed slice
+    by slice in backward. The output is unchanged.
+
+    Args:
+        hidden_states: [B, L, D]
+    """
+    if chunk_size is None or hidden_states.shape[1] <= chunk_size:
+        return fn(hidden_states)
+    outputs = []
+    for chunk in hidden_states.split(chunk_size, dim=1):
+        if torch.is_grad_enabled():
+            outputs.append(checkpoint(fn, chunk, use_reentrant=False))
+        else:
+            outputs.append(fn(chunk))
+    return torch.cat(outputs, dim=1)
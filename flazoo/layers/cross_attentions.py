@@ -10,6 +10,7 @@ from fla.modules import ShortConvolution, RMSNorm, FusedRMSNormGated
 from fla.models.utils import Cache
 from fla.ops import fused_recurrent_delta_rule, chunk_delta_rule
 from flazoo.ops import generate_sta_mask_3d, sta_3d_with_text_func
+from flazoo.layers.short_conv import FusedShortConvolution
 import warnings
 
 
@@ -57,25 +58,22 @@ class DeltaNetCrossAttentionHF(Attention):
             self.b_proj = nn.Linear(self.query_dim, self.heads, bias=False)
 
         if self.use_short_conv:
+            qk_conv_activation = "silu" if self.qk_activation == "silu" else None
             self.q_conv1d = ShortConvolution(
                 hidden_size=self.inner_dim,
                 kernel_size=self.conv_size,
                 bias=self.conv_bias,
-                activation="silu" if self.qk_activation == "silu" else None,
+                activation=qk_conv_activation,
             )
-
-            self.k_conv1d = ShortConvolution(
-                hidden_size=self.inner_dim,
+            # k and v both come from the encoder states and share their length, one depthwise conv over [k, v]
+            self.kv_conv1d = FusedShortConvolution(
+                split_sizes=(self.inner_dim, self.inner_dim),
                 kernel_size=self.conv_size,
                 bias=self.conv_bias,
-                activation="silu" if self.qk_activation == "silu" else None,
+                activations=(qk_conv_activation, "silu"),
             )
-
-            self.v_conv1d = ShortConvolution(
-                hidden_size=self.inner_dim,
-                kernel_size=self.conv_size,
-                bias=self.conv_bias,
-                activation="silu",
+            self.kv_conv1d.register_legacy_state_dict_hook(
+                self, "kv_conv1d", legacy_names=("k_conv1d", "v_conv1d")
             )
 
         if self.use_gate:
@@ -117,26 +115,29 @@ class DeltaNetCrossAttentionHF(Attention):
         mode = "fused_recurrent" if q_len <= 64 else self.mode
 
         if self.use_short_conv:
-            conv_state_q, conv_state_k, conv_state_v = None, None, None
+            conv_state_q, conv_state_kv = None, None
             if last_state is not None:
                 conv_state_q, conv_state_k, conv_state_v = last_state["conv_state"]
+                if conv_state_k is not None:
+                    conv_state_kv = torch.cat([conv_state_k, conv_state_v], dim=1)
             q, conv_state_q = self.q_conv1d(
                 x=q,
                 cache=conv_state_q,
                 output_final_state=use_cache,
                 cu_seqlens=cu_seqlens,
             )
-            k, conv_state_k = self.k_conv1d(
-                x=k,
-                cache=conv_state_k,
+            (k, v), conv_state_kv = self.kv_conv1d.split_forward(
+                k,
+                v,
+                cache=conv_state_kv,
                 output_final_state=use_cache,
                 cu_seqlens=cu_seqlens,
             )
-            v, conv_state_v = self.v_conv1d(
-                x=v,
-                cache=conv_state_v,
-                output_final_state=use_cache,
-                cu_seqlens=cu_seqlens,
+            # the cache keeps one [N, D, W] state per projection
+            conv_state_k, conv_state_v = (
+                conv_state_kv.split(self.inner_dim, dim=1)
+                if conv_state_kv is not None
+                else (None, None)
             )
         else:
             if self.qk_activation == "silu":
@@ -1,10 +1,13 @@
 import math
+from typing import Optional, Tuple
+
 import torch.nn.functional as F
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 import torch.cuda.amp as amp
 from einops import rearrange
-from fla.modules import ShortConvolution
+from .short_conv import FusedShortConvolution
 
 
 @torch.compile()
@@ -38,20 +41,20 @@ def zeropower_via_newtonschulz5(G):
     This is an updated version of the zeropower_via_newtonschulz5 function in here:
     https://github.com/KellerJordan/modded-nanogpt/blob/master/train_gpt_medium.py#L26
     The code is modified from https://github.com/MoonshotAI/Moonlight/blob/master/examples/toy_train.py#L49, which contains the original muon implementation.
-    Major change: G is [b, d, d] rather than [d, d]
+    Major change: G is [..., d, d] rather than [d, d]
     Newton-Schulz iteration to compute the zeroth power / orthogonalization of G.
     Args:
-        G: [b, d, d']
+        G: [..., d, d']
     Returns:
-        X: [b, d, d']
+        X: [..., d, d']
     FLOPS:  When d=d', Total FLOPS=30 * b * d^3
     """
-    assert len(G.shape) == 3
+    assert len(G.shape) >= 3
     X = G.bfloat16()
-    if G.size(1) > G.size(2):
-        X = X.transpose(1, 2)
+    if G.size(-2) > G.size(-1):
+        X = X.transpose(-2, -1)
     # Ensure spectral norm is at most 1
-    X = X / (X.norm(dim=(1, 2), keepdim=True) + 1e-7)
+    X = X / (X.norm(dim=(-2, -1), keepdim=True) + 1e-7)
     # Perform the NS iterations
     for a, b, c in [
         (4.0848, -6.8946, 2.9270),
@@ -60,17 +63,181 @@ def zeropower_via_newtonschulz5(G):
         (2.8769, -3.1427, 1.2046),
         (2.8366, -3.0525, 1.2012),
     ]:
-        A = X @ X.transpose(1, 2)
+        A = X @ X.transpose(-2, -1)
         B = (
             b * A + c * A @ A
         )  # adapted from suggestion by @jxbz, @leloykun, and @YouJiacheng
         X = a * X + B @ X
 
-    if G.size(1) > G.size(2):
-        X = X.transpose(1, 2)
+    if G.size(-2) > G.size(-1):
+        X = X.transpose(-2, -1)
     return X
 
 
+NEWTON_SCHULZ_QUINTIC_COEFFICIENTS = [
+    (4.0848, -6.8946, 2.9270),
+    (3.9505, -6.3029, 2.6377),
+    (3.7418, -5.5913, 2.3037),
+    (2.8769, -3.1427, 1.2046),
+    (2.8366, -3.0525, 1.2012),
+]
+# classical cubic Newton-Schulz, converges to the exact polar factor for singular values in (0, sqrt(3))
+NEWTON_SCHULZ_CUBIC_COEFFICIENTS = (1.5, -0.5, 0.0)
+
+
+@torch.compiler.disable
+def zeropower_via_newtonschulz_adaptive(
+    G: torch.Tensor,
+    tol: float = 0.3,
+    max_iters: int = 5,
+    min_iters: int = 4,
+    dtype: torch.dtype = torch.bfloat16,
+    return_iters: bool = False,
+):
+    """
+    Adaptive version of `zeropower_via_newtonschulz5`.
+    Runs the same quintic iterations, then the cubic one (which converges to the exact polar factor),
+    and stops as soon as every matrix is orthogonal up to `tol`:
+        ||X @ X^T - I||_F / sqrt(d) < tol
+    The quintic schedule only pushes the singular values into ~[0.7, 1.2]: on random updates the residual is ~0.25
+    after 4 iterations and ~0.15 after 5, so the default `tol` stops after 4 of them when it can, and never runs
+    more than the fixed 5-step version. Matrices below `tol` are frozen while the others keep iterating.
+
+    Args:
+        G: [..., d, d']
+        tol: tolerance on the orthogonality residual above.
+        max_iters: maximum number of iterations, more than 5 continue with the cubic iteration.
+        min_iters: iterations run before the residual is first compared with `tol` on the host.
+            Every check after it synchronizes with the host once.
+        dtype: dtype of the iterates. Norms and residuals are always computed in float32.
+        return_iters: also return the number of iterations that were run.
+    Returns:
+        X: [..., d, d'] in `dtype`
+        num_iters: int, if `return_iters` is True
+
+    The early stop synchronizes with the host, so this function is excluded from torch.compile.
+    """
+    assert len(G.shape) >= 3
+    transpose = G.size(-2) > G.size(-1)
+    if transpose:
+        G = G.transpose(-2, -1)
+    d = G.size(-2)
+
+    G32 = G.float()
+    # Ensure spectral norm is at most 1, the norm is taken in float32 to avoid bf16 overflow
+    X = (G32 / (G32.norm(dim=(-2, -1), keepdim=True) + 1e-7)).to(dtype)
+    eye = torch.eye(d, device=G.device, dtype=torch.float32)
+
+    num_iters = 0
+    while num_iters < max_iters:
+        A = X @ X.transpose(-2, -1)
+        if num_iters >= min_iters:
+            residual = (A.float() - eye).norm(dim=(-2, -1)) / math.sqrt(d)
+            converged = residual < tol
+            if bool(converged.all()):
+                break
+        if num_iters < len(NEWTON_SCHULZ_QUINTIC_COEFFICIENTS):
+            a, b, c = NEWTON_SCHULZ_QUINTIC_COEFFICIENTS[num_iters]
+        else:
+            a, b, c = NEWTON_SCHULZ_CUBIC_COEFFICIENTS
+        B = b * A + c * A @ A
+        X_next = a * X + B @ X
+        X = (
+            torch.where(converged[..., None, None], X, X_next)
+            if num_iters >= min_iters
+            else X_next
+        )
+        num_iters += 1
+
+    if transpose:
+        X = X.transpose(-2, -1)
+    return (X, num_iters) if return_iters else X
+
+
+def _lact_swiglu_update(
+    w0: torch.Tensor,  # [..., dh, dk]
+    w1: torch.Tensor,  # [..., dv, dh]
+    w2: torch.Tensor,  # [..., dh, dk]
+    k: torch.Tensor,  # [..., l, dk]
+    v: torch.Tensor,  # [..., l, dv]
+    lr0: torch.Tensor,  # [..., l, 1]
+    lr1: torch.Tensor,  # [..., l, 1]
+    lr2: torch.Tensor,  # [..., l, 1]
+    w0_norm: torch.Tensor,  # [..., dh, 1]
+    w1_norm: torch.Tensor,  # [..., dv, 1]
+    w2_norm: torch.Tensor,  # [..., dh, 1]
+    use_muon: bool = True,
+    muon_tol: Optional[float] = None,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    One test-time training step of the SwiGLU fast weights on (k, v).
+    The leading dims of the fast weights only need to broadcast against the ones of k/v,
+    e.g. [1, h, dh, dk] initial weights for [b, h, l, dk] keys.
+
+    With `muon_tol`, the updates are orthogonalized by `zeropower_via_newtonschulz_adaptive`.
+    Returns the updated w0, w1, w2.
+    """
+    v = v.transpose(-1, -2)  # [..., dv, l]
+    kt = k.transpose(-1, -2)  # [..., dk, l]
+
+    #### Forward pass with key
+    # [..., dh, dk] @ [..., dk, l] -> [..., dh, l]
+    gate_before_act = torch.matmul(w0, kt)
+    hidden_before_mul = torch.matmul(w2, kt)
+    hidden = F.silu(gate_before_act, inplace=False) * hidden_before_mul
+
+    #### Backward pass to compute fast weight gradients
+    # [..., dh, dv] @ [..., dv, l] -> [..., dh, l]
+    dhidden = torch.matmul(w1.transpose(-1, -2), v)
+
+    dhidden_before_mul = dhidden * F.silu(gate_before_act, inplace=False)
+    dgate = dhidden * hidden_before_mul
+    dgate_before_act = silu_backprop(dgate, gate_before_act)
+
+    # [..., dv, l] @ [..., l, dh] -> [..., dv, dh]
+    dw1 = torch.matmul(v, (hidden.transpose(-1, -2) * lr1).type_as(v))
+    # [..., dh, l] @ [..., l, dk] -> [..., dh, dk]
+    dw0 = torch.matmul(dgate_before_act, (k * lr0).type_as(dgate_before_act))
+    dw2 = torch.matmul(dhidden_before_mul, (k * lr2).type_as(dhidden_before_mul))
+
+    if use_muon and muon_tol is not None:
+        dw0, dw1, dw2 = (
+            zeropower_via_newtonschulz_adaptive(dw, tol=muon_tol)
+            for dw in (dw0, dw1, dw2)
+        )
+    elif use_muon:
+        dw0 = zeropower_via_newtonschulz5(dw0)
+        dw1 = zeropower_via_newtonschulz5(dw1)
+        dw2 = zeropower_via_newtonschulz5(dw2)
+
+    w1 = w1 + dw1
+    w0 = w0 + dw0
+    w2 = w2 + dw2
+
+    w0 = w0 / (w0.norm(dim=-1, keepdim=True) + 1e-5) * w0_norm
+    w1 = w1 / (w1.norm(dim=-1, keepdim=True) + 1e-5) * w1_norm
+    w2 = w2 / (w2.norm(dim=-1, keepdim=True) + 1e-5) * w2_norm
+
+    return w0, w1, w2
+
+
+def _lact_swiglu_apply(
+    w0: torch.Tensor,  # [..., dh, dk]
+    w1: torch.Tensor,  # [..., dv, dh]
+    w2: torch.Tensor,  # [..., dh, dk]
+    q: torch.Tensor,  # [..., l, dk]
+) -> torch.Tensor:
+    """
+    Apply the fast weight function f(x) = w1 @ (silu(w0 @ x) * (w2 @ x)) to the queries.
+    """
+    q = q.transpose(-1, -2)  # [..., dk, l]
+    # [..., dh, dk] @ [..., dk, l] -> [..., dh, l]
+    h = torch.matmul(w2, q)
+    gate = F.silu(torch.matmul(w0, q), inplace=True)
+    # [..., dv, dh] @ [..., dh, l] -> [..., dv, l] -> [..., l, dv]
+    return torch.matmul(w1, gate * h).transpose(-1, -2)
+
+
 @torch.compile
 def bidirectional_lact_swiglu(
     w0: torch.Tensor,  # [b, dh, dk]
@@ -83,11 +250,15 @@ def bidirectional_lact_swiglu(
     lr1: torch.Tensor,  # [b, l, 1]
     lr2: torch.Tensor,  # [b, l, 1]
     use_muon: bool = True,
+    muon_tol: Optional[float] = None,
 ) -> torch.Tensor:
     """
     Bidirectional LaCT with SwiGLU fast weight function.
     w0, w1, w2 are the fast weights. f(x) =  w1 @ (silu(w0 @ x) * (w2 @ x))
 
+    The batch dim `b` may be any number of leading dims, and the fast weights only need to
+    broadcast against q/k/v, so initial weights of shape [1, h, ...] are never copied per sample.
+
     About precision:
         w0, w1, w2 are mostly likely fp32.
         q, k, v are fp16.
@@ -107,57 +278,115 @@ def bidirectional_lact_swiglu(
     """
 
     # adding detach here sometimes improves stability.
-    w0_norm = w0.norm(dim=2, keepdim=True)
-    w1_norm = w1.norm(dim=2, keepdim=True)
-    w2_norm = w2.norm(dim=2, keepdim=True)
-
-    q = q.transpose(1, 2)  # [b, dk, l]
-    v = v.transpose(1, 2)
+    w0_norm = w0.norm(dim=-1, keepdim=True)
+    w1_norm = w1.norm(dim=-1, keepdim=True)
+    w2_norm = w2.norm(dim=-1, keepdim=True)
 
     ######### update the fast weight w0, w1, w2 with test-time training #########
+    w0, w1, w2 = _lact_swiglu_update(
+        w0, w1, w2, k, v, lr0, lr1, lr2, w0_norm, w1_norm, w2_norm, use_muon, muon_tol
+    )
 
-    #### Forward pass with key
-    # [b, dh, dk] @ [b, dk, l] -> [b, dh, l]
-    gate_before_act = torch.bmm(w0, k.transpose(1, 2))
-    hidden_before_mul = torch.bmm(w2, k.transpose(1, 2))
-    hidden = F.silu(gate_before_act, inplace=False) * hidden_before_mul
-
-    #### Backward pass to compute fast weight gradients
-    # [b, dh, dv] @ [b, dv, l] -> [b, dh, l]
-    dhidden = torch.bmm(w1.transpose(1, 2), v)
-
-    dhidden_before_mul = dhidden * F.silu(gate_before_act, inplace=False)
-    dgate = dhidden * hidden_before_mul
-    dgate_before_act = silu_backprop(dgate, gate_before_act)
-
-    # [b, dv, l] @ [b, l, dh] -> [b, dv, dh]
-    dw1 = torch.bmm(v, (hidden.transpose(1, 2) * lr1).type_as(v))  # [b, d, d]
-    # [b, dh, l] @ [b, l, dk] -> [b, dh, dk]
-    dw0 = torch.bmm(dgate_before_act, (k * lr0).type_as(dgate_before_act))
-    dw2 = torch.bmm(dhidden_before_mul, (k * lr2).type_as(dhidden_before_mul))
-
-    if use_muon:
-        w0 = zeropower_via_newtonschulz5(dw0)
-        w1 = zeropower_via_newtonschulz5(dw1)
-        w2 = zeropower_via_newtonschulz5(dw2)
+    ######### apply the updated fast weights to the query #########
+    return _lact_swiglu_apply(w0, w1, w2, q)
 
-    w1 = w1 + dw1
-    w0 = w0 + dw0
-    w2 = w2 + dw2
 
-    w0 = w0 / (w0.norm(dim=2, keepdim=True) + 1e-5) * w0_norm
-    w1 = w1 / (w1.norm(dim=2, keepdim=True) + 1e-5) * w1_norm
-    w2 = w2 / (w2.norm(dim=2, keepdim=True) + 1e-5) * w2_norm
+@torch.compile
+def _lact_swiglu_chunk(
+    w0: torch.Tensor,
+    w1: torch.Tensor,
+    w2: torch.Tensor,
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    lr0: torch.Tensor,
+    lr1: torch.Tensor,
+    lr2: torch.Tensor,
+    w0_norm: torch.Tensor,
+    w1_norm: torch.Tensor,
+    w2_norm: torch.Tensor,
+    use_muon: bool = True,
+    muon_tol: Optional[float] = None,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    w0, w1, w2 = _lact_swiglu_update(
+        w0,
+        w1,
+        w2,
+        k,
+        v,
+        lr0,
+        lr1,
+        lr2,
+        w0_norm,
+        w1_norm,
+        w2_norm,
+        use_muon,
+        muon_tol,
+    )
+    return _lact_swiglu_apply(w0, w1, w2, q), w0, w1, w2
+
+
+def chunked_bidirectional_lact_swiglu(
+    w0: torch.Tensor,  # [b, dh, dk]
+    w1: torch.Tensor,  # [b, dv, dh]
+    w2: torch.Tensor,  # [b, dh, dk]
+    q: torch.Tensor,  # [b, l, dk]
+    k: torch.Tensor,  # [b, l, dk]
+    v: torch.Tensor,  # [b, l, dv]
+    lr0: torch.Tensor,  # [b, l, 1]
+    lr1: torch.Tensor,  # [b, l, 1]
+    lr2: torch.Tensor,  # [b, l, 1]
+    chunk_size: int = 4096,
+    use_muon: bool = True,
+    muon_tol: Optional[float] = None,
+) -> torch.Tensor:
+    """
+    Large-chunk variant of `bidirectional_lact_swiglu`.
+    The sequence is split into chunks of `chunk_size` tokens, and for each chunk the fast weights are
+    first updated with the chunk's keys/values and then applied to the chunk's queries.
+    The updated fast weights are carried over to the next chunk.
 
-    ######### apply the updated fast weights to the query #########
+    Only [b, dh, chunk_size] intermediates are alive at a time. When gradients are needed, every chunk
+    is checkpointed so that only the (small) fast weights between chunks are kept for backward.
+    With chunk_size >= l this is the same as `bidirectional_lact_swiglu`.
 
-    # [b, dh, dk] @ [b, dk, l] -> [b, dh, l]
-    h = torch.bmm(w2, q)
-    gate = F.silu(torch.bmm(w0, q), inplace=True)
-    # [b, dv, dh] @ [b, dh, l] -> [b, dv, l] -> [b, l, dv]
-    o = torch.bmm(w1, gate * h).transpose(1, 2)
+    Outputs:
+        o: [b, l, dv]
+    """
+    w0_norm = w0.norm(dim=-1, keepdim=True)
+    w1_norm = w1.norm(dim=-1, keepdim=True)
+    w2_norm = w2.norm(dim=-1, keepdim=True)
+
+    use_checkpoint = torch.is_grad_enabled() and any(
+        t.requires_grad for t in (w0, w1, w2, q, k, v, lr0, lr1, lr2)
+    )
+
+    outputs = []
+    for start in range(0, q.shape[-2], chunk_size):
+        chunk = slice(start, start + chunk_size)
+        args = (
+            w0,
+            w1,
+            w2,
+            q[..., chunk, :],
+            k[..., chunk, :],
+            v[..., chunk, :],
+            lr0[..., chunk, :],
+            lr1[..., chunk, :],
+            lr2[..., chunk, :],
+            w0_norm,
+            w1_norm,
+            w2_norm,
+            use_muon,
+            muon_tol,
+        )
+        if use_checkpoint:
+            o, w0, w1, w2 = checkpoint(_lact_swiglu_chunk, *args, use_reentrant=False)
+        else:
+            o, w0, w1, w2 = _lact_swiglu_chunk(*args)
+        outputs.append(o)
 
-    return o
+    return torch.cat(outputs, dim=-2)
 
 
 def inv_softplus(x):
@@ -180,6 +409,8 @@ class BidirectionalLaCTSwiGLU(torch.nn.Module):
         base_lr: float = 1e-2,
         use_short_conv: bool = True,
         conv_size: int = 4,
+        chunk_size: Optional[int] = None,  # None: update and apply over the whole sequence at once
+        muon_tol: Optional[float] = None,  # None: fixed 5 Newton-Schulz iterations, else adaptive
     ):
         super().__init__()
         self.dim = dim
@@ -201,15 +432,13 @@ class BidirectionalLaCTSwiGLU(torch.nn.Module):
 
         if use_short_conv:
             self.conv_size = conv_size
-            self.q_conv1d = ShortConvolution(
-                hidden_size=dim, kernel_size=conv_size, activation="silu"
-            )
-            self.k_conv1d = ShortConvolution(
-                hidden_size=dim, kernel_size=conv_size, activation="silu"
-            )
-            self.v_conv1d = ShortConvolution(
-                hidden_size=dim, kernel_size=conv_size, activation="silu"
+            # one depthwise conv over [q, k, v] instead of three separate ones
+            self.qkv_conv1d = FusedShortConvolution(
+                split_sizes=(dim, dim, dim),
+                kernel_size=conv_size,
+                activations=("silu", "silu", "silu"),
             )
+            self.qkv_conv1d.register_legacy_state_dict_hook(self, "qkv_conv1d")
 
         self.lr_dim = 1  # single scalar learning rate for each head
         self.lr_proj = nn.Linear(dim, self.lr_dim * 3 * self.num_heads, bias=False)
@@ -226,6 +455,8 @@ class BidirectionalLaCTSwiGLU(torch.nn.Module):
 
         self.qk_l2_norm = qk_l2_norm
         self.use_muon = use_muon
+        self.chunk_size = chunk_size
+        self.muon_tol = muon_tol
 
         self.use_o_norm = use_o_norm
         if self.use_o_norm:
@@ -241,25 +472,17 @@ class BidirectionalLaCTSwiGLU(torch.nn.Module):
         q = self.q_proj(hidden_states)  # [b, l, d]
         k = self.k_proj(hidden_states)  # [b, l, d]
         v = self.v_proj(hidden_states)  # [b, l, d]
-        if self.use_short_conv:
-            q, _ = self.q_conv1d(
-                x=q,
-            )
-            k, _ = self.k_conv1d(
-                x=k,
-            )
-            v, _ = self.v_conv1d(
-                x=v,
-            )
         qkv = torch.cat([q, k, v], dim=-1)  # [b, l, 3 * d]
 
-        if not self.use_short_conv:
+        if self.use_short_conv:
+            qkv, _ = self.qkv_conv1d(x=qkv)  # silu is fused into the conv
+        else:
             qkv = F.silu(qkv, inplace=True)  # SiLU
 
-        # [b * num_heads, l, head_dim]
+        # [b, num_heads, l, head_dim]
         q, k, v = rearrange(
             qkv,
-            "b l (qkv h d) -> qkv (b h) l d",
+            "b l (qkv h d) -> qkv b h l d",
             qkv=3,
             h=self.num_heads,
             d=self.head_dim,
@@ -271,30 +494,44 @@ class BidirectionalLaCTSwiGLU(torch.nn.Module):
 
         # better to have float32 for lr.
         # For muon, I found that float16 is still very good.
-        with torch.autocast(device_type="cuda", enabled=False):
+        with torch.autocast(device_type=hidden_states.device.type, enabled=False):
             lr = self.lr_proj(hidden_states)  # [b, l, lr_dim]
 
         lr = torch.nn.functional.softplus(lr.float() + self.base_lr_inv)
 
-        # [b * num_heads, l, 1] for each lr
+        # [b, num_heads, l, 1] for each lr
         lr0, lr1, lr2 = rearrange(
-            lr, "b l (h lrs d) -> lrs (b h) l d", lrs=3, h=self.num_heads, d=self.lr_dim
+            lr, "b l (h lrs d) -> lrs b h l d", lrs=3, h=self.num_heads, d=self.lr_dim
         )
 
-        # [nh, d, d] -> [b * nh, d, d]
-        w0 = self.w0.repeat(hidden_states.shape[0], 1, 1)
-        w1 = self.w1.repeat(hidden_states.shape[0], 1, 1)
-        w2 = self.w2.repeat(hidden_states.shape[0], 1, 1)
-
-        # [b * num_heads, l, head_dim]
-        output = bidirectional_lact_swiglu(
-            w0, w1, w2, q, k, v, lr0, lr1, lr2, self.use_muon
-        )
+        # [nh, d, d] -> [1, nh, d, d], broadcast over the batch without copying
+        w0 = self.w0.unsqueeze(0)
+        w1 = self.w1.unsqueeze(0)
+        w2 = self.w2.unsqueeze(0)
+
+        # [b, num_heads, l, head_dim]
+        if self.chunk_size is not None and self.chunk_size < q.shape[-2]:
+            output = chunked_bidirectional_lact_swiglu(
+                w0,
+                w1,
+                w2,
+                q,
+                k,
+                v,
+                lr0,
+                lr1,
+                lr2,
+                self.chunk_size,
+                self.use_muon,
+                self.muon_tol,
+            )
+        else:
+            output = bidirectional_lact_swiglu(
+                w0, w1, w2, q, k, v, lr0, lr1, lr2, self.use_muon, self.muon_tol
+            )
 
         output = self.o_norm(output)
-        output = rearrange(
-            output, "(b h) l d -> b l (h d)", h=self.num_heads, b=hidden_states.shape[0]
-        )
+        output = rearrange(output, "b h l d -> b l (h d)")
         output = self.o_proj(output)
 
         # [b, l, d]
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+import warnings
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+
+import torch
+import torch.nn as nn
+
+
+def get_rng_state(device: torch.device) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    return (
+        torch.get_rng_state(),
+        torch.cuda.get_rng_state(device) if device.type == "cuda" else None,
+    )
+
+
+@contextmanager
+def restore_rng_state(state: Tuple[torch.Tensor, Optional[torch.Tensor]], device: torch.device):
+    """
+    Replay the random ops (dropout, random scans) of the forward pass, without touching the global RNG.
+    """
+    devices = [device] if device.type == "cuda" else []
+    with torch.random.fork_rng(devices=devices):
+        torch.set_rng_state(state[0])
+        if state[1] is not None:
+            torch.cuda.set_rng_state(state[1], device)
+        yield
+
+
+def get_autocast_state(device: torch.device) -> Dict[str, Any]:
+    """
+    Autocast state of the forward pass, the backward pass runs in another thread that does not inherit it.
+    """
+    return {
+        "device_type": device.type,
+        "enabled": torch.is_autocast_enabled(device.type),
+        "dtype": torch.get_autocast_dtype(device.type),
+        "cache_enabled": torch.is_autocast_cache_enabled(),
+    }
+
+
+class ReversibleFunction(torch.autograd.Function):
+    """
+    Run the reversible blocks without keeping their activations: the backward pass reconstructs the inputs of every
+    block from its outputs, in reverse order, and backpropagates through one block at a time.
+    The training memory then no longer grows with depth.
+    The gradients of the block parameters are accumulated directly in their `.grad`.
+    """
+
+    @staticmethod
+    def forward(
+        ctx,
+        x1: torch.Tensor,
+        x2: torch.Tensor,
+        blocks: Sequence[nn.Module],
+        kwargs: Dict[str, Any],
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        device = x1.device
+        rng_states = []
+        with torch.no_grad():
+            for block in blocks:
+                f_state = get_rng_state(device)
+                x1 = x1 + block.token_mixer_forward(x2, **kwargs)[0]
+                g_state = get_rng_state(device)
+                x2 = x2 + block.channel_mixer_forward(x1)
+                rng_states.append((f_state, g_state))
+
+        ctx.blocks = blocks
+        ctx.kwargs = kwargs
+        ctx.rng_states = rng_states
+        # the branches are recomputed in backward with the same precision
+        ctx.autocast_state = get_autocast_state(device)
+        ctx.save_for_backward(x1, x2)
+        return x1, x2
+
+    @staticmethod
+    def backward(ctx, dy1: torch.Tensor, dy2: torch.Tensor):
+        y1, y2 = ctx.saved_tensors
+        device = y1.device
+        for block, (f_state, g_state) in zip(
+            reversed(ctx.blocks), reversed(ctx.rng_states)
+        ):
+            # y2 = x2 + G(y1)
+            with torch.enable_grad(), torch.autocast(**ctx.autocast_state):
+                y1 = y1.detach().requires_grad_(True)
+                with restore_rng_state(g_state, device):
+                    g_out = block.channel_mixer_forward(y1)
+                torch.autograd.backward(g_out, dy2)
+            with torch.no_grad():
+                x2 = y2 - g_out
+                dy1 = dy1 + y1.grad
+                del g_out
+
+            # y1 = x1 + F(x2)
+            with torch.enable_grad(), torch.autocast(**ctx.autocast_state):
+                x2 = x2.detach().requires_grad_(True)
+                with restore_rng_state(f_state, device):
+                    f_out = block.token_mixer_forward(x2, **ctx.kwargs)[0]
+                torch.autograd.backward(f_out, dy1)
+            with torch.no_grad():
+                x1 = y1 - f_out
+                dy2 = dy2 + x2.grad
+                del f_out
+
+            y1, y2 = x1.detach(), x2.detach()
+
+        return dy1, dy2, None, None
+
+
+def reversible_forward(
+    blocks: Sequence[nn.Module],
+    hidden_states: torch.Tensor,
+    output_attentions: bool = False,
+    output_hidden_states: bool = False,
+    hidden_state_taps: Optional[Sequence[Callable]] = None,
+    **kwargs,
+) -> Tuple[torch.Tensor, Optional[Tuple[torch.Tensor]], Optional[Tuple[torch.Tensor]]]:
+    """
+    Two-stream residual of RevViT (https://arxiv.org/abs/2302.10122), the input is duplicated into both streams:
+        y1 = x1 + F(x2), F being the token mixing branch of the block
+        y2 = x2 + G(y1), G being the channel mixing branch of the block
+    and the output is the average of the two streams.
+
+    In training, the blocks run in `ReversibleFunction` and keep no activations. The intermediate hidden states
+    (the average of the streams at the input of every block) and attentions need a regular autograd pass.
+    `hidden_state_taps` (callables `tap(hidden_states, cu_seqlens)` with a `layer` attribute) are applied to the
+    output of their block as soon as it is computed; in training the blocks are split into reversible segments
+    ending at the tapped blocks, so only the tapped outputs are kept.
+
+    Returns:
+        hidden_states, all_hidden_states (the taps, in order, if any), all_self_attentions
+    """
+    all_hidden_states = () if output_hidden_states else None
+    all_self_attentions = () if output_attentions else None
+    tapped_states = None
+    if hidden_state_taps is not None:
+        tapped_states = [None] * len(hidden_state_taps)
+    cu_seqlens = kwargs.get("cu_seqlens", None)
+
+    def apply_taps(layer_idx: int, x1: torch.Tensor, x2: torch.Tensor):
+        for i, tap in enumerate(hidden_state_taps or ()):
+            if tap.layer == layer_idx:
+                tapped_states[i] = tap((x1 + x2) / 2, cu_seqlens)
+
+    x1 = x2 = hidden_states
+    if torch.is_grad_enabled() and not output_hidden_states and not output_attentions:
+        segment_ends = {len(blocks) - 1}
+        if hidden_state_taps is not None:
+            segment_ends.update(tap.layer for tap in hidden_state_taps)
+        start = 0
+        for end in sorted(segment_ends):
+            x1, x2 = ReversibleFunction.apply(x1, x2, blocks[start : end + 1], kwargs)
+            apply_taps(end, x1, x2)
+            start = end + 1
+    else:
+        if torch.is_grad_enabled():
+            warnings.warn(
+                "Reversible blocks keep all their activations when the hidden states or attentions are returned "
+                "(output_hidden_states or output_attentions) with autograd enabled"
+            )
+        for i, block in enumerate(blocks):
+            if output_hidden_states:
+                all_hidden_states = all_hidden_states + ((x1 + x2) / 2,)
+            hidden_states, attentions, _ = block.token_mixer_forward(
+                x2, output_attentions=output_attentions, **kwargs
+            )
+            x1 = x1 + hidden_states
+            x2 = x2 + block.channel_mixer_forward(x1)
+            if output_attentions:
+                all_self_attentions = all_self_attentions + (attentions,)
+            apply_taps(i, x1, x2)
+
+    hidden_states = (x1 + x2) / 2
+    if output_hidden_states:
+        all_hidden_states = all_hidden_states + (hidden_states,)
+    if tapped_states is not None:
+        all_hidden_states = tuple(tapped_states)
+    return hidden_states, all_hidden_states, all_self_attentions
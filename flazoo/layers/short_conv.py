@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+from typing import List, Optional, Sequence, Tuple
+
+import torch
+import torch.nn.functional as F
+from fla.modules import ShortConvolution
+
+
+class FusedShortConvolution(ShortConvolution):
+    """
+    A single depthwise short convolution over the concatenated q/k/v channels.
+
+    Depthwise convolutions never mix channels, so running one `ShortConvolution` over `[q, k, v]`
+    is equivalent to running three of them back to back, while reading the input once and launching one kernel.
+
+    Checkpoints saved with separate `q_conv1d`/`k_conv1d`/`v_conv1d` modules can still be loaded,
+    see `register_legacy_state_dict_hook`.
+    """
+
+    def __init__(
+        self,
+        split_sizes: Sequence[int],
+        kernel_size: int,
+        bias: bool = False,
+        activations: Sequence[Optional[str]] = ("silu", "silu", "silu"),
+        **kwargs,
+    ):
+        assert len(split_sizes) == len(activations), (
+            "split_sizes and activations must have the same length"
+        )
+        # if all the splits share one activation, let the kernel apply it
+        shared_activation = (
+            activations[0] if len(set(activations)) == 1 else None
+        )
+        super().__init__(
+            hidden_size=sum(split_sizes),
+            kernel_size=kernel_size,
+            bias=bias,
+            activation=shared_activation,
+            **kwargs,
+        )
+        self.split_sizes = list(split_sizes)
+        self.activations = list(activations)
+        self.fuse_activation = shared_activation is not None or all(
+            act is None for act in activations
+        )
+
+    def forward(
+        self,
+        x: torch.Tensor,
+        cache: Optional[torch.Tensor] = None,
+        output_final_state: bool = False,
+        cu_seqlens: Optional[torch.LongTensor] = None,
+        **kwargs,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """
+        Args:
+            x: [B, T, sum(split_sizes)], the concatenated q/k/v
+        Returns:
+            y: [B, T, sum(split_sizes)]
+            cache: the fused conv cache if `output_final_state` is True
+        """
+        y, cache = super().forward(
+            x=x,
+            cache=cache,
+            output_final_state=output_final_state,
+            cu_seqlens=cu_seqlens,
+            **kwargs,
+        )
+        if not self.fuse_activation:
+            y = torch.cat(
+                [
+                    F.silu(y_i) if act in ("silu", "swish") else y_i
+                    for y_i, act in zip(
+                        y.split(self.split_sizes, dim=-1), self.activations
+                    )
+                ],
+                dim=-1,
+            )
+        return y, cache
+
+    def split_forward(
+        self,
+        *xs: torch.Tensor,
+        cache: Optional[torch.Tensor] = None,
+        output_final_state: bool = False,
+        cu_seqlens: Optional[torch.LongTensor] = None,
+        **kwargs,
+    ) -> Tuple[List[torch.Tensor], Optional[torch.Tensor]]:
+        """
+        Args:
+            xs: one tensor per split, each of shape [B, T, split_size]
+        Returns:
+            A list with one output per split, and the fused conv cache
+        """
+        assert len(xs) == len(self.split_sizes)
+        if len(set(x.shape[:-1] for x in xs)) > 1:
+            # splits of different lengths cannot share one sequence, fall back to one conv per split
+            assert cache is None and not output_final_state, (
+                "conv cache is not supported when the splits have different lengths"
+            )
+            return self._forward_unfused(xs), None
+
+        y, cache = self.forward(
+            torch.cat(xs, dim=-1),
+            cache=cache,
+            output_final_state=output_final_state,
+            cu_seqlens=cu_seqlens,
+            **kwargs,
+        )
+        return list(y.split(self.split_sizes, dim=-1)), cache
+
+    def _forward_unfused(self, xs: Sequence[torch.Tensor]) -> List[torch.Tensor]:
+        # pure torch fallback, slicing the fused depthwise filters per split
+        weights = self.weight.split(self.split_sizes, dim=0)
+        biases = (
+            self.bias.split(self.split_sizes, dim=0)
+            if self.bias is not None
+            else [None] * len(self.split_sizes)
+        )
+        ys = []
+        for x, w, b, act in zip(xs, weights, biases, self.activations):
+            seq_len = x.shape[1]
+            y = F.conv1d(
+                x.transpose(1, 2),
+                w.to(x.dtype),
+                b.to(x.dtype) if b is not None else None,
+                padding=self.kernel_size[0] - 1,
+                groups=w.shape[0],
+            )[..., :seq_len].transpose(1, 2)
+            if act in ("silu", "swish"):
+                y = F.silu(y)
+            ys.append(y)
+        return ys
+
+    def register_legacy_state_dict_hook(
+        self,
+        parent: torch.nn.Module,
+        name: str,
+        legacy_names: Sequence[str] = ("q_conv1d", "k_conv1d", "v_conv1d"),
+    ):
+        """
+        Let `parent` load state dicts with one conv per split (e.g. `q_conv1d.weight`, ...)
+        by concatenating them into `{name}.weight` before loading.
+        """
+
+        def hook(state_dict, prefix, *args):
+            for param in ("weight", "bias"):
+                legacy_keys = [f"{prefix}{n}.{param}" for n in legacy_names]
+                if not all(k in state_dict for k in legacy_keys):
+                    continue
+                state_dict[f"{prefix}{name}.{param}"] = torch.cat(
+                    [state_dict.pop(k) for k in legacy_keys], dim=0
+                )
+
+        parent._register_load_state_dict_pre_hook(hook)
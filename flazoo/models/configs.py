@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from typing import Dict, Optional, Any
+from typing import Any, Dict, List, Optional, Union
 
 from transformers.configuration_utils import PretrainedConfig
 
@@ -166,19 +166,39 @@ class FLAVisionConfig(PretrainedConfig):
         num_householder: int = None,
         use_gk: bool = None,
         use_gv: bool = None,
+        lact_chunk_size: Optional[int] = None,
+        lact_use_muon: bool = False,  # orthogonalize the fast weight updates with Newton-Schulz
+        lact_muon_tol: Optional[float] = None,  # None: fixed 5 Newton-Schulz iterations, else adaptive
         # Vision specific parameters
         image_size: int = 224,
         patch_size: int = 16,
         num_channels: int = 3,
         num_classes: int = 1000,
         hidden_dropout_prob: float = 0.0,
+        patch_dropout: float = 0.0,  # fraction of the patches dropped per sample in classification training
+        token_merge_ratio: Optional[Union[float, List[float]]] = None,  # fraction of the tokens merged after each block at inference
+        stages: Optional[List[Dict]] = None,  # hierarchical encoder, one dict per stage, see below
+        early_exit_layers: Optional[List[int]] = None,  # blocks followed by a pooled exit classifier
+        early_exit_threshold: Optional[float] = None,  # softmax confidence to exit at inference, None runs every block
+        reversible: bool = False,  # RevViT two-stream blocks, activations are reconstructed in backward
+        checkpoint_policy: Optional[Dict[str, str]] = None,  # "save" / "recompute" / "offload" per sub-module of the blocks
         use_mask_token: bool = False,
         layer_norm_eps: float = 1e-6,
         interpolate_pos_encoding: bool = False,
+        pos_encoding_cache_size: int = 8,  # interpolated position tables cached at inference, one per resolution
         encoder_stride=16,
         channel_mixer_dim: int = None,
+        channel_mixer_chunk_size: Optional[int] = None,  # tokens per slice of the channel mixer, recomputed in backward
         train_scan_type: str = "uni-scan",
         test_scan_type: str = None,
+        # masked image modeling objective, "simmim" or "mae"
+        mim_mode: str = "simmim",
+        norm_pix_loss: bool = False,
+        # decoder specific parameters, only used by the "mae" objective
+        decoder_num_heads: int = 6,
+        decoder_hidden_size: int = 256,
+        decoder_num_hidden_layers: int = 4,
+        decoder_channel_mixer_dim: int = None,
         **kwargs,
     ):
         # Get the default values for the chosen model variant
@@ -315,14 +335,25 @@ class FLAVisionConfig(PretrainedConfig):
         )
         self.use_gk = use_gk if use_gk is not None else defaults.get("use_gk")
         self.use_gv = use_gv
+        self.lact_chunk_size = lact_chunk_size
+        self.lact_use_muon = lact_use_muon
+        self.lact_muon_tol = lact_muon_tol
         self.image_size = image_size
         self.patch_size = patch_size
         self.num_channels = num_channels
         self.num_classes = num_classes
         self.hidden_dropout_prob = hidden_dropout_prob
+        self.patch_dropout = patch_dropout
+        self.token_merge_ratio = token_merge_ratio
+        self.stages = stages
+        self.early_exit_layers = early_exit_layers
+        self.early_exit_threshold = early_exit_threshold
+        self.reversible = reversible
+        self.checkpoint_policy = checkpoint_policy
         self.use_mask_token = use_mask_token
         self.layer_norm_eps = layer_norm_eps
         self.interpolate_pos_encoding = interpolate_pos_encoding
+        self.pos_encoding_cache_size = pos_encoding_cache_size
         self.encoder_stride = encoder_stride
         self.train_scan_type = train_scan_type
 
@@ -331,6 +362,13 @@ class FLAVisionConfig(PretrainedConfig):
         else:
             self.test_scan_type = test_scan_type
         self.encoder_stride = encoder_stride
+        self.mim_mode = mim_mode
+        self.norm_pix_loss = norm_pix_loss
+
+        # Initialize decoder specific parameters
+        self.decoder_num_heads = decoder_num_heads
+        self.decoder_hidden_size = decoder_hidden_size
+        self.decoder_num_hidden_layers = decoder_num_hidden_layers
 
         if attn is not None:
             if not isinstance(attn, Dict):
@@ -346,6 +384,8 @@ class FLAVisionConfig(PretrainedConfig):
             attn["num_kv_heads"] = attn.get("num_kv_heads", attn["num_heads"])
             attn["window_size"] = attn.get("window_size", None)
             attn["rope_theta"] = attn.get("rope_theta", 10000.0)
+            # Mixture-of-Depths, fraction of the tokens routed through the attention layers, None routes all of them
+            attn["capacity_ratio"] = attn.get("capacity_ratio", None)
 
         self.attn = attn
 
@@ -355,6 +395,65 @@ class FLAVisionConfig(PretrainedConfig):
             )  # default value set to 4 * hidden_size
         else:
             self.channel_mixer_dim = channel_mixer_dim
+        self.channel_mixer_chunk_size = channel_mixer_chunk_size
+
+        if decoder_channel_mixer_dim is None:
+            self.decoder_channel_mixer_dim = 4 * decoder_hidden_size
+        else:
+            self.decoder_channel_mixer_dim = decoder_channel_mixer_dim  # default value set to 4 * decoder_hidden_size
+
+        if stages is not None:
+            # each stage is a dict with `num_hidden_layers`, and optionally any other config field
+            # (e.g. `hidden_size`, `num_heads`, `fla_attn_type`, `attn_type`, `attn`, `channel_mixer_dim`).
+            # Stages after the first one start with a 2x2 patch merging, the width and heads default to twice the previous stage.
+            # Hybrid attention layer indices are global, and `num_hidden_layers` becomes the total number of layers.
+            if not isinstance(stages, (list, tuple)) or len(stages) == 0:
+                raise ValueError("stages must be a non-empty list of dictionaries")
+            stages = [dict(stage) for stage in stages]
+            for idx, stage in enumerate(stages):
+                if "num_hidden_layers" not in stage:
+                    raise ValueError(
+                        f"Number of layers must be provided for stage {idx}"
+                    )
+                prev = stages[idx - 1] if idx > 0 else None
+                stage.setdefault(
+                    "hidden_size", 2 * prev["hidden_size"] if prev else hidden_size
+                )
+                stage.setdefault(
+                    "num_heads", 2 * prev["num_heads"] if prev else num_heads
+                )
+                stage.setdefault("channel_mixer_dim", 4 * stage["hidden_size"])
+                if stage.get("fla_attn_type", fla_attn_type) != fla_attn_type:
+                    if stage["fla_attn_type"] not in FLA_ARGS_DEFAULTS:
+                        raise ValueError(
+                            f"Unknown fla_attn_type: '{stage['fla_attn_type']}' for stage {idx}. "
+                            f"Available options: {list(FLA_ARGS_DEFAULTS.keys())}"
+                        )
+                    for key, value in FLA_ARGS_DEFAULTS[stage["fla_attn_type"]].items():
+                        stage.setdefault(key, value)
+                if stage.get("attn", None) is not None:
+                    stage_attn = dict(stage["attn"])
+                    if "layers" not in stage_attn or "num_heads" not in stage_attn:
+                        raise ValueError(
+                            f"Layer indices and number of heads must be provided for the hybrid attention of stage {idx}"
+                        )
+                    stage_attn["num_kv_heads"] = stage_attn.get(
+                        "num_kv_heads", stage_attn["num_heads"]
+                    )
+                    stage_attn["window_size"] = stage_attn.get("window_size", None)
+                    stage_attn["rope_theta"] = stage_attn.get("rope_theta", 10000.0)
+                    stage_attn["capacity_ratio"] = stage_attn.get(
+                        "capacity_ratio", None
+                    )
+                    stage["attn"] = stage_attn
+            if stages[0]["hidden_size"] != hidden_size:
+                raise ValueError(
+                    "The first stage must have the same hidden_size as the patch embeddings"
+                )
+            self.stages = stages
+            self.num_hidden_layers = sum(
+                stage["num_hidden_layers"] for stage in stages
+            )
 
         super().__init__(**kwargs)
 
@@ -423,20 +522,31 @@ class FLAVideoConfig(PretrainedConfig):
         num_householder: int = None,
         use_gk: bool = None,
         use_gv: bool = None,
+        lact_chunk_size: Optional[int] = None,
+        lact_use_muon: bool = False,  # orthogonalize the fast weight updates with Newton-Schulz
+        lact_muon_tol: Optional[float] = None,  # None: fixed 5 Newton-Schulz iterations, else adaptive
         # Video specific parameters
         image_size: int = 224,
         patch_size: int = 16,
         num_channels: int = 3,
         num_classes: int = 1000,
         hidden_dropout_prob: float = 0.0,
+        early_exit_layers: Optional[List[int]] = None,  # blocks followed by a pooled exit classifier
+        early_exit_threshold: Optional[float] = None,  # softmax confidence to exit at inference, None runs every block
+        reversible: bool = False,  # RevViT two-stream blocks, activations are reconstructed in backward
+        temporal_layers: Optional[List[int]] = None,  # factorized blocks: these scan along time, the others within frames
+        checkpoint_policy: Optional[Dict[str, str]] = None,  # "save" / "recompute" / "offload" per sub-module of the blocks
         use_mask_token: bool = False,
         layer_norm_eps: float = 1e-6,
         interpolate_pos_encoding: bool = False,
+        pos_encoding_cache_size: int = 8,  # interpolated position tables cached at inference, one per resolution
         encoder_stride=16,
         channel_mixer_dim: int = None,
+        channel_mixer_chunk_size: Optional[int] = None,  # tokens per slice of the channel mixer, recomputed in backward
         train_scan_type: str = "uni-scan",  # scaning type, "uni-scan" or "bi-scan" or "cross-scan", default to "uni-scan"
         test_scan_type: str = None,  # scaning type, "uni-scan" or "bi-scan" or "cross-scan", default to "uni-scan"
         norm_pix_loss: bool = True,
+        decoder_mask_ratio: float = 0.0,
         num_frames: int = 16,
         tubelet_size: int = 2,
         t_dim: int = 32,
@@ -582,14 +692,29 @@ class FLAVideoConfig(PretrainedConfig):
         )
         self.use_gk = use_gk if use_gk is not None else defaults.get("use_gk")
         self.use_gv = use_gv
+        self.lact_chunk_size = lact_chunk_size
+        self.lact_use_muon = lact_use_muon
+        self.lact_muon_tol = lact_muon_tol
         self.image_size = image_size
         self.patch_size = patch_size
         self.num_channels = num_channels
         self.num_classes = num_classes
         self.hidden_dropout_prob = hidden_dropout_prob
+        self.early_exit_layers = early_exit_layers
+        self.early_exit_threshold = early_exit_threshold
+        self.reversible = reversible
+        if temporal_layers is not None and any(
+            not 0 <= i < num_hidden_layers for i in temporal_layers
+        ):
+            raise ValueError(
+                f"temporal_layers must be block indices in [0, {num_hidden_layers}), got {temporal_layers}"
+            )
+        self.temporal_layers = temporal_layers
+        self.checkpoint_policy = checkpoint_policy
         self.use_mask_token = use_mask_token
         self.layer_norm_eps = layer_norm_eps
         self.interpolate_pos_encoding = interpolate_pos_encoding
+        self.pos_encoding_cache_size = pos_encoding_cache_size
         self.train_scan_type = train_scan_type
 
         if test_scan_type is None:
@@ -598,6 +723,7 @@ class FLAVideoConfig(PretrainedConfig):
             self.test_scan_type = test_scan_type
         self.encoder_stride = encoder_stride
         self.norm_pix_loss = norm_pix_loss
+        self.decoder_mask_ratio = decoder_mask_ratio
         self.num_frames = num_frames
         self.tubelet_size = tubelet_size
         self.t_dim = t_dim
@@ -621,6 +747,8 @@ class FLAVideoConfig(PretrainedConfig):
             attn["num_kv_heads"] = attn.get("num_kv_heads", attn["num_heads"])
             attn["window_size"] = attn.get("window_size", None)
             attn["rope_theta"] = attn.get("rope_theta", 10000.0)
+            # Mixture-of-Depths, fraction of the tokens routed through the attention layers, None routes all of them
+            attn["capacity_ratio"] = attn.get("capacity_ratio", None)
 
         self.attn = attn
 
@@ -630,6 +758,7 @@ class FLAVideoConfig(PretrainedConfig):
             )  # default value set to 4 * hidden_size
         else:
             self.channel_mixer_dim = channel_mixer_dim
+        self.channel_mixer_chunk_size = channel_mixer_chunk_size
 
         if decoder_channel_mixer_dim is None:
             self.decoder_channel_mixer_dim = 4 * decoder_hidden_size
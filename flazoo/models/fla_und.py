@@ -2,6 +2,7 @@
 
 from __future__ import annotations
 
+import functools
 import math
 from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
 
@@ -25,13 +26,42 @@ from fla.modules.activations import swiglu_linear
 from fla.modules import GatedMLP as FLASwiGLU
 from fla.modules.layernorm import rms_norm_linear, LayerNorm
 from flazoo.models.utils import (
+    add_norm,
     prepare_hidden_states_for_scan,
     prepare_hidden_states_for_merge,
+    gather_tokens,
+    mask_to_indices,
+    sample_decoder_indices,
+    scan_requires_full_grid,
+    sample_patch_dropout_indices,
+    FULL_GRID_SCAN_TYPES,
+    prepare_packed_hidden_states_for_scan,
+    prepare_packed_hidden_states_for_merge,
+    bipartite_merge,
+    route_top_k,
+    scatter_tokens,
+    early_exit_forward,
+    fold_video_tokens,
+    unfold_video_tokens,
+)
+from flazoo.models.und.utils import (
+    ImageEmbeddings,
+    Pooler,
+    ImageDecoderOutput,
+    StagedEncoderOutput,
+    StagedModelOutputWithPooling,
+    EarlyExitClassifierOutput,
+    HiddenStateTap,
+    get_early_exit_heads,
+    classification_loss,
+    get_hidden_state_taps,
+    requires_full_token_grid,
+    get_image_patch_targets,
+    patches_to_image,
 )
-from flazoo.models.und.utils import ImageEmbeddings, Pooler
-from transformers.utils.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 from flazoo.models.und.utils import (
     VideoEmbeddings,
+    get_video_patch_targets,
     VideoDecoderOutput,
     VideoForPreTrainingOutput,
     get_sinusoid_encoding_table,
@@ -39,7 +69,14 @@ from flazoo.models.und.utils import (
 from copy import deepcopy
 from flazoo.helpers.scanner import LearnableScan
 from flazoo.models.utils import compress_seq, decompress_seq
-from flazoo.layers.attentions import get_fla_attn
+from flazoo.layers.attentions import (
+    get_fla_attn,
+    PACKED_ATTN_LISTS,
+    PACKED_FLA_ATTN_LISTS,
+    GRID_ATTN_LISTS,
+)
+from flazoo.layers.reversible import reversible_forward
+from flazoo.layers.checkpointing import CheckpointPolicy, sequence_chunked_forward
 
 logger = logging.get_logger(__name__)
 
@@ -111,6 +148,25 @@ class FLAVisionBlock(nn.Module):
 
         self.num_heads = config.num_heads
 
+        self.channel_mixer_chunk_size = getattr(config, "channel_mixer_chunk_size", None)
+
+        # what the token / channel mixers and norms save for backward, see `CheckpointPolicy`
+        self.checkpoint_policy = CheckpointPolicy.from_config(
+            getattr(config, "checkpoint_policy", None)
+        )
+
+        # Mixture-of-Depths routing for the hybrid attention layers
+        self.capacity_ratio = None
+        if config.attn is not None and layer_idx in config.attn["layers"]:
+            capacity_ratio = config.attn.get("capacity_ratio", None)
+            if capacity_ratio is not None and capacity_ratio < 1.0:
+                if config.attn_type != "full_attn":
+                    raise ValueError(
+                        f"Token routing is only supported for full_attn hybrid layers, got {config.attn_type}"
+                    )
+                self.capacity_ratio = capacity_ratio
+                self.router = nn.Linear(config.hidden_size, 1, bias=False)
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -118,24 +174,123 @@ class FLAVisionBlock(nn.Module):
         use_cache: Optional[bool] = False,
         output_attentions: Optional[bool] = False,
         **kwargs: Unpack[Dict],
+    ):
+        if self.capacity_ratio is None or kwargs.get("cu_seqlens", None) is not None:
+            return self._forward(
+                hidden_states,
+                past_key_values=past_key_values,
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+                **kwargs,
+            )
+
+        # only the top-k tokens of each sample go through attention and MLP, the others skip the block,
+        # the quadratic attention then costs k^2 instead of L^2
+        indices, weights = route_top_k(
+            self.router(hidden_states).squeeze(-1), self.capacity_ratio
+        )
+        routed = gather_tokens(hidden_states, indices)
+        outputs, attentions, past_key_values = self._forward(
+            routed,
+            past_key_values=past_key_values,
+            use_cache=use_cache,
+            output_attentions=output_attentions,
+            **kwargs,
+        )
+        hidden_states = scatter_tokens(
+            hidden_states, indices, torch.lerp(routed, outputs, weights)
+        )
+        return hidden_states, attentions, past_key_values
+
+    def _forward(
+        self,
+        hidden_states: torch.Tensor,
+        past_key_values: Optional[Union[Cache, List[torch.FloatTensor]]] = None,
+        use_cache: Optional[bool] = False,
+        output_attentions: Optional[bool] = False,
+        **kwargs: Unpack[Dict],
     ) -> Union[Tuple[torch.Tensor, Optional[torch.Tensor]], Tuple[torch.Tensor]]:
         residual = hidden_states
 
-        hidden_states = self.ln_1(hidden_states)
+        hidden_states, attentions, past_key_values = self.token_mixer_forward(
+            hidden_states,
+            past_key_values=past_key_values,
+            use_cache=use_cache,
+            output_attentions=output_attentions,
+            **kwargs,
+        )
+
+        # the residual add of the token mixer is done in one pass with ln_2
+        hidden_states, residual = self.channel_mixer_forward(hidden_states, residual)
+
+        hidden_states = residual + hidden_states
+
+        outputs = (hidden_states, attentions, past_key_values)
+
+        return outputs
+
+    def token_mixer_forward(
+        self,
+        hidden_states: torch.Tensor,
+        past_key_values: Optional[Union[Cache, List[torch.FloatTensor]]] = None,
+        use_cache: Optional[bool] = False,
+        output_attentions: Optional[bool] = False,
+        **kwargs: Unpack[Dict],
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Cache]]:
+        """
+        The token mixing branch of the block, without its residual: norm, scan, attention and merge.
+        """
+        if self.checkpoint_policy is not None and self.training:
+            return self.checkpoint_policy.run_branch(
+                "token_mixer",
+                self.ln_1,
+                self._mix_tokens,
+                hidden_states,
+                past_key_values=past_key_values,
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+                **kwargs,
+            )
+        return self._mix_tokens(
+            self.ln_1(hidden_states),
+            past_key_values=past_key_values,
+            use_cache=use_cache,
+            output_attentions=output_attentions,
+            **kwargs,
+        )
 
+    def _mix_tokens(
+        self,
+        hidden_states: torch.Tensor,
+        past_key_values: Optional[Union[Cache, List[torch.FloatTensor]]] = None,
+        use_cache: Optional[bool] = False,
+        output_attentions: Optional[bool] = False,
+        **kwargs: Unpack[Dict],
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Cache]]:
         if self.compress_attention:
             hidden_states = compress_seq(hidden_states, self.block_size)
 
-        hidden_states = prepare_hidden_states_for_scan(
-            hidden_states,
-            train_scan_type=self.train_scan_type,
-            test_scan_type=self.test_scan_type,
-            training=self.training,
-            scan_module=self.scanner
-            if self.train_scan_type == "learnable-scan"
-            else None,
-            num_heads=self.num_heads,
-        )
+        cu_seqlens = kwargs.pop("cu_seqlens", None)
+        if cu_seqlens is None:
+            hidden_states = prepare_hidden_states_for_scan(
+                hidden_states,
+                train_scan_type=self.train_scan_type,
+                test_scan_type=self.test_scan_type,
+                training=self.training,
+                scan_module=self.scanner
+                if self.train_scan_type == "learnable-scan"
+                else None,
+                num_heads=self.num_heads,
+            )
+        else:
+            # packed sequences, each of them is scanned on its own
+            hidden_states, kwargs["cu_seqlens"] = prepare_packed_hidden_states_for_scan(
+                hidden_states,
+                cu_seqlens,
+                train_scan_type=self.train_scan_type,
+                test_scan_type=self.test_scan_type,
+                training=self.training,
+            )
 
         hidden_states, attentions, past_key_values = self.attn(
             hidden_states=hidden_states,
@@ -145,30 +300,65 @@ class FLAVisionBlock(nn.Module):
             **kwargs,
         )
 
-        hidden_states = prepare_hidden_states_for_merge(
-            hidden_states,
-            train_scan_type=self.train_scan_type,
-            test_scan_type=self.test_scan_type,
-            training=self.training,
-            layer_idx=self.layer_idx,
-            num_heads=self.num_heads,
-        )
+        if cu_seqlens is None:
+            hidden_states = prepare_hidden_states_for_merge(
+                hidden_states,
+                train_scan_type=self.train_scan_type,
+                test_scan_type=self.test_scan_type,
+                training=self.training,
+                layer_idx=self.layer_idx,
+                num_heads=self.num_heads,
+            )
+        else:
+            hidden_states = prepare_packed_hidden_states_for_merge(
+                hidden_states,
+                cu_seqlens,
+                train_scan_type=self.train_scan_type,
+                test_scan_type=self.test_scan_type,
+                training=self.training,
+                layer_idx=self.layer_idx,
+            )
 
         if self.compress_attention:
             hidden_states = decompress_seq(hidden_states, self.block_size)
 
-        hidden_states = residual + hidden_states
-        residual = hidden_states
-
-        hidden_states = self.ln_2(hidden_states)
-
-        hidden_states = self.channel_mixer(hidden_states)
-
-        hidden_states = residual + hidden_states
-
-        outputs = (hidden_states, attentions, past_key_values)
-
-        return outputs
+        return hidden_states, attentions, past_key_values
+
+    def channel_mixer_forward(
+        self, hidden_states: torch.Tensor, residual: Optional[torch.Tensor] = None
+    ) -> Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        The channel mixing branch of the block, without its residual.
+        With `residual`, ln_2 is applied to `residual + hidden_states` in one pass (see `add_norm`),
+        and the sum, the residual of the branch, is returned too.
+        """
+        channel_mixer = self.channel_mixer
+        if self.channel_mixer_chunk_size is not None:
+            # the 4x wider intermediate only exists for one slice of tokens at a time
+            channel_mixer = functools.partial(
+                sequence_chunked_forward,
+                self.channel_mixer,
+                chunk_size=self.channel_mixer_chunk_size,
+            )
+        if self.checkpoint_policy is not None and self.training:
+            # the policy applies around the chunked channel mixer
+            return self.checkpoint_policy.run_branch(
+                "channel_mixer",
+                self.ln_2,
+                channel_mixer,
+                hidden_states,
+                residual=residual,
+            )
+        if residual is None:
+            if self.channel_mixer_chunk_size is not None:
+                return sequence_chunked_forward(
+                    lambda x: self.channel_mixer(self.ln_2(x)),
+                    hidden_states,
+                    self.channel_mixer_chunk_size,
+                )
+            return self.channel_mixer(self.ln_2(hidden_states))
+        hidden_states, residual = add_norm(self.ln_2, hidden_states, residual)
+        return channel_mixer(hidden_states), residual
 
 
 class FLAVisionPreTrainedModel(PreTrainedModel):
@@ -200,17 +390,123 @@ class FLAVisionPreTrainedModel(PreTrainedModel):
                 ).to(module.position_embeddings.dtype)
 
 
+class FLAPatchMerging(nn.Module):
+    """
+    Downsample the token grid by 2 per side between two stages of a hierarchical encoder:
+    every 2x2 neighborhood is concatenated, normalized and projected to the width of the next stage (as in Swin).
+    """
+
+    def __init__(self, hidden_size: int, out_hidden_size: int, eps: float = 1e-6):
+        super().__init__()
+        self.norm = LayerNorm(4 * hidden_size, bias=True, eps=eps)
+        self.reduction = nn.Linear(4 * hidden_size, out_hidden_size, bias=False)
+
+    def forward(
+        self, hidden_states: torch.Tensor, grid_size: Tuple[int, int]
+    ) -> Tuple[torch.Tensor, Tuple[int, int]]:
+        batch_size, _, hidden_size = hidden_states.shape
+        height, width = grid_size
+        hidden_states = hidden_states.view(batch_size, height, width, hidden_size)
+        if height % 2 or width % 2:
+            # pad odd grids with zeros on the bottom / right
+            hidden_states = nn.functional.pad(
+                hidden_states, (0, 0, 0, width % 2, 0, height % 2)
+            )
+        hidden_states = torch.cat(
+            [
+                hidden_states[:, 0::2, 0::2],
+                hidden_states[:, 1::2, 0::2],
+                hidden_states[:, 0::2, 1::2],
+                hidden_states[:, 1::2, 1::2],
+            ],
+            dim=-1,
+        )
+        grid_size = (hidden_states.shape[1], hidden_states.shape[2])
+        hidden_states = hidden_states.reshape(batch_size, -1, 4 * hidden_size)
+        hidden_states = self.reduction(self.norm(hidden_states))
+        return hidden_states, grid_size
+
+
 class FLAVisionEncoder(nn.Module):
     def __init__(self, config) -> None:
         super().__init__()
         self.config = config
-        self.blocks = nn.ModuleList(
-            [
-                FLAVisionBlock(config, layer_idx)
-                for layer_idx in range(config.num_hidden_layers)
-            ]
-        )
+        if getattr(config, "stages", None) is None:
+            self.blocks = nn.ModuleList(
+                [
+                    FLAVisionBlock(config, layer_idx)
+                    for layer_idx in range(config.num_hidden_layers)
+                ]
+            )
+            self.downsamplers = None
+            self.stage_ends = None
+            self.hidden_size = config.hidden_size
+        else:
+            # hierarchical encoder, the blocks stay in a flat list and are indexed globally,
+            # the downsamplers are keyed by the index of the first block of their stage
+            blocks, downsamplers, self.stage_ends = [], {}, []
+            for stage_idx, stage in enumerate(config.stages):
+                stage_config = self._get_stage_config(config, stage_idx)
+                if stage_idx > 0:
+                    downsamplers[str(len(blocks))] = FLAPatchMerging(
+                        config.stages[stage_idx - 1]["hidden_size"],
+                        stage["hidden_size"],
+                        eps=config.layer_norm_eps,
+                    )
+                for _ in range(stage["num_hidden_layers"]):
+                    blocks.append(FLAVisionBlock(stage_config, len(blocks)))
+                self.stage_ends.append(len(blocks) - 1)
+            self.blocks = nn.ModuleList(blocks)
+            self.downsamplers = nn.ModuleDict(downsamplers)
+            self.hidden_size = config.stages[-1]["hidden_size"]
+        self.reversible = getattr(config, "reversible", False)
+        if self.reversible:
+            if any(block.capacity_ratio is not None for block in self.blocks):
+                raise ValueError("Reversible blocks do not support token routing")
+            if self.downsamplers is not None:
+                raise ValueError("Reversible blocks do not support stages")
         self.gradient_checkpointing = False
+        self.token_merge_ratios = self._get_token_merge_ratios(config)
+
+    def set_checkpoint_policy(
+        self, policy: Optional[Union[CheckpointPolicy, Dict[str, str]]]
+    ) -> None:
+        """
+        Choose what every block saves for backward, e.g. `{"token_mixer": "recompute", "norms": "recompute"}`.
+        """
+        policy = CheckpointPolicy.from_config(policy)
+        for block in self.blocks:
+            block.checkpoint_policy = policy
+
+    @staticmethod
+    def _get_stage_config(config, stage_idx: int):
+        stage_config = deepcopy(config)
+        stage_config.stages = None
+        for key, value in config.stages[stage_idx].items():
+            if key != "num_hidden_layers":
+                setattr(stage_config, key, value)
+        # the token grid of the stage, e.g. for the learnable scan
+        stage_config.patch_size = config.patch_size * 2**stage_idx
+        return stage_config
+
+    @staticmethod
+    def _get_token_merge_ratios(config) -> Optional[List[float]]:
+        ratio = getattr(config, "token_merge_ratio", None)
+        if not ratio:
+            return None
+        if requires_full_token_grid(config):
+            logger.warning(
+                "Token merging is disabled: the scans, the compression, the hybrid attention layers, "
+                "the patch merging between stages or the reversible blocks need the full token grid."
+            )
+            return None
+        if isinstance(ratio, (int, float)):
+            return [float(ratio)] * config.num_hidden_layers
+        if len(ratio) != config.num_hidden_layers:
+            raise ValueError(
+                f"token_merge_ratio should have one entry per layer, got {len(ratio)} for {config.num_hidden_layers} layers"
+            )
+        return [float(r) for r in ratio]
 
     def forward(
         self,
@@ -220,12 +516,66 @@ class FLAVisionEncoder(nn.Module):
         past_key_values: Optional[Union[Cache, List[torch.FloatTensor]]] = None,
         use_cache: Optional[bool] = None,
         return_dict: bool = True,
+        grid_size: Optional[Tuple[int, int]] = None,
+        hidden_state_taps: Optional[List[Union[int, HiddenStateTap]]] = None,
         **kwargs,
-    ) -> Union[tuple, BaseModelOutput]:
+    ) -> Union[tuple, BaseModelOutput, StagedEncoderOutput]:
+        taps = get_hidden_state_taps(hidden_state_taps, len(self.blocks))
+        if taps is not None:
+            # the taps replace the hidden states of every block
+            output_hidden_states = False
+            tapped_states = [None] * len(taps)
         all_hidden_states = () if output_hidden_states else None
         all_self_attentions = () if output_attentions else None
+        all_stage_hidden_states = () if self.stage_ends is not None else None
+
+        if self.downsamplers is not None and grid_size is None:
+            side = int(math.sqrt(hidden_states.shape[1]))
+            grid_size = (side, side)
+
+        if self.reversible:
+            # the activations are reconstructed in backward, gradient checkpointing is not needed
+            hidden_states, all_hidden_states, all_self_attentions = (
+                reversible_forward(
+                    self.blocks,
+                    hidden_states,
+                    output_attentions=output_attentions,
+                    output_hidden_states=output_hidden_states,
+                    hidden_state_taps=taps,
+                    **kwargs,
+                )
+            )
+            if not return_dict:
+                return tuple(
+                    v
+                    for v in [hidden_states, all_hidden_states, all_self_attentions]
+                    if v is not None
+                )
+            return BaseModelOutput(
+                last_hidden_state=hidden_states,
+                hidden_states=all_hidden_states,
+                attentions=all_self_attentions,
+            )
+
+        # ToMe at inference, the merged tokens are unmerged at the end for dense outputs
+        token_merging = (
+            self.token_merge_ratios is not None
+            and not self.training
+            and kwargs.get("cu_seqlens", None) is None
+        )
+        if token_merging:
+            batch_size, seq_len = hidden_states.shape[:2]
+            size = hidden_states.new_ones(batch_size, seq_len, 1)
+            token_map = torch.arange(seq_len, device=hidden_states.device).expand(
+                batch_size, -1
+            )
 
         for i, block in enumerate(self.blocks):
+            if self.downsamplers is not None and str(i) in self.downsamplers:
+                hidden_states, grid_size = self.downsamplers[str(i)](
+                    hidden_states, grid_size
+                )
+
             if output_hidden_states:
                 all_hidden_states = all_hidden_states + (hidden_states,)
 
@@ -252,16 +602,60 @@ class FLAVisionEncoder(nn.Module):
             if output_attentions:
                 all_self_attentions = all_self_attentions + (attentions,)
 
+            if all_stage_hidden_states is not None and i in self.stage_ends:
+                all_stage_hidden_states = all_stage_hidden_states + (hidden_states,)
+
+            if taps is not None:
+                for j, tap in enumerate(taps):
+                    if tap.layer == i:
+                        # the merged tokens are unmerged for the tap, like the last hidden state
+                        tapped_states[j] = tap(
+                            (
+                                gather_tokens(hidden_states, token_map)
+                                if token_merging
+                                else hidden_states
+                            ),
+                            kwargs.get("cu_seqlens", None),
+                        )
+
+            if token_merging and self.token_merge_ratios[i] > 0:
+                hidden_states, size, token_map = bipartite_merge(
+                    hidden_states,
+                    size,
+                    token_map,
+                    int(self.token_merge_ratios[i] * hidden_states.shape[1]),
+                )
+
+        if token_merging:
+            # every original token takes the state of the token it was merged into,
+            # so that the mean pooling over them is the size weighted mean of the merged tokens
+            hidden_states = gather_tokens(hidden_states, token_map)
+
         if output_hidden_states:
             all_hidden_states = all_hidden_states + (hidden_states,)
+        if taps is not None:
+            all_hidden_states = tuple(tapped_states)
 
         if not return_dict:
             return tuple(
                 v
-                for v in [hidden_states, all_hidden_states, all_self_attentions]
+                for v in [
+                    hidden_states,
+                    all_hidden_states,
+                    all_self_attentions,
+                    all_stage_hidden_states,
+                ]
                 if v is not None
             )
 
+        if all_stage_hidden_states is not None:
+            return StagedEncoderOutput(
+                last_hidden_state=hidden_states,
+                hidden_states=all_hidden_states,
+                attentions=all_self_attentions,
+                stage_hidden_states=all_stage_hidden_states,
+            )
+
         return BaseModelOutput(
             last_hidden_state=hidden_states,
             hidden_states=all_hidden_states,
@@ -275,10 +669,15 @@ class FLAVisionModel(FLAVisionPreTrainedModel):
         self.config = config
         self.embeddings = ImageEmbeddings(config, use_mask_token=use_mask_token)
         self.encoder = FLAVisionEncoder(config)
+        # the width of the last stage for hierarchical encoders
         self.layernorm = LayerNorm(
-            config.hidden_size, eps=config.layer_norm_eps, bias=True
+            self.encoder.hidden_size, eps=config.layer_norm_eps, bias=True
+        )
+        self.pooler = (
+            Pooler(config, hidden_size=self.encoder.hidden_size)
+            if add_pooling_layer
+            else None
         )
-        self.pooler = Pooler(config) if add_pooling_layer else None
         self.init_weights()
 
     def get_input_embeddings(self):
@@ -286,7 +685,7 @@ class FLAVisionModel(FLAVisionPreTrainedModel):
 
     def forward(
         self,
-        pixel_values: Optional[torch.Tensor] = None,
+        pixel_values: Optional[Union[torch.Tensor, List[torch.Tensor]]] = None,
         bool_masked_pos: Optional[torch.BoolTensor] = None,
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
@@ -294,8 +693,19 @@ class FLAVisionModel(FLAVisionPreTrainedModel):
         interpolate_pos_encoding: Optional[bool] = None,
         use_cache: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        visible_indices: Optional[torch.LongTensor] = None,
+        hidden_state_taps: Optional[List[Union[int, HiddenStateTap]]] = None,
         **kwargs,
     ) -> Union[Tuple, BaseModelOutputWithPooling]:
+        r"""
+        pixel_values (`torch.Tensor` of shape `(batch_size, num_channels, height, width)`, or a list of `(num_channels, height_i, width_i)` tensors):
+            A list of images of different sizes is packed into a single sequence of shape `(1, sum_i num_patches_i, hidden_size)`,
+            delimited by `cu_seqlens`, and every image is scanned and attended on its own. The pooled output then has one row per image.
+        hidden_state_taps (`List[Union[int, HiddenStateTap]]`, *optional*):
+            Blocks whose outputs are kept, e.g. `[3, 7, 11]` for a dense head, each optionally pooled, cast or offloaded
+            to CPU as soon as its block is done. `hidden_states` then holds one tensor per tap, in the given order,
+            instead of the input and output of every block.
+        """
         output_attentions = (
             output_attentions
             if output_attentions is not None
@@ -313,11 +723,42 @@ class FLAVisionModel(FLAVisionPreTrainedModel):
         if pixel_values is None:
             raise ValueError("You have to specify pixel_values")
 
-        hidden_states = self.embeddings(
-            pixel_values,
-            bool_masked_pos=bool_masked_pos,
-            interpolate_pos_encoding=interpolate_pos_encoding,
-        )
+        if isinstance(pixel_values, (list, tuple)):
+            # images of different sizes, packed into one sequence without padding
+            if self.config.fla_attn_type not in PACKED_FLA_ATTN_LISTS:
+                raise ValueError(
+                    f"Packed sequences are only supported with the {PACKED_FLA_ATTN_LISTS} FLA layers, "
+                    f"got fla_attn_type='{self.config.fla_attn_type}'"
+                )
+            if (
+                self.config.compress_attention
+                or self.encoder.downsamplers is not None
+                or (
+                    self.config.attn is not None
+                    and self.config.attn_type not in PACKED_ATTN_LISTS
+                )
+            ):
+                raise ValueError(
+                    f"Packed sequences are only supported with {PACKED_ATTN_LISTS} hybrid layers, no compression and no stages"
+                )
+            hidden_states, cu_seqlens = self.embeddings.forward_packed(pixel_values)
+            kwargs["cu_seqlens"] = cu_seqlens
+        else:
+            if self.encoder.downsamplers is not None:
+                if visible_indices is not None:
+                    raise ValueError(
+                        "The patch merging between stages needs the full token grid, got visible_indices"
+                    )
+                kwargs["grid_size"] = (
+                    pixel_values.shape[-2] // self.config.patch_size,
+                    pixel_values.shape[-1] // self.config.patch_size,
+                )
+            hidden_states = self.embeddings(
+                pixel_values,
+                bool_masked_pos=bool_masked_pos,
+                interpolate_pos_encoding=interpolate_pos_encoding,
+                visible_indices=visible_indices,
+            )
 
         encoder_outputs = self.encoder(
             hidden_states,
@@ -326,13 +767,16 @@ class FLAVisionModel(FLAVisionPreTrainedModel):
             past_key_values=past_key_values,
             use_cache=use_cache,
             return_dict=return_dict,
+            hidden_state_taps=hidden_state_taps,
             **kwargs,
         )
 
         sequence_output = encoder_outputs[0]
         sequence_output = self.layernorm(sequence_output)
         pooled_output = (
-            self.pooler(sequence_output) if self.pooler is not None else None
+            self.pooler(sequence_output, cu_seqlens=kwargs.get("cu_seqlens", None))
+            if self.pooler is not None
+            else None
         )
 
         if not return_dict:
@@ -343,6 +787,15 @@ class FLAVisionModel(FLAVisionPreTrainedModel):
             )
             return head_outputs + encoder_outputs[1:]
 
+        if isinstance(encoder_outputs, StagedEncoderOutput):
+            return StagedModelOutputWithPooling(
+                last_hidden_state=sequence_output,
+                pooler_output=pooled_output,
+                hidden_states=encoder_outputs.hidden_states,
+                attentions=encoder_outputs.attentions,
+                stage_hidden_states=encoder_outputs.stage_hidden_states,
+            )
+
         return BaseModelOutputWithPooling(
             last_hidden_state=sequence_output,
             pooler_output=pooled_output,
@@ -358,7 +811,19 @@ class FLAForImageClassification(FLAVisionPreTrainedModel):
         self.backbone = FLAVisionModel(
             config, add_pooling_layer=True
         )  # Here we should use mean pooling
-        self.classifier = nn.Linear(config.hidden_size, config.num_classes)
+        self.classifier = nn.Linear(
+            self.backbone.encoder.hidden_size, config.num_classes
+        )
+        self.patch_dropout = config.patch_dropout
+        if self.patch_dropout > 0 and requires_full_token_grid(config):
+            logger.warning(
+                "Patch dropout is disabled: the scans, the compression, the hybrid attention layers, "
+                "the patch merging between stages or the reversible blocks need the full token grid."
+            )
+            self.patch_dropout = 0.0
+        if config.early_exit_layers and config.stages is not None:
+            raise ValueError("Early exit is not supported with stages")
+        self.exit_heads = get_early_exit_heads(config)
         self.init_weights()
 
     def forward(
@@ -369,17 +834,66 @@ class FLAForImageClassification(FLAVisionPreTrainedModel):
         output_hidden_states: Optional[bool] = None,
         interpolate_pos_encoding: Optional[bool] = None,
         return_dict: Optional[bool] = None,
-    ) -> Union[tuple, ImageClassifierOutput]:
+        early_exit_threshold: Optional[float] = None,
+    ) -> Union[tuple, ImageClassifierOutput, EarlyExitClassifierOutput]:
+        r"""
+        early_exit_threshold (`float`, *optional*):
+            Overrides `config.early_exit_threshold`. In eval mode with exit heads, every sample whose softmax confidence
+            after an exit head reaches it stops there, and the rest of the batch is compacted for the remaining blocks.
+        """
         return_dict = (
             return_dict if return_dict is not None else self.config.use_return_dict
         )
+        early_exit_threshold = (
+            early_exit_threshold
+            if early_exit_threshold is not None
+            else self.config.early_exit_threshold
+        )
+
+        if (
+            self.exit_heads is not None
+            and not self.training
+            and early_exit_threshold is not None
+            and not isinstance(pixel_values, (list, tuple))
+        ):
+            return self._forward_early_exit(
+                pixel_values,
+                labels=labels,
+                interpolate_pos_encoding=interpolate_pos_encoding,
+                return_dict=return_dict,
+                threshold=early_exit_threshold,
+            )
+
+        # the exit heads are trained on the hidden states of their blocks
+        train_exit_heads = (
+            self.exit_heads is not None and self.training and labels is not None
+        )
+
+        visible_indices = None
+        if (
+            self.training
+            and self.patch_dropout > 0
+            and not isinstance(pixel_values, (list, tuple))
+        ):
+            # the encoder only runs on the kept patches, all of them are used in eval
+            patch_size = self.config.patch_size
+            num_patches = (pixel_values.shape[-2] // patch_size) * (
+                pixel_values.shape[-1] // patch_size
+            )
+            visible_indices = sample_patch_dropout_indices(
+                pixel_values.shape[0],
+                num_patches,
+                self.patch_dropout,
+                device=pixel_values.device,
+            )
 
         outputs = self.backbone(
             pixel_values,
             output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
+            output_hidden_states=True if train_exit_heads else output_hidden_states,
             interpolate_pos_encoding=interpolate_pos_encoding,
-            return_dict=return_dict,
+            return_dict=True,
+            visible_indices=visible_indices,
         )
 
         pooled_output = outputs.pooler_output
@@ -387,15 +901,20 @@ class FLAForImageClassification(FLAVisionPreTrainedModel):
 
         loss = None
         if labels is not None:
-            if self.num_labels == 1:
-                loss_fct = torch.nn.MSELoss()
-                loss = loss_fct(logits.squeeze(), labels.squeeze())
-            else:
-                loss_fct = torch.nn.CrossEntropyLoss()
-                loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
+            loss = classification_loss(logits, labels, self.num_labels)
+
+        if train_exit_heads:
+            # hidden_states[i + 1] is the output of block i
+            exit_loss = sum(
+                classification_loss(
+                    head(outputs.hidden_states[int(i) + 1]), labels, self.num_labels
+                )
+                for i, head in self.exit_heads.items()
+            )
+            loss = loss + exit_loss / len(self.exit_heads)
 
         if not return_dict:
-            output = (logits,) + outputs[2:]
+            output = (logits,) + outputs.to_tuple()[2:]
             return ((loss,) + output) if loss is not None else output
 
         return ImageClassifierOutput(
@@ -405,21 +924,167 @@ class FLAForImageClassification(FLAVisionPreTrainedModel):
             attentions=outputs.attentions,
         )
 
+    @torch.no_grad()
+    def _forward_early_exit(
+        self,
+        pixel_values: torch.Tensor,
+        labels: Optional[torch.Tensor] = None,
+        interpolate_pos_encoding: Optional[bool] = None,
+        return_dict: bool = True,
+        threshold: float = 1.0,
+    ) -> Union[tuple, EarlyExitClassifierOutput]:
+        # token merging is not applied on this path, the blocks run one after the other on a shrinking batch
+        backbone = self.backbone
+        hidden_states = backbone.embeddings(
+            pixel_values, interpolate_pos_encoding=interpolate_pos_encoding
+        )
+        logits, exit_layers = early_exit_forward(
+            hidden_states,
+            backbone.encoder.blocks,
+            self.exit_heads,
+            lambda x: self.classifier(backbone.pooler(backbone.layernorm(x))),
+            threshold,
+        )
 
-class FLAForMaskedImageModeling(FLAVisionPreTrainedModel):
+        loss = None
+        if labels is not None:
+            loss = classification_loss(logits, labels, self.num_labels)
+
+        if not return_dict:
+            output = (logits, exit_layers)
+            return ((loss,) + output) if loss is not None else output
+
+        return EarlyExitClassifierOutput(
+            loss=loss, logits=logits, exit_layers=exit_layers
+        )
+
+
+class FLAVisionDecoder(nn.Module):
     def __init__(self, config):
-        super().__init__(config)
-        self.backbone = FLAVisionModel(
-            config, add_pooling_layer=False, use_mask_token=True
+        super().__init__()
+
+        decoder_num_labels = config.num_channels * config.patch_size**2
+
+        # Initialize decoder-specific configuration
+        decoder_config = deepcopy(config)
+        decoder_config.hidden_size = config.decoder_hidden_size
+        decoder_config.num_hidden_layers = config.decoder_num_hidden_layers
+        decoder_config.num_heads = config.decoder_num_heads
+        decoder_config.channel_mixer_dim = config.decoder_channel_mixer_dim
+
+        self.decoder_blocks = nn.ModuleList(
+            [
+                FLAVisionBlock(decoder_config, layer_idx)
+                for layer_idx in range(decoder_config.num_hidden_layers)
+            ]
         )
-        self.decoder = nn.Sequential(
-            nn.Conv2d(
-                in_channels=config.hidden_size,
-                out_channels=config.encoder_stride**2 * config.num_channels,
-                kernel_size=1,
-            ),
-            nn.PixelShuffle(config.encoder_stride),
+
+        self.norm = LayerNorm(config.decoder_hidden_size, bias=True)
+        self.head = nn.Linear(config.decoder_hidden_size, decoder_num_labels)
+
+        self.gradient_checkpointing = False
+        self.config = config
+
+    def forward(
+        self,
+        hidden_states,
+        output_attentions=False,
+        output_hidden_states=False,
+        return_dict=True,
+        **kwargs,
+    ):
+        all_hidden_states = () if output_hidden_states else None
+        all_self_attentions = () if output_attentions else None
+
+        for i, block in enumerate(self.decoder_blocks):
+            if output_hidden_states:
+                all_hidden_states = all_hidden_states + (hidden_states,)
+
+            if self.gradient_checkpointing and self.training:
+                hidden_states, attentions, _ = self._gradient_checkpointing_func(
+                    block.__call__,
+                    hidden_states,
+                    output_attentions=output_attentions,
+                    **kwargs,
+                )
+            else:
+                hidden_states, attentions, _ = block(
+                    hidden_states,
+                    output_attentions=output_attentions,
+                    **kwargs,
+                )
+
+            if output_attentions:
+                all_self_attentions = all_self_attentions + (attentions,)
+
+        if output_hidden_states:
+            all_hidden_states = all_hidden_states + (hidden_states,)
+
+        hidden_states = self.norm(hidden_states)
+        logits = self.head(hidden_states)
+
+        if not return_dict:
+            return tuple(
+                v
+                for v in [logits, all_hidden_states, all_self_attentions]
+                if v is not None
+            )
+
+        return ImageDecoderOutput(
+            logits=logits,
+            hidden_states=all_hidden_states,
+            attentions=all_self_attentions,
         )
+
+
+class FLAForMaskedImageModeling(FLAVisionPreTrainedModel):
+    def __init__(self, config):
+        super().__init__(config)
+        if config.stages is not None:
+            raise ValueError(
+                "Masked image modeling reconstructs from the full resolution tokens, which is not supported with stages"
+            )
+        self.mim_mode = config.mim_mode
+        if self.mim_mode == "simmim":
+            self.backbone = FLAVisionModel(
+                config, add_pooling_layer=False, use_mask_token=True
+            )
+            self.decoder = nn.Sequential(
+                nn.Conv2d(
+                    in_channels=config.hidden_size,
+                    out_channels=config.encoder_stride**2 * config.num_channels,
+                    kernel_size=1,
+                ),
+                nn.PixelShuffle(config.encoder_stride),
+            )
+        elif self.mim_mode == "mae":
+            if scan_requires_full_grid(config):
+                raise ValueError(
+                    "The MAE objective drops the masked patches before the encoder, which is not supported by "
+                    f"`train_scan_type` = {config.train_scan_type} / `test_scan_type` = {config.test_scan_type}."
+                )
+            # the encoder only sees the visible patches, no mask token
+            self.backbone = FLAVisionModel(config, add_pooling_layer=False)
+            self.encoder_to_decoder = nn.Linear(
+                config.hidden_size, config.decoder_hidden_size, bias=False
+            )
+            self.mask_token = nn.Parameter(
+                torch.zeros(1, 1, config.decoder_hidden_size)
+            )
+            # fixed sin-cos embedding, built once and moved along with the model
+            self.register_buffer(
+                "position_embeddings",
+                get_sinusoid_encoding_table(
+                    self.backbone.embeddings.patch_embeddings.num_patches,
+                    config.decoder_hidden_size,
+                ),
+                persistent=False,
+            )
+            self.decoder = FLAVisionDecoder(config)
+        else:
+            raise ValueError(
+                f"Unknown mim_mode: {config.mim_mode}, expected 'simmim' or 'mae'"
+            )
         self.init_weights()
 
     def forward(
@@ -431,11 +1096,32 @@ class FLAForMaskedImageModeling(FLAVisionPreTrainedModel):
         output_hidden_states: Optional[bool] = None,
         interpolate_pos_encoding: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        visible_indices: Optional[torch.LongTensor] = None,
+        masked_indices: Optional[torch.LongTensor] = None,
     ) -> Union[tuple, MaskedImageModelingOutput]:
+        r"""
+        visible_indices (`torch.LongTensor` of shape `(batch_size, num_visible)`, *optional*):
+            Positions of the visible patches, only used by the "mae" objective. Together with `masked_indices`
+            they replace `bool_masked_pos`, without the host sync of turning a boolean mask into indices.
+        masked_indices (`torch.LongTensor` of shape `(batch_size, num_masked)`, *optional*):
+            Positions of the masked patches to reconstruct, only used by the "mae" objective.
+        """
         return_dict = (
             return_dict if return_dict is not None else self.config.use_return_dict
         )
 
+        if self.mim_mode == "mae":
+            return self._forward_mae(
+                pixel_values,
+                bool_masked_pos=bool_masked_pos,
+                visible_indices=visible_indices,
+                masked_indices=masked_indices,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                interpolate_pos_encoding=interpolate_pos_encoding,
+                return_dict=return_dict,
+            )
+
         if bool_masked_pos is not None and (
             self.config.patch_size != self.config.encoder_stride
         ):
@@ -474,8 +1160,12 @@ class FLAForMaskedImageModeling(FLAVisionPreTrainedModel):
                 .unsqueeze(1)
                 .contiguous()
             )
+            # uint8 inputs are compared in the normalized pixel space of the reconstruction
+            target_pixel_values = self.backbone.embeddings.patch_embeddings.normalize(
+                pixel_values
+            )
             reconstruction_loss = nn.functional.l1_loss(
-                pixel_values, reconstructed_pixel_values, reduction="none"
+                target_pixel_values, reconstructed_pixel_values, reduction="none"
             )
             masked_im_loss = (
                 (reconstruction_loss * mask).sum()
@@ -496,6 +1186,93 @@ class FLAForMaskedImageModeling(FLAVisionPreTrainedModel):
             attentions=outputs.attentions,
         )
 
+    def _forward_mae(
+        self,
+        pixel_values: torch.Tensor,
+        bool_masked_pos: Optional[torch.BoolTensor] = None,
+        visible_indices: Optional[torch.LongTensor] = None,
+        masked_indices: Optional[torch.LongTensor] = None,
+        output_attentions: Optional[bool] = None,
+        output_hidden_states: Optional[bool] = None,
+        interpolate_pos_encoding: Optional[bool] = None,
+        return_dict: bool = True,
+    ) -> Union[tuple, MaskedImageModelingOutput]:
+        if visible_indices is None or masked_indices is None:
+            if bool_masked_pos is None:
+                raise ValueError(
+                    "The MAE objective needs `bool_masked_pos`, or `visible_indices` and `masked_indices`."
+                )
+            # turning a boolean mask into indices needs one host sync
+            visible_indices, masked_indices = mask_to_indices(bool_masked_pos)
+
+        outputs = self.backbone(
+            pixel_values,
+            visible_indices=visible_indices,
+            output_attentions=output_attentions,
+            output_hidden_states=output_hidden_states,
+            interpolate_pos_encoding=interpolate_pos_encoding,
+            return_dict=return_dict,
+        )
+
+        sequence_output = self.encoder_to_decoder(outputs[0])
+        batch_size, _, decoder_hidden_size = sequence_output.shape
+        patch_size = self.config.patch_size
+        grid_size = (
+            pixel_values.shape[-2] // patch_size,
+            pixel_values.shape[-1] // patch_size,
+        )
+        num_patches = grid_size[0] * grid_size[1]
+
+        position_embeddings = self.position_embeddings
+        if position_embeddings.shape[1] != num_patches:
+            # other resolutions, the sin-cos table is extended instead of interpolated
+            position_embeddings = get_sinusoid_encoding_table(
+                num_patches, decoder_hidden_size
+            ).to(sequence_output.device)
+        position_embeddings = position_embeddings.type_as(sequence_output)
+
+        # put the visible tokens back in place, so that the decoder scans the full grid in order
+        hidden_states = (
+            self.mask_token.type_as(sequence_output)
+            .expand(batch_size, num_patches, -1)
+            .scatter(
+                1,
+                visible_indices.unsqueeze(-1).expand(-1, -1, decoder_hidden_size),
+                sequence_output,
+            )
+        )
+        hidden_states = hidden_states + position_embeddings
+
+        # [B, N, num_channels * patch_size * patch_size], a prediction for every patch
+        logits = self.decoder(hidden_states).logits
+
+        with torch.no_grad():
+            # uint8 inputs are compared in the normalized pixel space of the reconstruction
+            labels = get_image_patch_targets(
+                self.backbone.embeddings.patch_embeddings.normalize(pixel_values),
+                masked_indices,
+                self.config,
+            )
+
+        # the loss only covers the masked patches
+        loss_fct = torch.nn.MSELoss()
+        masked_im_loss = loss_fct(gather_tokens(logits, masked_indices), labels)
+
+        reconstructed_pixel_values = patches_to_image(
+            logits, grid_size, (patch_size, patch_size), self.config.num_channels
+        )
+
+        if not return_dict:
+            output = (reconstructed_pixel_values,) + outputs[1:]
+            return (masked_im_loss,) + output
+
+        return MaskedImageModelingOutput(
+            loss=masked_im_loss,
+            reconstruction=reconstructed_pixel_values,
+            hidden_states=outputs.hidden_states,
+            attentions=outputs.attentions,
+        )
+
 
 class FLAVideoMLP(nn.Module):
     def __init__(self, config):
@@ -548,6 +1325,59 @@ class FLAVideoBlock(nn.Module):
 
         self.num_heads = config.num_heads
 
+        self.channel_mixer_chunk_size = getattr(config, "channel_mixer_chunk_size", None)
+
+        # what the token / channel mixers and norms save for backward, see `CheckpointPolicy`
+        self.checkpoint_policy = CheckpointPolicy.from_config(
+            getattr(config, "checkpoint_policy", None)
+        )
+
+        # Mixture-of-Depths routing for the hybrid attention layers
+        self.capacity_ratio = None
+        if config.attn is not None and layer_idx in config.attn["layers"]:
+            capacity_ratio = config.attn.get("capacity_ratio", None)
+            if capacity_ratio is not None and capacity_ratio < 1.0:
+                if config.attn_type != "full_attn":
+                    raise ValueError(
+                        f"Token routing is only supported for full_attn hybrid layers, got {config.attn_type}"
+                    )
+                self.capacity_ratio = capacity_ratio
+                self.router = nn.Linear(config.hidden_size, 1, bias=False)
+
+        # factorized space-time blocks: the token mixer scans within every frame (spatial) or along time at every
+        # location (temporal), shorter sequences with a larger batch instead of the whole T*H*W clip
+        self.factorized_axis = None
+        temporal_layers = getattr(config, "temporal_layers", None)
+        if temporal_layers is not None:
+            if self.capacity_ratio is not None:
+                raise ValueError("Factorized blocks do not support token routing")
+            if "mh3d-scan" in (self.train_scan_type, self.test_scan_type):
+                raise ValueError(
+                    "mh3d-scan scans the whole clip, it cannot be used with factorized blocks"
+                )
+            if (
+                config.attn is not None
+                and layer_idx in config.attn["layers"]
+                and config.attn_type in GRID_ATTN_LISTS
+            ):
+                raise ValueError(
+                    f"{config.attn_type} folds the whole clip into a grid, it cannot be used with factorized blocks"
+                )
+            self.factorized_axis = (
+                "temporal" if layer_idx in temporal_layers else "spatial"
+            )
+            self.grid_thw = (
+                config.num_frames // config.tubelet_size,
+                config.image_size // config.patch_size,
+                config.image_size // config.patch_size,
+            )
+            if self.factorized_axis == "temporal":
+                # a sequence of T tokens has no 2D grid, the grid scans become a bidirectional scan over time
+                if self.train_scan_type in FULL_GRID_SCAN_TYPES:
+                    self.train_scan_type = "bi-scan"
+                if self.test_scan_type in FULL_GRID_SCAN_TYPES:
+                    self.test_scan_type = "bi-scan"
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -555,10 +1385,107 @@ class FLAVideoBlock(nn.Module):
         use_cache: Optional[bool] = False,
         output_attentions: bool = False,
         **kwargs: Unpack[Dict],
+    ):
+        if self.capacity_ratio is None or kwargs.get("cu_seqlens", None) is not None:
+            return self._forward(
+                hidden_states,
+                past_key_values=past_key_values,
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+                **kwargs,
+            )
+
+        # only the top-k tokens of each sample go through attention and MLP, the others skip the block,
+        # the quadratic attention then costs k^2 instead of L^2
+        indices, weights = route_top_k(
+            self.router(hidden_states).squeeze(-1), self.capacity_ratio
+        )
+        routed = gather_tokens(hidden_states, indices)
+        outputs, attentions, past_key_values = self._forward(
+            routed,
+            past_key_values=past_key_values,
+            use_cache=use_cache,
+            output_attentions=output_attentions,
+            **kwargs,
+        )
+        hidden_states = scatter_tokens(
+            hidden_states, indices, torch.lerp(routed, outputs, weights)
+        )
+        return hidden_states, attentions, past_key_values
+
+    def _forward(
+        self,
+        hidden_states: torch.Tensor,
+        past_key_values: Optional[Union[Cache, List[torch.FloatTensor]]] = None,
+        use_cache: Optional[bool] = False,
+        output_attentions: bool = False,
+        **kwargs: Unpack[Dict],
     ):
         residual = hidden_states
 
-        hidden_states = self.ln_1(hidden_states)
+        hidden_states, attentions, past_key_values = self.token_mixer_forward(
+            hidden_states,
+            past_key_values=past_key_values,
+            use_cache=use_cache,
+            output_attentions=output_attentions,
+            **kwargs,
+        )
+
+        # the residual add of the token mixer is done in one pass with ln_2
+        hidden_states, residual = self.channel_mixer_forward(hidden_states, residual)
+        hidden_states = residual + hidden_states
+
+        outputs = (hidden_states,)
+        outputs = (hidden_states, attentions, past_key_values)
+
+        return outputs
+
+    def token_mixer_forward(
+        self,
+        hidden_states: torch.Tensor,
+        past_key_values: Optional[Union[Cache, List[torch.FloatTensor]]] = None,
+        use_cache: Optional[bool] = False,
+        output_attentions: bool = False,
+        **kwargs: Unpack[Dict],
+    ):
+        """
+        The token mixing branch of the block, without its residual: norm, scan, attention and merge.
+        """
+        if self.checkpoint_policy is not None and self.training:
+            return self.checkpoint_policy.run_branch(
+                "token_mixer",
+                self.ln_1,
+                self._mix_tokens,
+                hidden_states,
+                past_key_values=past_key_values,
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+                **kwargs,
+            )
+        return self._mix_tokens(
+            self.ln_1(hidden_states),
+            past_key_values=past_key_values,
+            use_cache=use_cache,
+            output_attentions=output_attentions,
+            **kwargs,
+        )
+
+    def _mix_tokens(
+        self,
+        hidden_states: torch.Tensor,
+        past_key_values: Optional[Union[Cache, List[torch.FloatTensor]]] = None,
+        use_cache: Optional[bool] = False,
+        output_attentions: bool = False,
+        **kwargs: Unpack[Dict],
+    ):
+        if self.factorized_axis is not None:
+            if hidden_states.shape[1] != math.prod(self.grid_thw):
+                raise ValueError(
+                    f"Factorized blocks need the full {self.grid_thw} token grid, got {hidden_states.shape[1]} tokens"
+                )
+            hidden_states = fold_video_tokens(
+                hidden_states, self.grid_thw, self.factorized_axis
+            )
 
         hidden_states = prepare_hidden_states_for_scan(
             hidden_states,
@@ -585,18 +1512,48 @@ class FLAVideoBlock(nn.Module):
             layer_idx=self.layer_idx,
         )
 
-        hidden_states = residual + hidden_states
-        residual = hidden_states
-
-        hidden_states = self.ln_2(hidden_states)
-
-        hidden_states = self.channel_mixer(hidden_states)
-        hidden_states = residual + hidden_states
-
-        outputs = (hidden_states,)
-        outputs = (hidden_states, attentions, past_key_values)
+        if self.factorized_axis is not None:
+            hidden_states = unfold_video_tokens(
+                hidden_states, self.grid_thw, self.factorized_axis
+            )
 
-        return outputs
+        return hidden_states, attentions, past_key_values
+
+    def channel_mixer_forward(
+        self, hidden_states: torch.Tensor, residual: Optional[torch.Tensor] = None
+    ) -> Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        The channel mixing branch of the block, without its residual.
+        With `residual`, ln_2 is applied to `residual + hidden_states` in one pass (see `add_norm`),
+        and the sum, the residual of the branch, is returned too.
+        """
+        channel_mixer = self.channel_mixer
+        if self.channel_mixer_chunk_size is not None:
+            # the 4x wider intermediate only exists for one slice of tokens at a time
+            channel_mixer = functools.partial(
+                sequence_chunked_forward,
+                self.channel_mixer,
+                chunk_size=self.channel_mixer_chunk_size,
+            )
+        if self.checkpoint_policy is not None and self.training:
+            # the policy applies around the chunked channel mixer
+            return self.checkpoint_policy.run_branch(
+                "channel_mixer",
+                self.ln_2,
+                channel_mixer,
+                hidden_states,
+                residual=residual,
+            )
+        if residual is None:
+            if self.channel_mixer_chunk_size is not None:
+                return sequence_chunked_forward(
+                    lambda x: self.channel_mixer(self.ln_2(x)),
+                    hidden_states,
+                    self.channel_mixer_chunk_size,
+                )
+            return self.channel_mixer(self.ln_2(hidden_states))
+        hidden_states, residual = add_norm(self.ln_2, hidden_states, residual)
+        return channel_mixer(hidden_states), residual
 
 
 class FLAVideoEncoder(nn.Module):
@@ -609,8 +1566,22 @@ class FLAVideoEncoder(nn.Module):
                 for layer_idx in range(config.num_hidden_layers)
             ]
         )
+        self.reversible = getattr(config, "reversible", False)
+        if self.reversible:
+            if any(block.capacity_ratio is not None for block in self.blocks):
+                raise ValueError("Reversible blocks do not support token routing")
         self.gradient_checkpointing = False
 
+    def set_checkpoint_policy(
+        self, policy: Optional[Union[CheckpointPolicy, Dict[str, str]]]
+    ) -> None:
+        """
+        Choose what every block saves for backward, e.g. `{"token_mixer": "recompute", "norms": "recompute"}`.
+        """
+        policy = CheckpointPolicy.from_config(policy)
+        for block in self.blocks:
+            block.checkpoint_policy = policy
+
     def forward(
         self,
         hidden_states,
@@ -619,11 +1590,41 @@ class FLAVideoEncoder(nn.Module):
         past_key_values: Optional[Union[Cache, List[torch.FloatTensor]]] = None,
         use_cache: Optional[bool] = None,
         return_dict=True,
+        hidden_state_taps: Optional[List[Union[int, HiddenStateTap]]] = None,
         **kwargs,
     ):
+        taps = get_hidden_state_taps(hidden_state_taps, len(self.blocks))
+        if taps is not None:
+            # the taps replace the hidden states of every block
+            output_hidden_states = False
+            tapped_states = [None] * len(taps)
         all_hidden_states = () if output_hidden_states else None
         all_self_attentions = () if output_attentions else None
 
+        if self.reversible:
+            # the activations are reconstructed in backward, gradient checkpointing is not needed
+            hidden_states, all_hidden_states, all_self_attentions = (
+                reversible_forward(
+                    self.blocks,
+                    hidden_states,
+                    output_attentions=output_attentions,
+                    output_hidden_states=output_hidden_states,
+                    hidden_state_taps=taps,
+                    **kwargs,
+                )
+            )
+            if not return_dict:
+                return tuple(
+                    v
+                    for v in [hidden_states, all_hidden_states, all_self_attentions]
+                    if v is not None
+                )
+            return BaseModelOutput(
+                last_hidden_state=hidden_states,
+                hidden_states=all_hidden_states,
+                attentions=all_self_attentions,
+            )
+
         for i, block in enumerate(self.blocks):
             if output_hidden_states:
                 all_hidden_states = all_hidden_states + (hidden_states,)
@@ -649,8 +1650,15 @@ class FLAVideoEncoder(nn.Module):
             if output_attentions:
                 all_self_attentions = all_self_attentions + (attentions,)
 
+            if taps is not None:
+                for j, tap in enumerate(taps):
+                    if tap.layer == i:
+                        tapped_states[j] = tap(hidden_states)
+
         if output_hidden_states:
             all_hidden_states = all_hidden_states + (hidden_states,)
+        if taps is not None:
+            all_hidden_states = tuple(tapped_states)
 
         if not return_dict:
             return tuple(
@@ -702,14 +1710,21 @@ class FLAVideoModel(FLAVideoPreTrainedModel):
         self,
         pixel_values,
         bool_masked_pos=None,
+        visible_indices=None,
         output_attentions=None,
         output_hidden_states=None,
         past_key_values: Optional[Union[Cache, List[torch.FloatTensor]]] = None,
         interpolate_pos_encoding: Optional[bool] = None,
         use_cache: Optional[bool] = None,
         return_dict=None,
+        hidden_state_taps: Optional[List[Union[int, HiddenStateTap]]] = None,
         **kwargs,
     ):
+        r"""
+        hidden_state_taps (`List[Union[int, HiddenStateTap]]`, *optional*):
+            Blocks whose outputs are kept, each optionally pooled, cast or offloaded to CPU as soon as its block is done.
+            `hidden_states` then holds one tensor per tap, in the given order, instead of the input and output of every block.
+        """
         output_attentions = (
             output_attentions
             if output_attentions is not None
@@ -724,7 +1739,9 @@ class FLAVideoModel(FLAVideoPreTrainedModel):
             return_dict if return_dict is not None else self.config.use_return_dict
         )
 
-        embedding_output = self.embeddings(pixel_values, bool_masked_pos)
+        embedding_output = self.embeddings(
+            pixel_values, bool_masked_pos, visible_indices=visible_indices
+        )
 
         encoder_outputs = self.encoder(
             embedding_output,
@@ -733,6 +1750,7 @@ class FLAVideoModel(FLAVideoPreTrainedModel):
             return_dict=return_dict,
             past_key_values=past_key_values,
             use_cache=use_cache,
+            hidden_state_taps=hidden_state_taps,
             **kwargs,
         )
 
@@ -766,6 +1784,8 @@ class FLAVideoDecoder(nn.Module):
         decoder_config.num_hidden_layers = config.decoder_num_hidden_layers
         decoder_config.num_heads = config.decoder_num_heads
         decoder_config.channel_mixer_dim = config.decoder_channel_mixer_dim
+        # the decoder tokens are in [visible, masked] order, not on the clip grid
+        decoder_config.temporal_layers = None
 
         self.decoder_blocks = nn.ModuleList(
             [
@@ -849,6 +1869,10 @@ class FLAVideoDecoder(nn.Module):
 class FLAForVideoPreTraining(FLAVideoPreTrainedModel):
     def __init__(self, config):
         super().__init__(config)
+        if getattr(config, "temporal_layers", None) is not None:
+            raise ValueError(
+                "Factorized blocks need the full token grid, the pre-training encoder only gets the visible tokens"
+            )
         self.config = config
         self.backbone = FLAVideoModel(config)
 
@@ -856,8 +1880,13 @@ class FLAForVideoPreTraining(FLAVideoPreTrainedModel):
             config.hidden_size, config.decoder_hidden_size, bias=False
         )
         self.mask_token = nn.Parameter(torch.zeros(1, 1, config.decoder_hidden_size))
-        self.position_embeddings = get_sinusoid_encoding_table(
-            self.backbone.embeddings.num_patches, config.decoder_hidden_size
+        # fixed sin-cos embedding, built once and moved along with the model
+        self.register_buffer(
+            "position_embeddings",
+            get_sinusoid_encoding_table(
+                self.backbone.embeddings.num_patches, config.decoder_hidden_size
+            ),
+            persistent=False,
         )
 
         self.decoder = FLAVideoDecoder(
@@ -869,18 +1898,39 @@ class FLAForVideoPreTraining(FLAVideoPreTrainedModel):
     def forward(
         self,
         pixel_values: torch.FloatTensor,
-        bool_masked_pos: torch.BoolTensor,
+        bool_masked_pos: Optional[torch.BoolTensor] = None,
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        visible_indices: Optional[torch.LongTensor] = None,
+        masked_indices: Optional[torch.LongTensor] = None,
+        decoder_indices: Optional[torch.LongTensor] = None,
     ) -> Union[tuple, VideoForPreTrainingOutput]:
+        r"""
+        visible_indices (`torch.LongTensor` of shape `(batch_size, num_visible)`, *optional*):
+            Positions of the visible tubelets, e.g. from `sample_video_mask_indices`. Together with `masked_indices`
+            they replace `bool_masked_pos`, and the whole step runs with gathers only, without host syncs.
+        masked_indices (`torch.LongTensor` of shape `(batch_size, num_masked)`, *optional*):
+            Positions of the masked tubelets to reconstruct.
+        decoder_indices (`torch.LongTensor` of shape `(batch_size, num_decoded)`, *optional*):
+            Subset of the masked positions that the decoder reconstructs (decoder masking, as in VideoMAE v2).
+            In training, defaults to a random `1 - config.decoder_mask_ratio` fraction of the masked tubelets.
+        """
         return_dict = (
             return_dict if return_dict is not None else self.config.use_return_dict
         )
 
+        if visible_indices is None or masked_indices is None:
+            if bool_masked_pos is None:
+                raise ValueError(
+                    "The MAE objective needs `bool_masked_pos`, or `visible_indices` and `masked_indices`."
+                )
+            # turning a boolean mask into indices needs one host sync
+            visible_indices, masked_indices = mask_to_indices(bool_masked_pos)
+
         outputs = self.backbone(
             pixel_values,
-            bool_masked_pos=bool_masked_pos,
+            visible_indices=visible_indices,
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
@@ -889,21 +1939,15 @@ class FLAForVideoPreTraining(FLAVideoPreTrainedModel):
         sequence_output = outputs[0]
         sequence_output = self.encoder_to_decoder(sequence_output)
 
-        batch_size, seq_len, num_channels = sequence_output.shape
+        if decoder_indices is None:
+            decoder_indices = sample_decoder_indices(
+                masked_indices,
+                self.config.decoder_mask_ratio if self.training else 0.0,
+            )
 
-        expanded_position_embeddings = self.position_embeddings.expand(
-            batch_size, -1, -1
-        ).type_as(pixel_values)
-        expanded_position_embeddings = (
-            expanded_position_embeddings.to(pixel_values.device).clone().detach()
-        )
-
-        pos_emb_visible = expanded_position_embeddings[~bool_masked_pos].reshape(
-            batch_size, -1, num_channels
-        )
-        pos_emb_mask = expanded_position_embeddings[bool_masked_pos].reshape(
-            batch_size, -1, num_channels
-        )
+        position_embeddings = self.position_embeddings.type_as(sequence_output)
+        pos_emb_visible = gather_tokens(position_embeddings, visible_indices)
+        pos_emb_mask = gather_tokens(position_embeddings, decoder_indices)
 
         x_full = torch.cat(
             [sequence_output + pos_emb_visible, self.mask_token + pos_emb_mask], dim=1
@@ -913,84 +1957,9 @@ class FLAForVideoPreTraining(FLAVideoPreTrainedModel):
         logits = decoder_outputs.logits
 
         loss = None
-        # below taken from https://github.com/huggingface/transformers/blob/main/src/transformers/models/videomae/modeling_videomae.py#L730
         with torch.no_grad():
-            # calculate the labels to be predicted
-            if self.config.num_channels != 3:
-                # Can't unnormalize with default means/stds
-                frames = pixel_values
-            else:
-                # first, unnormalize the frames
-                device = pixel_values.device
-                dtype = pixel_values.dtype
-                mean = torch.as_tensor(IMAGENET_DEFAULT_MEAN).to(
-                    device=device, dtype=dtype
-                )[None, None, :, None, None]
-                std = torch.as_tensor(IMAGENET_DEFAULT_STD).to(
-                    device=device, dtype=dtype
-                )[None, None, :, None, None]
-                frames = pixel_values * std + mean  # in [0, 1]
-
-            batch_size, time, num_channels, height, width = frames.shape
-            tubelet_size, patch_size = self.config.tubelet_size, self.config.patch_size
-            if self.config.norm_pix_loss:
-                # step 1: split up dimensions (time by tubelet_size, height by patch_size, width by patch_size)
-                frames = frames.view(
-                    batch_size,
-                    time // tubelet_size,
-                    tubelet_size,
-                    num_channels,
-                    height // patch_size,
-                    patch_size,
-                    width // patch_size,
-                    patch_size,
-                )
-                # step 2: move dimensions to concatenate:
-                frames = frames.permute(0, 1, 4, 6, 2, 5, 7, 3).contiguous()
-                # step 3: concatenate:
-                frames = frames.view(
-                    batch_size,
-                    time // tubelet_size * height // patch_size * width // patch_size,
-                    tubelet_size * patch_size * patch_size,
-                    num_channels,
-                )
-                # step 4: normalize. The authors find that the mean is about 0.48 and standard deviation is about 0.08.
-                frames_norm = (frames - frames.mean(dim=-2, keepdim=True)) / (
-                    frames.var(dim=-2, unbiased=True, keepdim=True).sqrt() + 1e-6
-                )
-                # step 5: reshape to (batch_size, T//ts * H//ps * W//ps, ts * ps * ps * C)
-                videos_patch = frames_norm.view(
-                    batch_size,
-                    time // tubelet_size * height // patch_size * width // patch_size,
-                    tubelet_size * patch_size * patch_size * num_channels,
-                )
-            else:
-                if self.config.num_channels != 3:
-                    raise ValueError(
-                        "Can't unnormalize non-RGB images. Consider setting config.norm_pix_loss to False."
-                    )
-                # step 1: split up dimensions (time by tubelet_size, height by patch_size, width by patch_size)
-                frames = frames.view(
-                    batch_size,
-                    time // tubelet_size,
-                    tubelet_size,
-                    num_channels,
-                    height // patch_size,
-                    patch_size,
-                    width // patch_size,
-                    patch_size,
-                )
-                # step 2: move dimensions to concatenate: (batch_size, T//ts, H//ps, W//ps, ts, ps, ps, C)
-                frames = frames.permute(0, 1, 4, 6, 2, 5, 7, 3).contiguous()
-                # step 3: concatenate
-                videos_patch = frames.view(
-                    batch_size,
-                    time // tubelet_size * height // patch_size * width // patch_size,
-                    tubelet_size * patch_size * patch_size * num_channels,
-                )
-
-            batch_size, _, num_channels = videos_patch.shape
-            labels = videos_patch[bool_masked_pos].reshape(batch_size, -1, num_channels)
+            # calculate the labels to be predicted, only for the decoded tubelets
+            labels = get_video_patch_targets(pixel_values, decoder_indices, self.config)
 
         loss_fct = torch.nn.MSELoss()
         loss = loss_fct(logits, labels)
@@ -1020,6 +1989,7 @@ class FLAForVideoClassification(FLAVideoPreTrainedModel):
             if config.num_classes > 0
             else nn.Identity()
         )
+        self.exit_heads = get_early_exit_heads(config)
 
         self.post_init()
 
@@ -1030,16 +2000,44 @@ class FLAForVideoClassification(FLAVideoPreTrainedModel):
         output_attentions=None,
         output_hidden_states=None,
         return_dict=None,
+        early_exit_threshold: Optional[float] = None,
     ):
+        r"""
+        early_exit_threshold (`float`, *optional*):
+            Overrides `config.early_exit_threshold`. In eval mode with exit heads, every sample whose softmax confidence
+            after an exit head reaches it stops there, and the rest of the batch is compacted for the remaining blocks.
+        """
         return_dict = (
             return_dict if return_dict is not None else self.config.use_return_dict
         )
+        early_exit_threshold = (
+            early_exit_threshold
+            if early_exit_threshold is not None
+            else self.config.early_exit_threshold
+        )
+
+        if (
+            self.exit_heads is not None
+            and not self.training
+            and early_exit_threshold is not None
+        ):
+            return self._forward_early_exit(
+                pixel_values,
+                labels=labels,
+                return_dict=return_dict,
+                threshold=early_exit_threshold,
+            )
+
+        # the exit heads are trained on the hidden states of their blocks
+        train_exit_heads = (
+            self.exit_heads is not None and self.training and labels is not None
+        )
 
         outputs = self.backbone(
             pixel_values,
             output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
+            output_hidden_states=True if train_exit_heads else output_hidden_states,
+            return_dict=True,
         )
 
         pooled_output = outputs.pooler_output
@@ -1047,11 +2045,20 @@ class FLAForVideoClassification(FLAVideoPreTrainedModel):
 
         loss = None
         if labels is not None:
-            loss_fct = torch.nn.CrossEntropyLoss()
-            loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
+            loss = classification_loss(logits, labels, self.num_labels)
+
+        if train_exit_heads:
+            # hidden_states[i + 1] is the output of block i
+            exit_loss = sum(
+                classification_loss(
+                    head(outputs.hidden_states[int(i) + 1]), labels, self.num_labels
+                )
+                for i, head in self.exit_heads.items()
+            )
+            loss = loss + exit_loss / len(self.exit_heads)
 
         if not return_dict:
-            output = (logits,) + outputs[2:]
+            output = (logits,) + outputs.to_tuple()[2:]
             return ((loss,) + output) if loss is not None else output
 
         return ImageClassifierOutput(
@@ -1060,3 +2067,33 @@ class FLAForVideoClassification(FLAVideoPreTrainedModel):
             hidden_states=outputs.hidden_states,
             attentions=outputs.attentions,
         )
+
+    @torch.no_grad()
+    def _forward_early_exit(
+        self,
+        pixel_values: torch.Tensor,
+        labels: Optional[torch.Tensor] = None,
+        return_dict: bool = True,
+        threshold: float = 1.0,
+    ) -> Union[tuple, EarlyExitClassifierOutput]:
+        backbone = self.backbone
+        hidden_states = backbone.embeddings(pixel_values, None)
+        logits, exit_layers = early_exit_forward(
+            hidden_states,
+            backbone.encoder.blocks,
+            self.exit_heads,
+            lambda x: self.classifier(backbone.pooler(backbone.layernorm(x))),
+            threshold,
+        )
+
+        loss = None
+        if labels is not None:
+            loss = classification_loss(logits, labels, self.num_labels)
+
+        if not return_dict:
+            output = (logits, exit_layers)
+            return ((loss,) + output) if loss is not None else output
+
+        return EarlyExitClassifierOutput(
+            loss=loss, logits=logits, exit_layers=exit_layers
+        )
@@ -37,6 +37,7 @@ class BitNetVisionConfig(PretrainedConfig):
         num_classes: int = 1000,
         qkv_bias: bool = True,
         hidden_dropout_prob: float = 0.0,
+        patch_dropout: float = 0.0,  # fraction of the patches dropped per sample in classification training
         use_mask_token: bool = False,
         layer_norm_eps: float = 1e-6,
         interpolate_pos_encoding: bool = False,
@@ -44,6 +45,14 @@ class BitNetVisionConfig(PretrainedConfig):
         encoder_stride=16,
         train_scan_type: str = "uni-scan",  # scaning type, "uni-scan" or "bi-scan" or "cross-scan", default to "uni-scan"
         test_scan_type: str = None,  # scaning type, "uni-scan" or "bi-scan" or "cross-scan", default to "uni-scan"
+        # masked image modeling objective, "simmim" or "mae"
+        mim_mode: str = "simmim",
+        norm_pix_loss: bool = False,
+        # decoder specific parameters, only used by the "mae" objective
+        decoder_num_heads: int = 6,
+        decoder_hidden_size: int = 256,
+        decoder_num_hidden_layers: int = 4,
+        decoder_channel_mixer_dim: int = None,
         **kwargs,
     ):
         # Initialize BitNet core parameters
@@ -75,6 +84,7 @@ class BitNetVisionConfig(PretrainedConfig):
         self.num_classes = num_classes
         self.qkv_bias = qkv_bias
         self.hidden_dropout_prob = hidden_dropout_prob
+        self.patch_dropout = patch_dropout
         self.use_mask_token = use_mask_token
         self.layer_norm_eps = layer_norm_eps
         self.interpolate_pos_encoding = interpolate_pos_encoding
@@ -85,6 +95,13 @@ class BitNetVisionConfig(PretrainedConfig):
         else:
             self.test_scan_type = test_scan_type
         self.encoder_stride = encoder_stride
+        self.mim_mode = mim_mode
+        self.norm_pix_loss = norm_pix_loss
+
+        # Initialize decoder specific parameters
+        self.decoder_num_heads = decoder_num_heads
+        self.decoder_hidden_size = decoder_hidden_size
+        self.decoder_num_hidden_layers = decoder_num_hidden_layers
 
         if attn is not None:
             if not isinstance(attn, Dict):
@@ -109,6 +126,11 @@ class BitNetVisionConfig(PretrainedConfig):
         else:
             self.channel_mixer_dim = channel_mixer_dim
 
+        if decoder_channel_mixer_dim is None:
+            self.decoder_channel_mixer_dim = 4 * decoder_hidden_size
+        else:
+            self.decoder_channel_mixer_dim = decoder_channel_mixer_dim  # default value set to 4 * decoder_hidden_size
+
         super().__init__(**kwargs)
 
 
@@ -151,6 +173,7 @@ class BitNetVideoConfig(PretrainedConfig):
         train_scan_type: str = "uni-scan",  # scaning type, "uni-scan" or "bi-scan" or "cross-scan", default to "uni-scan"
         test_scan_type: str = None,  # scaning type, "uni-scan" or "bi-scan" or "cross-scan", default to "uni-scan"
         norm_pix_loss: bool = True,
+        decoder_mask_ratio: float = 0.0,
         num_frames: int = 16,
         tubelet_size: int = 2,
         # decoder specific parameters
@@ -197,6 +220,7 @@ class BitNetVideoConfig(PretrainedConfig):
             self.test_scan_type = train_scan_type
         self.encoder_stride = encoder_stride
         self.norm_pix_loss = norm_pix_loss
+        self.decoder_mask_ratio = decoder_mask_ratio
         self.num_frames = num_frames
         self.tubelet_size = tubelet_size
 
@@ -44,6 +44,7 @@ class DeltaNetVisionConfig(PretrainedConfig):
         num_channels: int = 3,
         num_classes: int = 1000,
         hidden_dropout_prob: float = 0.0,
+        patch_dropout: float = 0.0,  # fraction of the patches dropped per sample in classification training
         use_mask_token: bool = False,
         layer_norm_eps: float = 1e-6,
         interpolate_pos_encoding: bool = False,
@@ -51,6 +52,14 @@ class DeltaNetVisionConfig(PretrainedConfig):
         channel_mixer_dim: int = None,
         train_scan_type: str = "uni-scan",  # scaning type, "uni-scan" or "bi-scan" or "cross-scan", default to "uni-scan"
         test_scan_type: str = None,  # scaning type, "uni-scan" or "bi-scan" or "cross-scan", default to "uni-scan"
+        # masked image modeling objective, "simmim" or "mae"
+        mim_mode: str = "simmim",
+        norm_pix_loss: bool = False,
+        # decoder specific parameters, only used by the "mae" objective
+        decoder_num_heads: int = 6,
+        decoder_hidden_size: int = 256,
+        decoder_num_hidden_layers: int = 4,
+        decoder_channel_mixer_dim: int = None,
         **kwargs,
     ):
         # Initialize DeltaNet core parameters
@@ -87,6 +96,7 @@ class DeltaNetVisionConfig(PretrainedConfig):
         self.num_channels = num_channels
         self.num_classes = num_classes
         self.hidden_dropout_prob = hidden_dropout_prob
+        self.patch_dropout = patch_dropout
         self.use_mask_token = use_mask_token
         self.layer_norm_eps = layer_norm_eps
         self.interpolate_pos_encoding = interpolate_pos_encoding
@@ -97,6 +107,13 @@ class DeltaNetVisionConfig(PretrainedConfig):
         else:
             self.test_scan_type = test_scan_type
         self.encoder_stride = encoder_stride
+        self.mim_mode = mim_mode
+        self.norm_pix_loss = norm_pix_loss
+
+        # Initialize decoder specific parameters
+        self.decoder_num_heads = decoder_num_heads
+        self.decoder_hidden_size = decoder_hidden_size
+        self.decoder_num_hidden_layers = decoder_num_hidden_layers
 
         if attn is not None:
             if not isinstance(attn, Dict):
@@ -122,6 +139,11 @@ class DeltaNetVisionConfig(PretrainedConfig):
         else:
             self.channel_mixer_dim = channel_mixer_dim
 
+        if decoder_channel_mixer_dim is None:
+            self.decoder_channel_mixer_dim = 4 * decoder_hidden_size
+        else:
+            self.decoder_channel_mixer_dim = decoder_channel_mixer_dim  # default value set to 4 * decoder_hidden_size
+
         super().__init__(**kwargs)
 
 
@@ -172,6 +194,7 @@ class DeltaNetVideoConfig(PretrainedConfig):
         train_scan_type: str = "uni-scan",  # scaning type, "uni-scan" or "bi-scan" or "cross-scan", default to "uni-scan"
         test_scan_type: str = None,  # scaning type, "uni-scan" or "bi-scan" or "cross-scan", default to "uni-scan"
         norm_pix_loss: bool = True,
+        decoder_mask_ratio: float = 0.0,
         num_frames: int = 16,
         tubelet_size: int = 2,
         t_dim: int = 32,
@@ -229,6 +252,7 @@ class DeltaNetVideoConfig(PretrainedConfig):
             self.test_scan_type = test_scan_type
         self.encoder_stride = encoder_stride
         self.norm_pix_loss = norm_pix_loss
+        self.decoder_mask_ratio = decoder_mask_ratio
         self.num_frames = num_frames
         self.tubelet_size = tubelet_size
         self.t_dim = t_dim
@@ -28,18 +28,31 @@ from fla.modules import FusedCrossEntropyLoss, FusedLinearCrossEntropyLoss, RMSN
 from fla.modules.activations import swiglu_linear
 from fla.modules.layernorm import rms_norm_linear
 from flazoo.models.utils import (
+    add_norm,
     prepare_hidden_states_for_scan,
     prepare_hidden_states_for_merge,
+    gather_tokens,
+    mask_to_indices,
+    sample_decoder_indices,
+    scan_requires_full_grid,
+    sample_patch_dropout_indices,
+)
+from ..utils import (
+    ImageEmbeddings,
+    Pooler,
+    ImageDecoderOutput,
+    get_image_patch_targets,
+    patches_to_image,
+    requires_full_token_grid,
 )
-from ..utils import ImageEmbeddings, Pooler
 
 if TYPE_CHECKING:
     from transformers.processing_utils import Unpack
 
 from .configuration_gated_deltanet import GatedDeltaNetVideoConfig
-from transformers.utils.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 from ..utils import (
     VideoEmbeddings,
+    get_video_patch_targets,
     VideoDecoderOutput,
     VideoForPreTrainingOutput,
     get_sinusoid_encoding_table,
@@ -140,13 +153,12 @@ class GatedDeltaNetVisionBlock(nn.Module):
             layer_idx=self.layer_idx,
         )
 
-        # First residual connection
-        hidden_states = residual + hidden_states
-        residual = hidden_states
-
-        # Pre-normalization for MLP if enabled
+        # First residual connection, fused with the pre-normalization for MLP if enabled
         if hasattr(self, "ln_2"):
-            hidden_states = self.ln_2(hidden_states)
+            hidden_states, residual = add_norm(self.ln_2, hidden_states, residual)
+        else:
+            hidden_states = residual + hidden_states
+            residual = hidden_states
 
         hidden_states = self.channel_mixer(hidden_states)
 
@@ -273,6 +285,7 @@ class GatedDeltaNetVisionModel(GatedDeltaNetVisionPreTrainedModel):
         interpolate_pos_encoding: Optional[bool] = None,
         use_cache: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        visible_indices: Optional[torch.LongTensor] = None,
         **kwargs,
     ) -> Union[Tuple, BaseModelOutputWithPooling]:
         output_attentions = (
@@ -296,6 +309,7 @@ class GatedDeltaNetVisionModel(GatedDeltaNetVisionPreTrainedModel):
             pixel_values,
             bool_masked_pos=bool_masked_pos,
             interpolate_pos_encoding=interpolate_pos_encoding,
+            visible_indices=visible_indices,
         )
 
         encoder_outputs = self.encoder(
@@ -338,6 +352,13 @@ class GatedDeltaNetForImageClassification(GatedDeltaNetVisionPreTrainedModel):
             config, add_pooling_layer=True
         )  # Here we should use mean pooling
         self.classifier = nn.Linear(config.hidden_size, config.num_classes)
+        self.patch_dropout = config.patch_dropout
+        if self.patch_dropout > 0 and requires_full_token_grid(config):
+            logger.warning(
+                "Patch dropout is disabled: the scans, the compression or the hybrid attention layers "
+                "need the full token grid."
+            )
+            self.patch_dropout = 0.0
         self.init_weights()
 
     def forward(
@@ -353,12 +374,27 @@ class GatedDeltaNetForImageClassification(GatedDeltaNetVisionPreTrainedModel):
             return_dict if return_dict is not None else self.config.use_return_dict
         )
 
+        visible_indices = None
+        if self.training and self.patch_dropout > 0:
+            # the encoder only runs on the kept patches, all of them are used in eval
+            patch_size = self.config.patch_size
+            num_patches = (pixel_values.shape[-2] // patch_size) * (
+                pixel_values.shape[-1] // patch_size
+            )
+            visible_indices = sample_patch_dropout_indices(
+                pixel_values.shape[0],
+                num_patches,
+                self.patch_dropout,
+                device=pixel_values.device,
+            )
+
         outputs = self.backbone(
             pixel_values,
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             interpolate_pos_encoding=interpolate_pos_encoding,
             return_dict=return_dict,
+            visible_indices=visible_indices,
         )
 
         pooled_output = outputs.pooler_output
@@ -385,20 +421,128 @@ class GatedDeltaNetForImageClassification(GatedDeltaNetVisionPreTrainedModel):
         )
 
 
-class GatedDeltaNetForMaskedImageModeling(GatedDeltaNetVisionPreTrainedModel):
+class GatedDeltaNetVisionDecoder(nn.Module):
     def __init__(self, config):
-        super().__init__(config)
-        self.backbone = GatedDeltaNetVisionModel(
-            config, add_pooling_layer=False, use_mask_token=True
+        super().__init__()
+
+        decoder_num_labels = config.num_channels * config.patch_size**2
+
+        # Initialize decoder-specific configuration
+        decoder_config = deepcopy(config)
+        decoder_config.hidden_size = config.decoder_hidden_size
+        decoder_config.num_hidden_layers = config.decoder_num_hidden_layers
+        decoder_config.num_heads = config.decoder_num_heads
+        decoder_config.channel_mixer_dim = config.decoder_channel_mixer_dim
+
+        self.decoder_blocks = nn.ModuleList(
+            [
+                GatedDeltaNetVisionBlock(decoder_config, layer_idx)
+                for layer_idx in range(decoder_config.num_hidden_layers)
+            ]
         )
-        self.decoder = nn.Sequential(
-            nn.Conv2d(
-                in_channels=config.hidden_size,
-                out_channels=config.encoder_stride**2 * config.num_channels,
-                kernel_size=1,
-            ),
-            nn.PixelShuffle(config.encoder_stride),
+
+        self.norm = nn.LayerNorm(config.decoder_hidden_size)
+        self.head = nn.Linear(config.decoder_hidden_size, decoder_num_labels)
+
+        self.gradient_checkpointing = False
+        self.config = config
+
+    def forward(
+        self,
+        hidden_states,
+        output_attentions=False,
+        output_hidden_states=False,
+        return_dict=True,
+        **kwargs,
+    ):
+        all_hidden_states = () if output_hidden_states else None
+        all_self_attentions = () if output_attentions else None
+
+        for i, block in enumerate(self.decoder_blocks):
+            if output_hidden_states:
+                all_hidden_states = all_hidden_states + (hidden_states,)
+
+            if self.gradient_checkpointing and self.training:
+                hidden_states, attentions, _ = self._gradient_checkpointing_func(
+                    block.__call__,
+                    hidden_states,
+                    output_attentions=output_attentions,
+                    **kwargs,
+                )
+            else:
+                hidden_states, attentions, _ = block(
+                    hidden_states,
+                    output_attentions=output_attentions,
+                    **kwargs,
+                )
+
+            if output_attentions:
+                all_self_attentions = all_self_attentions + (attentions,)
+
+        if output_hidden_states:
+            all_hidden_states = all_hidden_states + (hidden_states,)
+
+        hidden_states = self.norm(hidden_states)
+        logits = self.head(hidden_states)
+
+        if not return_dict:
+            return tuple(
+                v
+                for v in [logits, all_hidden_states, all_self_attentions]
+                if v is not None
+            )
+
+        return ImageDecoderOutput(
+            logits=logits,
+            hidden_states=all_hidden_states,
+            attentions=all_self_attentions,
         )
+
+
+class GatedDeltaNetForMaskedImageModeling(GatedDeltaNetVisionPreTrainedModel):
+    def __init__(self, config):
+        super().__init__(config)
+        self.mim_mode = config.mim_mode
+        if self.mim_mode == "simmim":
+            self.backbone = GatedDeltaNetVisionModel(
+                config, add_pooling_layer=False, use_mask_token=True
+            )
+            self.decoder = nn.Sequential(
+                nn.Conv2d(
+                    in_channels=config.hidden_size,
+                    out_channels=config.encoder_stride**2 * config.num_channels,
+                    kernel_size=1,
+                ),
+                nn.PixelShuffle(config.encoder_stride),
+            )
+        elif self.mim_mode == "mae":
+            if scan_requires_full_grid(config):
+                raise ValueError(
+                    "The MAE objective drops the masked patches before the encoder, which is not supported by "
+                    f"`train_scan_type` = {config.train_scan_type} / `test_scan_type` = {config.test_scan_type}."
+                )
+            # the encoder only sees the visible patches, no mask token
+            self.backbone = GatedDeltaNetVisionModel(config, add_pooling_layer=False)
+            self.encoder_to_decoder = nn.Linear(
+                config.hidden_size, config.decoder_hidden_size, bias=False
+            )
+            self.mask_token = nn.Parameter(
+                torch.zeros(1, 1, config.decoder_hidden_size)
+            )
+            # fixed sin-cos embedding, built once and moved along with the model
+            self.register_buffer(
+                "position_embeddings",
+                get_sinusoid_encoding_table(
+                    self.backbone.embeddings.patch_embeddings.num_patches,
+                    config.decoder_hidden_size,
+                ),
+                persistent=False,
+            )
+            self.decoder = GatedDeltaNetVisionDecoder(config)
+        else:
+            raise ValueError(
+                f"Unknown mim_mode: {config.mim_mode}, expected 'simmim' or 'mae'"
+            )
         self.init_weights()
 
     def forward(
@@ -410,11 +554,32 @@ class GatedDeltaNetForMaskedImageModeling(GatedDeltaNetVisionPreTrainedModel):
         output_hidden_states: Optional[bool] = None,
         interpolate_pos_encoding: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        visible_indices: Optional[torch.LongTensor] = None,
+        masked_indices: Optional[torch.LongTensor] = None,
     ) -> Union[tuple, MaskedImageModelingOutput]:
+        r"""
+        visible_indices (`torch.LongTensor` of shape `(batch_size, num_visible)`, *optional*):
+            Positions of the visible patches, only used by the "mae" objective. Together with `masked_indices`
+            they replace `bool_masked_pos`, without the host sync of turning a boolean mask into indices.
+        masked_indices (`torch.LongTensor` of shape `(batch_size, num_masked)`, *optional*):
+            Positions of the masked patches to reconstruct, only used by the "mae" objective.
+        """
         return_dict = (
             return_dict if return_dict is not None else self.config.use_return_dict
         )
 
+        if self.mim_mode == "mae":
+            return self._forward_mae(
+                pixel_values,
+                bool_masked_pos=bool_masked_pos,
+                visible_indices=visible_indices,
+                masked_indices=masked_indices,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                interpolate_pos_encoding=interpolate_pos_encoding,
+                return_dict=return_dict,
+            )
+
         if bool_masked_pos is not None and (
             self.config.patch_size != self.config.encoder_stride
         ):
@@ -453,8 +618,12 @@ class GatedDeltaNetForMaskedImageModeling(GatedDeltaNetVisionPreTrainedModel):
                 .unsqueeze(1)
                 .contiguous()
             )
+            # uint8 inputs are compared in the normalized pixel space of the reconstruction
+            target_pixel_values = self.backbone.embeddings.patch_embeddings.normalize(
+                pixel_values
+            )
             reconstruction_loss = nn.functional.l1_loss(
-                pixel_values, reconstructed_pixel_values, reduction="none"
+                target_pixel_values, reconstructed_pixel_values, reduction="none"
             )
             masked_im_loss = (
                 (reconstruction_loss * mask).sum()
@@ -475,6 +644,93 @@ class GatedDeltaNetForMaskedImageModeling(GatedDeltaNetVisionPreTrainedModel):
             attentions=outputs.attentions,
         )
 
+    def _forward_mae(
+        self,
+        pixel_values: torch.Tensor,
+        bool_masked_pos: Optional[torch.BoolTensor] = None,
+        visible_indices: Optional[torch.LongTensor] = None,
+        masked_indices: Optional[torch.LongTensor] = None,
+        output_attentions: Optional[bool] = None,
+        output_hidden_states: Optional[bool] = None,
+        interpolate_pos_encoding: Optional[bool] = None,
+        return_dict: bool = True,
+    ) -> Union[tuple, MaskedImageModelingOutput]:
+        if visible_indices is None or masked_indices is None:
+            if bool_masked_pos is None:
+                raise ValueError(
+                    "The MAE objective needs `bool_masked_pos`, or `visible_indices` and `masked_indices`."
+                )
+            # turning a boolean mask into indices needs one host sync
+            visible_indices, masked_indices = mask_to_indices(bool_masked_pos)
+
+        outputs = self.backbone(
+            pixel_values,
+            visible_indices=visible_indices,
+            output_attentions=output_attentions,
+            output_hidden_states=output_hidden_states,
+            interpolate_pos_encoding=interpolate_pos_encoding,
+            return_dict=return_dict,
+        )
+
+        sequence_output = self.encoder_to_decoder(outputs[0])
+        batch_size, _, decoder_hidden_size = sequence_output.shape
+        patch_size = self.config.patch_size
+        grid_size = (
+            pixel_values.shape[-2] // patch_size,
+            pixel_values.shape[-1] // patch_size,
+        )
+        num_patches = grid_size[0] * grid_size[1]
+
+        position_embeddings = self.position_embeddings
+        if position_embeddings.shape[1] != num_patches:
+            # other resolutions, the sin-cos table is extended instead of interpolated
+            position_embeddings = get_sinusoid_encoding_table(
+                num_patches, decoder_hidden_size
+            ).to(sequence_output.device)
+        position_embeddings = position_embeddings.type_as(sequence_output)
+
+        # put the visible tokens back in place, so that the decoder scans the full grid in order
+        hidden_states = (
+            self.mask_token.type_as(sequence_output)
+            .expand(batch_size, num_patches, -1)
+            .scatter(
+                1,
+                visible_indices.unsqueeze(-1).expand(-1, -1, decoder_hidden_size),
+                sequence_output,
+            )
+        )
+        hidden_states = hidden_states + position_embeddings
+
+        # [B, N, num_channels * patch_size * patch_size], a prediction for every patch
+        logits = self.decoder(hidden_states).logits
+
+        with torch.no_grad():
+            # uint8 inputs are compared in the normalized pixel space of the reconstruction
+            labels = get_image_patch_targets(
+                self.backbone.embeddings.patch_embeddings.normalize(pixel_values),
+                masked_indices,
+                self.config,
+            )
+
+        # the loss only covers the masked patches
+        loss_fct = torch.nn.MSELoss()
+        masked_im_loss = loss_fct(gather_tokens(logits, masked_indices), labels)
+
+        reconstructed_pixel_values = patches_to_image(
+            logits, grid_size, (patch_size, patch_size), self.config.num_channels
+        )
+
+        if not return_dict:
+            output = (reconstructed_pixel_values,) + outputs[1:]
+            return (masked_im_loss,) + output
+
+        return MaskedImageModelingOutput(
+            loss=masked_im_loss,
+            reconstruction=reconstructed_pixel_values,
+            hidden_states=outputs.hidden_states,
+            attentions=outputs.attentions,
+        )
+
 
 class GatedDeltaNetVideoMLP(nn.Module):
     def __init__(self, config):
@@ -559,10 +815,8 @@ class GatedDeltaNetVideoBlock(nn.Module):
             layer_idx=self.layer_idx,
         )
 
-        hidden_states = residual + hidden_states
-        residual = hidden_states
-
-        hidden_states = self.ln_2(hidden_states)
+        # residual add and ln_2 in one pass
+        hidden_states, residual = add_norm(self.ln_2, hidden_states, residual)
 
         hidden_states = self.channel_mixer(hidden_states)
         hidden_states = residual + hidden_states
@@ -671,6 +925,7 @@ class GatedDeltaNetVideoModel(GatedDeltaNetVideoPreTrainedModel):
         self,
         pixel_values,
         bool_masked_pos=None,
+        visible_indices=None,
         output_attentions=None,
         output_hidden_states=None,
         past_key_values: Optional[Union[Cache, List[torch.FloatTensor]]] = None,
@@ -693,7 +948,9 @@ class GatedDeltaNetVideoModel(GatedDeltaNetVideoPreTrainedModel):
             return_dict if return_dict is not None else self.config.use_return_dict
         )
 
-        embedding_output = self.embeddings(pixel_values, bool_masked_pos)
+        embedding_output = self.embeddings(
+            pixel_values, bool_masked_pos, visible_indices=visible_indices
+        )
 
         encoder_outputs = self.encoder(
             embedding_output,
@@ -821,8 +1078,13 @@ class GatedDeltaNetForVideoPreTraining(GatedDeltaNetVideoPreTrainedModel):
             config.hidden_size, config.decoder_hidden_size, bias=False
         )
         self.mask_token = nn.Parameter(torch.zeros(1, 1, config.decoder_hidden_size))
-        self.position_embeddings = get_sinusoid_encoding_table(
-            self.backbone.embeddings.num_patches, config.decoder_hidden_size
+        # fixed sin-cos embedding, built once and moved along with the model
+        self.register_buffer(
+            "position_embeddings",
+            get_sinusoid_encoding_table(
+                self.backbone.embeddings.num_patches, config.decoder_hidden_size
+            ),
+            persistent=False,
         )
 
         self.decoder = GatedDeltaNetVideoDecoder(
@@ -834,18 +1096,39 @@ class GatedDeltaNetForVideoPreTraining(GatedDeltaNetVideoPreTrainedModel):
     def forward(
         self,
         pixel_values: torch.FloatTensor,
-        bool_masked_pos: torch.BoolTensor,
+        bool_masked_pos: Optional[torch.BoolTensor] = None,
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        visible_indices: Optional[torch.LongTensor] = None,
+        masked_indices: Optional[torch.LongTensor] = None,
+        decoder_indices: Optional[torch.LongTensor] = None,
     ) -> Union[tuple, VideoForPreTrainingOutput]:
+        r"""
+        visible_indices (`torch.LongTensor` of shape `(batch_size, num_visible)`, *optional*):
+            Positions of the visible tubelets, e.g. from `sample_video_mask_indices`. Together with `masked_indices`
+            they replace `bool_masked_pos`, and the whole step runs with gathers only, without host syncs.
+        masked_indices (`torch.LongTensor` of shape `(batch_size, num_masked)`, *optional*):
+            Positions of the masked tubelets to reconstruct.
+        decoder_indices (`torch.LongTensor` of shape `(batch_size, num_decoded)`, *optional*):
+            Subset of the masked positions that the decoder reconstructs (decoder masking, as in VideoMAE v2).
+            In training, defaults to a random `1 - config.decoder_mask_ratio` fraction of the masked tubelets.
+        """
         return_dict = (
             return_dict if return_dict is not None else self.config.use_return_dict
         )
 
+        if visible_indices is None or masked_indices is None:
+            if bool_masked_pos is None:
+                raise ValueError(
+                    "The MAE objective needs `bool_masked_pos`, or `visible_indices` and `masked_indices`."
+                )
+            # turning a boolean mask into indices needs one host sync
+            visible_indices, masked_indices = mask_to_indices(bool_masked_pos)
+
         outputs = self.backbone(
             pixel_values,
-            bool_masked_pos=bool_masked_pos,
+            visible_indices=visible_indices,
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
@@ -854,21 +1137,15 @@ class GatedDeltaNetForVideoPreTraining(GatedDeltaNetVideoPreTrainedModel):
         sequence_output = outputs[0]
         sequence_output = self.encoder_to_decoder(sequence_output)
 
-        batch_size, seq_len, num_channels = sequence_output.shape
-
-        expanded_position_embeddings = self.position_embeddings.expand(
-            batch_size, -1, -1
-        ).type_as(pixel_values)
-        expanded_position_embeddings = (
-            expanded_position_embeddings.to(pixel_values.device).clone().detach()
-        )
+        if decoder_indices is None:
+            decoder_indices = sample_decoder_indices(
+                masked_indices,
+                self.config.decoder_mask_ratio if self.training else 0.0,
+            )
 
-        pos_emb_visible = expanded_position_embeddings[~bool_masked_pos].reshape(
-            batch_size, -1, num_channels
-        )
-        pos_emb_mask = expanded_position_embeddings[bool_masked_pos].reshape(
-            batch_size, -1, num_channels
-        )
+        position_embeddings = self.position_embeddings.type_as(sequence_output)
+        pos_emb_visible = gather_tokens(position_embeddings, visible_indices)
+        pos_emb_mask = gather_tokens(position_embeddings, decoder_indices)
 
         x_full = torch.cat(
             [sequence_output + pos_emb_visible, self.mask_token + pos_emb_mask], dim=1
@@ -878,84 +1155,9 @@ class GatedDeltaNetForVideoPreTraining(GatedDeltaNetVideoPreTrainedModel):
         logits = decoder_outputs.logits
 
         loss = None
-        # below taken from https://github.com/huggingface/transformers/blob/main/src/transformers/models/videomae/modeling_videomae.py#L730
         with torch.no_grad():
-            # calculate the labels to be predicted
-            if self.config.num_channels != 3:
-                # Can't unnormalize with default means/stds
-                frames = pixel_values
-            else:
-                # first, unnormalize the frames
-                device = pixel_values.device
-                dtype = pixel_values.dtype
-                mean = torch.as_tensor(IMAGENET_DEFAULT_MEAN).to(
-                    device=device, dtype=dtype
-                )[None, None, :, None, None]
-                std = torch.as_tensor(IMAGENET_DEFAULT_STD).to(
-                    device=device, dtype=dtype
-                )[None, None, :, None, None]
-                frames = pixel_values * std + mean  # in [0, 1]
-
-            batch_size, time, num_channels, height, width = frames.shape
-            tubelet_size, patch_size = self.config.tubelet_size, self.config.patch_size
-            if self.config.norm_pix_loss:
-                # step 1: split up dimensions (time by tubelet_size, height by patch_size, width by patch_size)
-                frames = frames.view(
-                    batch_size,
-                    time // tubelet_size,
-                    tubelet_size,
-                    num_channels,
-                    height // patch_size,
-                    patch_size,
-                    width // patch_size,
-                    patch_size,
-                )
-                # step 2: move dimensions to concatenate:
-                frames = frames.permute(0, 1, 4, 6, 2, 5, 7, 3).contiguous()
-                # step 3: concatenate:
-                frames = frames.view(
-                    batch_size,
-                    time // tubelet_size * height // patch_size * width // patch_size,
-                    tubelet_size * patch_size * patch_size,
-                    num_channels,
-                )
-                # step 4: normalize. The authors find that the mean is about 0.48 and standard deviation is about 0.08.
-                frames_norm = (frames - frames.mean(dim=-2, keepdim=True)) / (
-                    frames.var(dim=-2, unbiased=True, keepdim=True).sqrt() + 1e-6
-                )
-                # step 5: reshape to (batch_size, T//ts * H//ps * W//ps, ts * ps * ps * C)
-                videos_patch = frames_norm.view(
-                    batch_size,
-                    time // tubelet_size * height // patch_size * width // patch_size,
-                    tubelet_size * patch_size * patch_size * num_channels,
-                )
-            else:
-                if self.config.num_channels != 3:
-                    raise ValueError(
-                        "Can't unnormalize non-RGB images. Consider setting config.norm_pix_loss to False."
-                    )
-                # step 1: split up dimensions (time by tubelet_size, height by patch_size, width by patch_size)
-                frames = frames.view(
-                    batch_size,
-                    time // tubelet_size,
-                    tubelet_size,
-                    num_channels,
-                    height // patch_size,
-                    patch_size,
-                    width // patch_size,
-                    patch_size,
-                )
-                # step 2: move dimensions to concatenate: (batch_size, T//ts, H//ps, W//ps, ts, ps, ps, C)
-                frames = frames.permute(0, 1, 4, 6, 2, 5, 7, 3).contiguous()
-                # step 3: concatenate
-                videos_patch = frames.view(
-                    batch_size,
-                    time // tubelet_size * height // patch_size * width // patch_size,
-                    tubelet_size * patch_size * patch_size * num_channels,
-                )
-
-            batch_size, _, num_channels = videos_patch.shape
-            labels = videos_patch[bool_masked_pos].reshape(batch_size, -1, num_channels)
+            # calculate the labels to be predicted, only for the decoded tubelets
+            labels = get_video_patch_targets(pixel_values, decoder_indices, self.config)
 
         loss_fct = torch.nn.MSELoss()
         loss = loss_fct(logits, labels)
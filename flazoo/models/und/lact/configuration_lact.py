@@ -22,6 +22,9 @@ class LaCTVisionConfig(PretrainedConfig):
         use_swiglu: bool = False,
         use_short_conv: bool = True,
         conv_size: int = 4,
+        lact_chunk_size: Optional[int] = None,
+        lact_use_muon: bool = False,  # orthogonalize the fast weight updates with Newton-Schulz
+        lact_muon_tol: Optional[float] = None,  # None: fixed 5 Newton-Schulz iterations, else adaptive
         use_rope: bool = False,
         # Vision specific parameters
         image_size: int = 224,
@@ -29,11 +32,20 @@ class LaCTVisionConfig(PretrainedConfig):
         num_channels: int = 3,
         num_classes: int = 1000,
         hidden_dropout_prob: float = 0.0,
+        patch_dropout: float = 0.0,  # fraction of the patches dropped per sample in classification training
         use_mask_token: bool = False,
         layer_norm_eps: float = 1e-6,
         interpolate_pos_encoding: bool = False,
         encoder_stride=16,
         channel_mixer_dim: int = None,
+        # masked image modeling objective, "simmim" or "mae"
+        mim_mode: str = "simmim",
+        norm_pix_loss: bool = False,
+        # decoder specific parameters, only used by the "mae" objective
+        decoder_num_heads: int = 6,
+        decoder_hidden_size: int = 256,
+        decoder_num_hidden_layers: int = 4,
+        decoder_channel_mixer_dim: int = None,
         **kwargs,
     ):
         # Initialize DeltaNet core parameters
@@ -47,6 +59,9 @@ class LaCTVisionConfig(PretrainedConfig):
         self.use_swiglu = use_swiglu
         self.use_short_conv = use_short_conv
         self.conv_size = conv_size
+        self.lact_chunk_size = lact_chunk_size
+        self.lact_use_muon = lact_use_muon
+        self.lact_muon_tol = lact_muon_tol
         self.use_rope = use_rope
 
         # Initialize vision specific parameters
@@ -55,12 +70,20 @@ class LaCTVisionConfig(PretrainedConfig):
         self.num_channels = num_channels
         self.num_classes = num_classes
         self.hidden_dropout_prob = hidden_dropout_prob
+        self.patch_dropout = patch_dropout
         self.use_mask_token = use_mask_token
         self.layer_norm_eps = layer_norm_eps
         self.interpolate_pos_encoding = interpolate_pos_encoding
         self.train_scan_type = "uni-scan"
         self.test_scan_type = "uni-scan"
         self.encoder_stride = encoder_stride
+        self.mim_mode = mim_mode
+        self.norm_pix_loss = norm_pix_loss
+
+        # Initialize decoder specific parameters
+        self.decoder_num_heads = decoder_num_heads
+        self.decoder_hidden_size = decoder_hidden_size
+        self.decoder_num_hidden_layers = decoder_num_hidden_layers
 
         if attn is not None:
             if not isinstance(attn, Dict):
@@ -85,6 +108,11 @@ class LaCTVisionConfig(PretrainedConfig):
         else:
             self.channel_mixer_dim = channel_mixer_dim
 
+        if decoder_channel_mixer_dim is None:
+            self.decoder_channel_mixer_dim = 4 * decoder_hidden_size
+        else:
+            self.decoder_channel_mixer_dim = decoder_channel_mixer_dim  # default value set to 4 * decoder_hidden_size
+
         super().__init__(**kwargs)
 
 
@@ -105,6 +133,9 @@ class LaCTVideoConfig(PretrainedConfig):
         use_swiglu: bool = False,
         use_short_conv: bool = True,
         conv_size: int = 4,
+        lact_chunk_size: Optional[int] = None,
+        lact_use_muon: bool = False,  # orthogonalize the fast weight updates with Newton-Schulz
+        lact_muon_tol: Optional[float] = None,  # None: fixed 5 Newton-Schulz iterations, else adaptive
         use_rope: bool = False,
         # Video specific parameters
         image_size: int = 224,
@@ -118,6 +149,7 @@ class LaCTVideoConfig(PretrainedConfig):
         encoder_stride=16,
         channel_mixer_dim: int = None,
         norm_pix_loss: bool = True,
+        decoder_mask_ratio: float = 0.0,
         num_frames: int = 16,
         tubelet_size: int = 1,
         # decoder specific parameters
@@ -138,6 +170,9 @@ class LaCTVideoConfig(PretrainedConfig):
         self.use_swiglu = use_swiglu
         self.use_short_conv = use_short_conv
         self.conv_size = conv_size
+        self.lact_chunk_size = lact_chunk_size
+        self.lact_use_muon = lact_use_muon
+        self.lact_muon_tol = lact_muon_tol
         self.use_rope = use_rope
 
         # Initialize video specific parameters
@@ -153,6 +188,7 @@ class LaCTVideoConfig(PretrainedConfig):
         self.test_scan_type = "uni-scan"
         self.encoder_stride = encoder_stride
         self.norm_pix_loss = norm_pix_loss
+        self.decoder_mask_ratio = decoder_mask_ratio
         self.num_frames = num_frames
         self.tubelet_size = tubelet_size
 
@@ -5,10 +5,16 @@ from typing import Any, Dict, List, Optional, Tuple
 import torch
 import transformers
 from torch import nn
+import collections
 import collections.abc
-from transformers.utils import torch_int, ModelOutput
+import functools
+from transformers.utils import ModelOutput
+from transformers.utils.constants import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
+import dataclasses
 from dataclasses import dataclass
-import numpy as np
+from fla.modules import LayerNorm
+from flazoo.models.utils import gather_tokens, mask_to_indices, scan_requires_full_grid
+from flazoo.layers.attentions import GRID_ATTN_LISTS
 
 
 """
@@ -16,6 +22,158 @@ Basic components of a vision model, including the patch embeddings, image embedd
 """
 
 
+def get_pixel_statistics(config, num_channels: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Per-channel mean/std used to normalize uint8 pixels, from `config.image_mean` / `config.image_std`.
+    Defaults to the ImageNet statistics for RGB inputs, and to a plain rescaling to [0, 1] otherwise.
+    """
+    mean = getattr(config, "image_mean", None)
+    std = getattr(config, "image_std", None)
+    if mean is None:
+        mean = IMAGENET_DEFAULT_MEAN if num_channels == 3 else (0.0,) * num_channels
+    if std is None:
+        std = IMAGENET_DEFAULT_STD if num_channels == 3 else (1.0,) * num_channels
+    return torch.tensor(mean, dtype=torch.float32), torch.tensor(std, dtype=torch.float32)
+
+
+def fold_pixel_normalization(
+    weight: torch.Tensor,
+    bias: Optional[torch.Tensor],
+    mean: torch.Tensor,
+    std: torch.Tensor,
+    scale: float = 255.0,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Fold the input normalization x -> (x / scale - mean) / std into a patch projection,
+    so that raw uint8 pixels can be projected directly.
+
+    Args:
+        weight: [hidden_size, num_channels, *kernel_size]
+        bias: [hidden_size]
+        mean, std: [num_channels]
+
+    Returns:
+        The folded weight and bias
+    """
+    shape = (1, -1) + (1,) * (weight.dim() - 2)
+    weight_scale = (1.0 / (scale * std)).view(shape).to(weight.dtype)
+    weight_shift = (mean / std).view(shape).to(weight.dtype)
+    folded_bias = -(weight * weight_shift).flatten(1).sum(-1)
+    if bias is not None:
+        folded_bias = folded_bias + bias
+    return weight * weight_scale, folded_bias
+
+
+def patch_projection(
+    patches: torch.Tensor,
+    weight: torch.Tensor,
+    bias: Optional[torch.Tensor],
+    position_embeddings: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """
+    Project flattened patches [B, N, K] with weight [hidden_size, K].
+    The position embeddings [1, N, hidden_size] (and the bias) are the additive input of a single batched GEMM.
+    """
+    if position_embeddings is None:
+        return nn.functional.linear(patches, weight, bias)
+    batch_size = patches.shape[0]
+    addend = position_embeddings.to(patches.dtype)
+    if bias is not None:
+        addend = addend + bias.to(patches.dtype)
+    return torch.baddbmm(
+        addend.expand(batch_size, -1, -1),
+        patches,
+        weight.t().expand(batch_size, -1, -1),
+    )
+
+
+def gather_patches(
+    pixel_values: torch.Tensor,
+    indices: Optional[torch.LongTensor],
+    patch_size: Tuple[int, int],
+) -> torch.Tensor:
+    """
+    Cut images into non-overlapping patches, only materializing the selected ones.
+
+    Args:
+        pixel_values: [B, C, H, W]
+        indices: [B, n] flat (h, w) positions of the patches to keep, or None to keep all of them
+        patch_size: (patch_height, patch_width)
+
+    Returns:
+        [B, n, C, ph, pw]
+    """
+    batch_size, num_channels, height, width = pixel_values.shape
+    patch_height, patch_width = patch_size
+    grid_height, grid_width = height // patch_height, width // patch_width
+    # drop the borders like the strided convolution does
+    pixel_values = pixel_values[
+        :, :, : grid_height * patch_height, : grid_width * patch_width
+    ]
+    # [B, C, H', ph, W', pw]
+    patches = pixel_values.reshape(
+        batch_size, num_channels, grid_height, patch_height, grid_width, patch_width
+    )
+    if indices is None:
+        return patches.permute(0, 2, 4, 1, 3, 5).reshape(
+            batch_size, grid_height * grid_width, num_channels, patch_height, patch_width
+        )
+
+    height_idx = indices // grid_width
+    width_idx = indices % grid_width
+    batch_idx = torch.arange(batch_size, device=indices.device)[:, None]
+    # advanced indexing only reads the selected patches: [B, n, C, ph, pw]
+    return patches[batch_idx, :, height_idx, :, width_idx, :]
+
+
+def patches_to_image(
+    patches: torch.Tensor,
+    grid_size: Tuple[int, int],
+    patch_size: Tuple[int, int],
+    num_channels: int,
+) -> torch.Tensor:
+    """
+    Inverse of `gather_patches` for a full grid: [B, H' * W', C * ph * pw] -> [B, C, H' * ph, W' * pw]
+    """
+    batch_size = patches.shape[0]
+    grid_height, grid_width = grid_size
+    patch_height, patch_width = patch_size
+    patches = patches.reshape(
+        batch_size, grid_height, grid_width, num_channels, patch_height, patch_width
+    )
+    return patches.permute(0, 3, 1, 4, 2, 5).reshape(
+        batch_size, num_channels, grid_height * patch_height, grid_width * patch_width
+    )
+
+
+def get_image_patch_targets(
+    pixel_values: torch.Tensor,
+    masked_indices: torch.LongTensor,
+    config,
+) -> torch.Tensor:
+    """
+    MAE reconstruction targets, computed for the masked patches only.
+
+    Args:
+        pixel_values: [B, C, H, W], normalized pixels
+        masked_indices: [B, n] positions of the masked patches
+
+    Returns:
+        labels: [B, n, num_channels * patch_size * patch_size], in the layout of `patches_to_image`
+    """
+    patch_size = config.patch_size
+    # [B, n, C, ph, pw]
+    patches = gather_patches(pixel_values, masked_indices, (patch_size, patch_size))
+    batch_size, num_masked = patches.shape[:2]
+    if config.norm_pix_loss:
+        # normalize each patch per channel, as in MAE
+        patches = patches.flatten(3)
+        patches = (patches - patches.mean(dim=-1, keepdim=True)) / (
+            patches.var(dim=-1, unbiased=True, keepdim=True).sqrt() + 1e-6
+        )
+    return patches.reshape(batch_size, num_masked, -1)
+
+
 class PatchEmbeddings(nn.Module):
     """
     Convert image into patch embeddings.
@@ -48,10 +206,37 @@ class PatchEmbeddings(nn.Module):
         self.projection = nn.Conv2d(
             num_channels, hidden_size, kernel_size=patch_size, stride=patch_size
         )
+        # statistics of uint8 inputs, folded into the projection
+        pixel_mean, pixel_std = get_pixel_statistics(config, num_channels)
+        self.register_buffer("pixel_mean", pixel_mean, persistent=False)
+        self.register_buffer("pixel_std", pixel_std, persistent=False)
+
+    def normalize(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        """
+        Normalize uint8 pixels [B, C, H, W] the way the projection expects them, float inputs are returned as is.
+        """
+        if pixel_values.dtype != torch.uint8:
+            return pixel_values
+        mean = self.pixel_mean.view(1, -1, 1, 1)
+        std = self.pixel_std.view(1, -1, 1, 1)
+        return (pixel_values.to(mean.dtype) / 255.0 - mean) / std
 
     def forward(
-        self, pixel_values: torch.Tensor, interpolate_pos_encoding: bool = False
+        self,
+        pixel_values: torch.Tensor,
+        interpolate_pos_encoding: bool = False,
+        position_embeddings: Optional[torch.Tensor] = None,
+        patch_indices: Optional[torch.LongTensor] = None,
     ) -> torch.Tensor:
+        """
+        Args:
+            pixel_values: [B, C, H, W], normalized floats or raw uint8 pixels
+            position_embeddings: [1, N, hidden_size], added to the output if given
+            patch_indices: [B, n], only embed these patches
+
+        uint8 pixels are patchified as bytes and projected with a single GEMM whose weights absorb the normalization,
+        so they never materialize as a float image. Selected patches are gathered before the projection.
+        """
         batch_size, num_channels, height, width = pixel_values.shape
         if num_channels != self.num_channels:
             raise ValueError(
@@ -64,9 +249,50 @@ class PatchEmbeddings(nn.Module):
                     f"Input image size ({height}*{width}) doesn't match model"
                     f" ({self.image_size[0]}*{self.image_size[1]})."
                 )
+        if patch_indices is not None and position_embeddings is not None:
+            position_embeddings = gather_tokens(position_embeddings, patch_indices)
+        if self.projection.stride == self.projection.kernel_size and (
+            pixel_values.dtype == torch.uint8 or patch_indices is not None
+        ):
+            return self._forward_patchify(
+                pixel_values, position_embeddings, patch_indices
+            )
+        pixel_values = self.normalize(pixel_values)
         embeddings = self.projection(pixel_values).flatten(2).transpose(1, 2)
+        if patch_indices is not None:
+            embeddings = gather_tokens(embeddings, patch_indices)
+        if position_embeddings is not None:
+            embeddings = embeddings + position_embeddings
         return embeddings
 
+    def _forward_patchify(
+        self,
+        pixel_values: torch.Tensor,
+        position_embeddings: Optional[torch.Tensor] = None,
+        patch_indices: Optional[torch.LongTensor] = None,
+    ) -> torch.Tensor:
+        # non-overlapping patches: reshape + GEMM is the same as the strided convolution
+        # [B, n, C * ph * pw], on bytes for uint8 inputs
+        patches = gather_patches(pixel_values, patch_indices, self.patch_size).flatten(2)
+        return self.project_patches(patches, position_embeddings)
+
+    def project_patches(
+        self,
+        patches: torch.Tensor,
+        position_embeddings: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """
+        Project flattened patches [B, n, C * ph * pw] (normalized floats or raw uint8 pixels) to [B, n, hidden_size].
+        """
+        weight, bias = self.projection.weight, self.projection.bias
+        if patches.dtype == torch.uint8:
+            weight, bias = fold_pixel_normalization(
+                weight, bias, self.pixel_mean, self.pixel_std
+            )
+        return patch_projection(
+            patches.to(weight.dtype), weight.flatten(1), bias, position_embeddings
+        )
+
 
 class ImageEmbeddings(nn.Module):
     """
@@ -90,6 +316,9 @@ class ImageEmbeddings(nn.Module):
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
         self.patch_size = config.patch_size
         self.config = config
+        # (height, width, dtype, device) -> (parameter version, interpolated table), in LRU order
+        self._pos_encoding_cache = collections.OrderedDict()
+        self.pos_encoding_cache_size = getattr(config, "pos_encoding_cache_size", 8)
 
     def interpolate_pos_encoding(
         self, embeddings: torch.Tensor, height: int, width: int
@@ -98,30 +327,44 @@ class ImageEmbeddings(nn.Module):
         This method allows to interpolate the pre-trained position encodings, to be able to use the model on higher resolution
         images. This method is also adapted to support torch.jit tracing.
 
+        Rectangular pre-trained and target grids are supported. When no gradient flows to the position embeddings
+        (e.g. inference), the interpolated tables are cached per (height, width, dtype, device), with LRU eviction,
+        and recomputed whenever the parameter is modified.
+
         Adapted from:
         - https://github.com/facebookresearch/dino/blob/de9ee3df6cf39fac952ab558447af1fa1365362a/vision_transformer.py#L174-L194, and
         - https://github.com/facebookresearch/dinov2/blob/e1277af2ba9496fbadf7aec6eba56e8d882d1e35/dinov2/models/vision_transformer.py#L179-L211
         """
 
-        num_patches = embeddings.shape[1]
-        num_positions = self.position_embeddings.shape[1]
+        patch_height, patch_width = self.patch_embeddings.patch_size
+        grid_height = self.patch_embeddings.image_size[0] // patch_height
+        grid_width = self.patch_embeddings.image_size[1] // patch_width
+        new_height = height // patch_height
+        new_width = width // patch_width
 
-        if (
-            not torch.jit.is_tracing()
-            and num_patches == num_positions
-            and height == width
+        if not torch.jit.is_tracing() and (new_height, new_width) == (
+            grid_height,
+            grid_width,
         ):
             return self.position_embeddings
 
-        dim = embeddings.shape[-1]
-
-        new_height = height // self.patch_size
-        new_width = width // self.patch_size
-
-        sqrt_num_positions = torch_int(num_positions**0.5)
-        pos_embed = self.position_embeddings.reshape(
-            1, sqrt_num_positions, sqrt_num_positions, dim
+        use_cache = not torch.jit.is_tracing() and not (
+            torch.is_grad_enabled() and self.position_embeddings.requires_grad
         )
+        key = (new_height, new_width, embeddings.dtype, embeddings.device)
+        # the version counter is bumped by every in-place update, e.g. optimizer steps or load_state_dict
+        version = (
+            self.position_embeddings._version,
+            self.position_embeddings.data_ptr(),
+        )
+        if use_cache:
+            cached = self._pos_encoding_cache.get(key)
+            if cached is not None and cached[0] == version:
+                self._pos_encoding_cache.move_to_end(key)
+                return cached[1]
+
+        dim = embeddings.shape[-1]
+        pos_embed = self.position_embeddings.reshape(1, grid_height, grid_width, dim)
 
         pos_embed = pos_embed.permute(0, 3, 1, 2)
 
@@ -132,7 +375,14 @@ class ImageEmbeddings(nn.Module):
             align_corners=False,
         )
 
-        pos_embed = pos_embed.permute(0, 2, 3, 1).view(1, -1, dim)
+        pos_embed = pos_embed.permute(0, 2, 3, 1).reshape(1, -1, dim)
+        pos_embed = pos_embed.to(dtype=embeddings.dtype, device=embeddings.device)
+
+        if use_cache:
+            self._pos_encoding_cache[key] = (version, pos_embed)
+            self._pos_encoding_cache.move_to_end(key)
+            while len(self._pos_encoding_cache) > self.pos_encoding_cache_size:
+                self._pos_encoding_cache.popitem(last=False)
 
         return pos_embed
 
@@ -141,31 +391,108 @@ class ImageEmbeddings(nn.Module):
         pixel_values: torch.Tensor,
         bool_masked_pos: Optional[torch.BoolTensor] = None,
         interpolate_pos_encoding: bool = False,
+        visible_indices: Optional[torch.LongTensor] = None,
     ) -> torch.Tensor:
+        """
+        Args:
+            pixel_values: [B, C, H, W]
+            bool_masked_pos: [B, N], masked patches are replaced by the mask token
+            visible_indices: [B, n], only embed these patches, the others are dropped (as in MAE)
+        """
         batch_size, num_channels, height, width = pixel_values.shape
-        embeddings = self.patch_embeddings(
-            pixel_values, interpolate_pos_encoding=interpolate_pos_encoding
-        )
+        if interpolate_pos_encoding:
+            # only the hidden size, dtype and device of the table are needed here
+            position_embeddings = self.interpolate_pos_encoding(
+                self.position_embeddings, height, width
+            )
+        else:
+            position_embeddings = self.position_embeddings
 
-        if bool_masked_pos is not None:
+        if bool_masked_pos is None or visible_indices is not None:
+            # add positional encoding to each token, fused into the patch projection
+            embeddings = self.patch_embeddings(
+                pixel_values,
+                interpolate_pos_encoding=interpolate_pos_encoding,
+                position_embeddings=position_embeddings,
+                patch_indices=visible_indices,
+            )
+        else:
+            embeddings = self.patch_embeddings(
+                pixel_values, interpolate_pos_encoding=interpolate_pos_encoding
+            )
             seq_length = embeddings.shape[1]
             mask_tokens = self.mask_token.expand(batch_size, seq_length, -1)
             # replace the masked visual tokens by mask_tokens
             mask = bool_masked_pos.unsqueeze(-1).type_as(mask_tokens)
             embeddings = embeddings * (1.0 - mask) + mask_tokens * mask
 
-        # add positional encoding to each token
-        if interpolate_pos_encoding:
-            embeddings = embeddings + self.interpolate_pos_encoding(
-                embeddings, height, width
-            )
-        else:
-            embeddings = embeddings + self.position_embeddings
+            # add positional encoding to each token
+            embeddings = embeddings + position_embeddings
 
         embeddings = self.dropout(embeddings)
 
         return embeddings
 
+    def forward_packed(
+        self, pixel_values: List[torch.Tensor]
+    ) -> Tuple[torch.Tensor, torch.LongTensor]:
+        """
+        Embed images of different sizes into a single packed sequence, without padding.
+
+        Args:
+            pixel_values: list of [C, H_i, W_i] images, normalized floats or raw uint8 pixels
+
+        Returns:
+            embeddings: [1, sum_i N_i, hidden_size]
+            cu_seqlens: [num_images + 1], boundaries of the images in the packed sequence
+        """
+        patch_embeddings = self.patch_embeddings
+        if patch_embeddings.projection.stride != patch_embeddings.projection.kernel_size:
+            raise ValueError("Packed sequences need non-overlapping patches")
+        patches, position_embeddings, seqlens = [], [], []
+        for image in pixel_values:
+            height, width = image.shape[-2:]
+            # [N_i, C * ph * pw]
+            patches.append(
+                gather_patches(image[None], None, patch_embeddings.patch_size)
+                .flatten(2)
+                .squeeze(0)
+            )
+            # the tables are cached per resolution at inference
+            position_embeddings.append(
+                self.interpolate_pos_encoding(self.position_embeddings, height, width)
+                .squeeze(0)
+            )
+            seqlens.append(patches[-1].shape[0])
+        # a single projection for the whole ragged batch, the position embeddings are fused in
+        embeddings = patch_embeddings.project_patches(
+            torch.cat(patches)[None], torch.cat(position_embeddings)[None]
+        )
+        cu_seqlens = torch.tensor(
+            [0] + seqlens, dtype=torch.long, device=embeddings.device
+        ).cumsum(0)
+        return self.dropout(embeddings), cu_seqlens
+
+
+def mean_pool(
+    hidden_states: torch.Tensor, cu_seqlens: Optional[torch.LongTensor] = None
+) -> torch.Tensor:
+    """
+    Mean of the tokens: [B, L, D] -> [B, D], or within each of the packed sequences [1, T, D] -> [N, D]
+    """
+    if cu_seqlens is None:
+        return hidden_states.mean(dim=1)
+    seqlens = cu_seqlens[1:] - cu_seqlens[:-1]
+    seq_ids = torch.repeat_interleave(
+        torch.arange(seqlens.numel(), device=hidden_states.device),
+        seqlens,
+        output_size=hidden_states.shape[1],
+    )
+    pooled_output = hidden_states.new_zeros(
+        seqlens.numel(), hidden_states.shape[-1]
+    ).index_add_(0, seq_ids, hidden_states[0])
+    return pooled_output / seqlens[:, None].to(pooled_output.dtype)
+
 
 class Pooler(nn.Module):
     """
@@ -173,18 +500,183 @@ class Pooler(nn.Module):
     Adapted from huggingface/transformers ViT implementation.
     """
 
-    def __init__(self, config):
+    def __init__(self, config, hidden_size: Optional[int] = None):
         super().__init__()
-        self.dense = nn.Linear(config.hidden_size, config.hidden_size)
+        # the width of the last stage for hierarchical encoders
+        hidden_size = hidden_size if hidden_size is not None else config.hidden_size
+        self.dense = nn.Linear(hidden_size, hidden_size)
         self.activation = nn.Tanh()
 
-    def forward(self, hidden_states):
-        pooled_output = hidden_states.mean(dim=1)  # always use mean pooling
+    def forward(self, hidden_states, cu_seqlens: Optional[torch.LongTensor] = None):
+        pooled_output = mean_pool(hidden_states, cu_seqlens)  # always use mean pooling
         pooled_output = self.dense(pooled_output)
         pooled_output = self.activation(pooled_output)
         return pooled_output
 
 
+class EarlyExitHead(nn.Module):
+    """
+    Lightweight classifier after an intermediate block for early exit: layer norm, mean pooling and a linear layer.
+    """
+
+    def __init__(self, hidden_size: int, num_classes: int, eps: float = 1e-6):
+        super().__init__()
+        self.norm = LayerNorm(hidden_size, bias=True, eps=eps)
+        self.classifier = nn.Linear(hidden_size, num_classes)
+
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        return self.classifier(self.norm(hidden_states).mean(dim=1))
+
+
+def requires_full_token_grid(config) -> bool:
+    """
+    Whether the encoder of `config` only works on the full token grid, so that patches cannot be dropped or merged:
+    grid scans, compression (the length must be a multiple of the block size), grid attention hybrid layers,
+    patch merging between stages or reversible blocks.
+    """
+    return (
+        scan_requires_full_grid(config)
+        or getattr(config, "compress_attention", False)
+        or (
+            getattr(config, "attn", None) is not None
+            and getattr(config, "attn_type", None) in GRID_ATTN_LISTS
+        )
+        or getattr(config, "stages", None) is not None
+        or getattr(config, "reversible", False)
+    )
+
+
+def get_early_exit_heads(config) -> Optional[nn.ModuleDict]:
+    """
+    One `EarlyExitHead` per block index in `config.early_exit_layers`, keyed by the index as a string.
+    """
+    if not getattr(config, "early_exit_layers", None):
+        return None
+    if config.num_classes < 2:
+        raise ValueError("Early exit needs a classification head with at least 2 classes")
+    if getattr(config, "reversible", False):
+        raise ValueError("Early exit is not supported with reversible blocks")
+    for layer_idx in config.early_exit_layers:
+        if not 0 <= layer_idx < config.num_hidden_layers - 1:
+            raise ValueError(
+                f"Early exit layers must be in [0, {config.num_hidden_layers - 1}), got {layer_idx}"
+            )
+    return nn.ModuleDict(
+        {
+            str(layer_idx): EarlyExitHead(
+                config.hidden_size, config.num_classes, eps=config.layer_norm_eps
+            )
+            for layer_idx in config.early_exit_layers
+        }
+    )
+
+
+def classification_loss(
+    logits: torch.Tensor, labels: torch.Tensor, num_labels: int
+) -> torch.Tensor:
+    """
+    Regression (MSE) loss for a single label, cross-entropy otherwise; shared by the classifiers and their exit heads.
+    """
+    if num_labels == 1:
+        return nn.functional.mse_loss(logits.squeeze(), labels.squeeze())
+    return nn.functional.cross_entropy(logits.view(-1, num_labels), labels.view(-1))
+
+
+@dataclass
+class ImageDecoderOutput(ModelOutput):
+    logits: torch.FloatTensor = None
+    hidden_states: Optional[Tuple[torch.FloatTensor]] = None
+    attentions: Optional[Tuple[torch.FloatTensor]] = None
+
+
+@dataclass
+class StagedEncoderOutput(ModelOutput):
+    """
+    Output of a hierarchical encoder, `stage_hidden_states` holds the last hidden states of every stage `i`,
+    of shape `(batch_size, ceil(h / 2**i) * ceil(w / 2**i), stage_hidden_size)` for a `h x w` patch grid.
+    """
+
+    last_hidden_state: torch.FloatTensor = None
+    hidden_states: Optional[Tuple[torch.FloatTensor]] = None
+    attentions: Optional[Tuple[torch.FloatTensor]] = None
+    stage_hidden_states: Optional[Tuple[torch.FloatTensor]] = None
+
+
+@dataclass
+class StagedModelOutputWithPooling(ModelOutput):
+    last_hidden_state: torch.FloatTensor = None
+    pooler_output: Optional[torch.FloatTensor] = None
+    hidden_states: Optional[Tuple[torch.FloatTensor]] = None
+    attentions: Optional[Tuple[torch.FloatTensor]] = None
+    stage_hidden_states: Optional[Tuple[torch.FloatTensor]] = None
+
+
+@dataclass
+class HiddenStateTap:
+    """
+    Keep the output of one block, instead of every hidden state with `output_hidden_states=True`.
+
+    Args:
+        layer: block index, negative indices count from the last block
+        pool: mean pool over the tokens, [B, D] instead of [B, L, D] (one row per packed sequence)
+        dtype: cast the tap, e.g. `torch.bfloat16`
+        offload: copy the tap to (pinned) CPU memory without blocking, offloaded taps are detached
+    """
+
+    layer: int
+    pool: bool = False
+    dtype: Optional[torch.dtype] = None
+    offload: bool = False
+
+    def __call__(
+        self, hidden_states: torch.Tensor, cu_seqlens: Optional[torch.LongTensor] = None
+    ) -> torch.Tensor:
+        if self.pool:
+            hidden_states = mean_pool(hidden_states, cu_seqlens)
+        if self.dtype is not None:
+            hidden_states = hidden_states.to(self.dtype)
+        if self.offload:
+            hidden_states = hidden_states.detach()
+            if hidden_states.is_cuda:
+                tap = torch.empty(
+                    hidden_states.shape,
+                    dtype=hidden_states.dtype,
+                    device="cpu",
+                    pin_memory=True,
+                )
+                hidden_states = tap.copy_(hidden_states, non_blocking=True)
+        return hidden_states
+
+
+def get_hidden_state_taps(
+    taps: Optional[List[Any]], num_layers: int
+) -> Optional[List[HiddenStateTap]]:
+    """
+    Normalize taps given as block indices or `HiddenStateTap`s, with non-negative layer indices.
+    """
+    if taps is None:
+        return None
+    normalized = []
+    for tap in taps:
+        tap = tap if isinstance(tap, HiddenStateTap) else HiddenStateTap(layer=tap)
+        layer = tap.layer + num_layers if tap.layer < 0 else tap.layer
+        if not 0 <= layer < num_layers:
+            raise ValueError(f"Tap layer {tap.layer} is out of range for {num_layers} layers")
+        normalized.append(dataclasses.replace(tap, layer=layer))
+    return normalized
+
+
+@dataclass
+class EarlyExitClassifierOutput(ModelOutput):
+    """
+    Output of early-exit inference, `exit_layers` holds the index of the block after which every sample exited.
+    """
+
+    loss: Optional[torch.FloatTensor] = None
+    logits: torch.FloatTensor = None
+    exit_layers: torch.LongTensor = None
+
+
 """
 Video utilities, taken from https://github.com/huggingface/transformers/blob/main/src/transformers/models/videomae/modeling_videomae.py
 """
@@ -205,25 +697,188 @@ class VideoForPreTrainingOutput(ModelOutput):
     attentions: Optional[Tuple[torch.FloatTensor]] = None
 
 
-# sin-cos position encoding
-# https://github.com/jadore801120/attention-is-all-you-need-pytorch/blob/master/transformer/Models.py#L31
-def get_sinusoid_encoding_table(n_position, d_hid):
-    """Sinusoid position encoding table"""
+def gather_tubelets(
+    pixel_values: torch.Tensor,
+    indices: Optional[torch.LongTensor],
+    tubelet_size: int,
+    patch_size: Tuple[int, int],
+    channels_last: bool = False,
+) -> torch.Tensor:
+    """
+    Cut a clip into tubelets, only materializing the selected ones.
 
-    # TODO: make it with torch instead of numpy
-    def get_position_angle_vec(position):
-        return [
-            position / np.power(10000, 2 * (hid_j // 2) / d_hid)
-            for hid_j in range(d_hid)
-        ]
+    Args:
+        pixel_values: [B, T, C, H, W]
+        indices: [B, n] flat (t, h, w) positions of the tubelets to keep, or None to keep all of them
+        tubelet_size: number of frames per tubelet
+        patch_size: (patch_height, patch_width)
+        channels_last: return the pixels of a tubelet as (t, ph, pw, C) instead of (C, t, ph, pw)
 
-    sinusoid_table = np.array(
-        [get_position_angle_vec(pos_i) for pos_i in range(n_position)]
+    Returns:
+        [B, n, C, t, ph, pw], or [B, n, t, ph, pw, C] if channels_last
+    """
+    batch_size, num_frames, num_channels, height, width = pixel_values.shape
+    patch_height, patch_width = patch_size
+    grid_time = num_frames // tubelet_size
+    grid_height, grid_width = height // patch_height, width // patch_width
+    # drop what the strided convolution would drop, a no-op (and a view) for well-sized clips
+    pixel_values = pixel_values[
+        :,
+        : grid_time * tubelet_size,
+        :,
+        : grid_height * patch_height,
+        : grid_width * patch_width,
+    ]
+    # [B, T', t, C, H', ph, W', pw]
+    tubelets = pixel_values.reshape(
+        batch_size,
+        grid_time,
+        tubelet_size,
+        num_channels,
+        grid_height,
+        patch_height,
+        grid_width,
+        patch_width,
     )
-    sinusoid_table[:, 0::2] = np.sin(sinusoid_table[:, 0::2])  # dim 2i
-    sinusoid_table[:, 1::2] = np.cos(sinusoid_table[:, 1::2])  # dim 2i+1
+    if indices is None:
+        permutation = (
+            (0, 1, 4, 6, 2, 5, 7, 3) if channels_last else (0, 1, 4, 6, 3, 2, 5, 7)
+        )
+        tubelets = tubelets.permute(*permutation)
+        return tubelets.reshape(
+            batch_size, grid_time * grid_height * grid_width, *tubelets.shape[4:]
+        )
+
+    time_idx = indices // (grid_height * grid_width)
+    height_idx = (indices // grid_width) % grid_height
+    width_idx = indices % grid_width
+    batch_idx = torch.arange(batch_size, device=indices.device)[:, None]
+    # advanced indexing only reads the selected tubelets: [B, n, t, C, ph, pw]
+    tubelets = tubelets[batch_idx, time_idx, :, :, height_idx, :, width_idx, :]
+    if channels_last:
+        return tubelets.permute(0, 1, 2, 4, 5, 3)
+    return tubelets.permute(0, 1, 3, 2, 4, 5)
+
+
+def sample_video_mask_indices(
+    batch_size: int,
+    grid_thw: Tuple[int, int, int],
+    mask_ratio: float = 0.9,
+    mask_type: str = "tube",
+    generator: Optional[torch.Generator] = None,
+    device: Optional[torch.device] = None,
+) -> Tuple[torch.LongTensor, torch.LongTensor]:
+    """
+    Sample VideoMAE masks for a whole batch at once, directly as index tensors.
+
+    Args:
+        batch_size: number of masks to sample
+        grid_thw: (T', H', W') tubelet grid of the clip
+        mask_ratio: fraction of the tubelets to mask
+        mask_type: "tube" masks the same spatial positions in every frame, "random" masks tubelets independently
+        generator: random generator for reproducible masks, must live on `device`
+        device: device of the outputs
+
+    Returns:
+        visible_indices: [B, num_visible], sorted positions of the visible tubelets
+        masked_indices: [B, num_masked], sorted positions of the masked tubelets
+    """
+    grid_time, grid_height, grid_width = grid_thw
+    if mask_type == "tube":
+        num_positions = grid_height * grid_width
+    elif mask_type == "random":
+        num_positions = grid_time * grid_height * grid_width
+    else:
+        raise ValueError(f"Unknown mask_type: {mask_type}, expected 'tube' or 'random'")
+    num_masked = int(mask_ratio * num_positions)
 
-    return torch.FloatTensor(sinusoid_table).unsqueeze(0)
+    # a random permutation per sample, its head is masked and its tail is visible
+    noise = torch.rand(batch_size, num_positions, generator=generator, device=device)
+    order = noise.argsort(dim=1)
+    masked_indices = order[:, :num_masked].sort(dim=1).values
+    visible_indices = order[:, num_masked:].sort(dim=1).values
+
+    if mask_type == "tube":
+        # repeat the spatial positions in every frame, frames first as in the token order
+        offsets = torch.arange(grid_time, device=order.device) * num_positions
+        masked_indices = (offsets[None, :, None] + masked_indices[:, None]).flatten(1)
+        visible_indices = (offsets[None, :, None] + visible_indices[:, None]).flatten(1)
+    return visible_indices, masked_indices
+
+
+def get_video_patch_targets(
+    pixel_values: torch.Tensor,
+    masked_indices: torch.LongTensor,
+    config,
+) -> torch.Tensor:
+    """
+    VideoMAE reconstruction targets, computed for the masked tubelets only.
+    Adapted from https://github.com/huggingface/transformers/blob/main/src/transformers/models/videomae/modeling_videomae.py#L730
+
+    Args:
+        pixel_values: [B, T, C, H, W], normalized floats or raw uint8 pixels
+        masked_indices: [B, n] positions of the masked tubelets
+
+    Returns:
+        labels: [B, n, tubelet_size * patch_size * patch_size * num_channels]
+    """
+    patch_size = config.patch_size
+    # [B, n, t, ph, pw, C]
+    frames = gather_tubelets(
+        pixel_values,
+        masked_indices,
+        config.tubelet_size,
+        (patch_size, patch_size),
+        channels_last=True,
+    )
+    if pixel_values.dtype == torch.uint8:
+        # raw frames, only rescale to [0, 1]
+        frames = frames.float() / 255.0
+    elif config.num_channels == 3:
+        # unnormalize the frames
+        mean = torch.as_tensor(
+            IMAGENET_DEFAULT_MEAN, device=frames.device, dtype=frames.dtype
+        )
+        std = torch.as_tensor(
+            IMAGENET_DEFAULT_STD, device=frames.device, dtype=frames.dtype
+        )
+        frames = frames * std + mean  # in [0, 1]
+    # else: can't unnormalize with default means/stds
+
+    batch_size, num_masked = frames.shape[:2]
+    if config.norm_pix_loss:
+        # normalize each tubelet per channel.
+        # The authors find that the mean is about 0.48 and standard deviation is about 0.08.
+        frames = frames.reshape(batch_size, num_masked, -1, config.num_channels)
+        frames = (frames - frames.mean(dim=-2, keepdim=True)) / (
+            frames.var(dim=-2, unbiased=True, keepdim=True).sqrt() + 1e-6
+        )
+    elif config.num_channels != 3:
+        raise ValueError(
+            "Can't unnormalize non-RGB images. Consider setting config.norm_pix_loss to False."
+        )
+    return frames.reshape(batch_size, num_masked, -1)
+
+
+# sin-cos position encoding
+# https://github.com/jadore801120/attention-is-all-you-need-pytorch/blob/master/transformer/Models.py#L31
+@functools.lru_cache(maxsize=None)
+def _sinusoid_encoding_table(n_position: int, d_hid: int) -> torch.Tensor:
+    position = torch.arange(n_position, dtype=torch.float64)[:, None]
+    # 10000^(2 * (j // 2) / d_hid) for every hidden dim j
+    inv_freq = torch.pow(
+        10000.0, 2 * (torch.arange(d_hid, dtype=torch.float64) // 2) / d_hid
+    )
+    sinusoid_table = position / inv_freq
+    sinusoid_table[:, 0::2] = torch.sin(sinusoid_table[:, 0::2])  # dim 2i
+    sinusoid_table[:, 1::2] = torch.cos(sinusoid_table[:, 1::2])  # dim 2i+1
+    return sinusoid_table.float().unsqueeze(0)
+
+
+def get_sinusoid_encoding_table(n_position, d_hid):
+    """Sinusoid position encoding table of shape [1, n_position, d_hid], memoized per (n_position, d_hid)"""
+    # clone so that callers (and buffers moved in-place) never alias the memoized table
+    return _sinusoid_encoding_table(int(n_position), int(d_hid)).clone()
 
 
 class VideoEmbeddings(nn.Module):
@@ -237,30 +892,26 @@ class VideoEmbeddings(nn.Module):
 
         self.patch_embeddings = VideoPatchEmbeddings(config)
         self.num_patches = self.patch_embeddings.num_patches
-        # fixed sin-cos embedding
-        self.position_embeddings = get_sinusoid_encoding_table(
-            self.num_patches, config.hidden_size
+        # fixed sin-cos embedding, built once and moved along with the model
+        self.register_buffer(
+            "position_embeddings",
+            get_sinusoid_encoding_table(self.num_patches, config.hidden_size),
+            persistent=False,
         )
         self.config = config
 
-    def forward(self, pixel_values, bool_masked_pos):
-        # create patch embeddings
-        embeddings = self.patch_embeddings(pixel_values)
-
-        # add position embeddings
-        embeddings = (
-            embeddings
-            + self.position_embeddings.type_as(embeddings)
-            .to(embeddings.device)
-            .clone()
-            .detach()
+    def forward(self, pixel_values, bool_masked_pos=None, visible_indices=None):
+        # only embed visible patches
+        # ~bool_masked_pos means visible, `visible_indices` spares the host sync of converting the mask
+        if visible_indices is None and bool_masked_pos is not None:
+            visible_indices, _ = mask_to_indices(bool_masked_pos)
+
+        # create patch embeddings, with the position embeddings added in the projection
+        embeddings = self.patch_embeddings(
+            pixel_values,
+            position_embeddings=self.position_embeddings,
+            patch_indices=visible_indices,
         )
-        # only keep visible patches
-        # ~bool_masked_pos means visible
-        if bool_masked_pos is not None:
-            batch_size, _, num_channels = embeddings.shape
-            embeddings = embeddings[~bool_masked_pos]
-            embeddings = embeddings.reshape(batch_size, -1, num_channels)
 
         return embeddings
 
@@ -311,8 +962,37 @@ class VideoPatchEmbeddings(nn.Module):
             kernel_size=(self.tubelet_size, patch_size[0], patch_size[1]),
             stride=(self.tubelet_size, patch_size[0], patch_size[1]),
         )
+        # statistics of uint8 inputs, folded into the projection
+        pixel_mean, pixel_std = get_pixel_statistics(config, num_channels)
+        self.register_buffer("pixel_mean", pixel_mean, persistent=False)
+        self.register_buffer("pixel_std", pixel_std, persistent=False)
+
+    def normalize(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        """
+        Normalize uint8 frames [B, T, C, H, W] the way the projection expects them, float inputs are returned as is.
+        """
+        if pixel_values.dtype != torch.uint8:
+            return pixel_values
+        mean = self.pixel_mean.view(1, 1, -1, 1, 1)
+        std = self.pixel_std.view(1, 1, -1, 1, 1)
+        return (pixel_values.to(mean.dtype) / 255.0 - mean) / std
 
-    def forward(self, pixel_values):
+    def forward(
+        self,
+        pixel_values: torch.Tensor,
+        position_embeddings: Optional[torch.Tensor] = None,
+        patch_indices: Optional[torch.LongTensor] = None,
+    ) -> torch.Tensor:
+        """
+        Args:
+            pixel_values: [B, T, C, H, W], normalized floats or raw uint8 pixels
+            position_embeddings: [1, N, hidden_size], added to the output if given
+            patch_indices: [B, n], only embed these tubelets (e.g. the visible ones), in this order
+
+        Tubelets are gathered with a single reshape of the clip (as bytes for uint8 inputs) and projected with one GEMM,
+        instead of permuting the whole clip to channels-first for a Conv3d.
+        For uint8 inputs the normalization is folded into the projection weights.
+        """
         batch_size, num_frames, num_channels, height, width = pixel_values.shape
         if num_channels != self.num_channels:
             raise ValueError(
@@ -322,7 +1002,28 @@ class VideoPatchEmbeddings(nn.Module):
             raise ValueError(
                 f"Input image size ({height}*{width}) doesn't match model ({self.image_size[0]}*{self.image_size[1]})."
             )
-        # permute to (batch_size, num_channels, num_frames, height, width)
-        pixel_values = pixel_values.permute(0, 2, 1, 3, 4)
-        embeddings = self.projection(pixel_values).flatten(2).transpose(1, 2)
-        return embeddings
+        if patch_indices is not None and position_embeddings is not None:
+            position_embeddings = gather_tokens(position_embeddings, patch_indices)
+
+        if self.projection.stride != self.projection.kernel_size:
+            # permute to (batch_size, num_channels, num_frames, height, width)
+            pixel_values = self.normalize(pixel_values).permute(0, 2, 1, 3, 4)
+            embeddings = self.projection(pixel_values).flatten(2).transpose(1, 2)
+            if patch_indices is not None:
+                embeddings = gather_tokens(embeddings, patch_indices)
+            if position_embeddings is not None:
+                embeddings = embeddings + position_embeddings.type_as(embeddings)
+            return embeddings
+
+        # [B, n, C * t * ph * pw], the Conv3d weight layout
+        patches = gather_tubelets(
+            pixel_values, patch_indices, self.tubelet_size, self.patch_size
+        ).reshape(batch_size, -1, self.projection.weight[0].numel())
+        weight, bias = self.projection.weight, self.projection.bias
+        if pixel_values.dtype == torch.uint8:
+            weight, bias = fold_pixel_normalization(
+                weight, bias, self.pixel_mean, self.pixel_std
+            )
+        return patch_projection(
+            patches.to(weight.dtype), weight.flatten(1), bias, position_embeddings
+        )
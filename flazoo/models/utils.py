@@ -6,7 +6,8 @@ import torch
 from transformers.utils import logging
 import warnings
 import torch.nn as nn
-from typing import TYPE_CHECKING, Optional, Tuple, Union
+from typing import TYPE_CHECKING, Callable, Optional, Tuple, Union
+from fla.modules.layernorm import LayerNorm as FLALayerNorm, RMSNorm as FLARMSNorm
 from ..helpers.scanner import cross_scan_fn, cross_merge_fn
 from ..helpers.scanner import multi_head_2d_scan
 from ..helpers.scanner import multi_head_3d_scan
@@ -207,6 +208,116 @@ def prepare_hidden_states_for_merge(
     return hidden_states
 
 
+"""
+Scans over packed sequences, i.e. several images concatenated into a single [1, T, D] sequence delimited by `cu_seqlens`.
+Every sequence is scanned on its own, so that the result matches running the images one by one.
+"""
+
+PACKED_SCAN_TYPES = ("uni-scan", "random-scan", "flip-scan", "1d-shift-scan", "bi-scan")
+
+
+def _packed_positions(
+    cu_seqlens: torch.LongTensor, total_len: int
+) -> Tuple[torch.LongTensor, torch.LongTensor]:
+    # start offset and length of the sequence of every token
+    seqlens = cu_seqlens[1:] - cu_seqlens[:-1]
+    seq_ids = torch.repeat_interleave(
+        torch.arange(seqlens.numel(), device=cu_seqlens.device),
+        seqlens,
+        output_size=total_len,
+    )
+    return cu_seqlens[:-1][seq_ids], seqlens[seq_ids]
+
+
+def packed_flip_indices(cu_seqlens: torch.LongTensor, total_len: int) -> torch.LongTensor:
+    """
+    Indices that reverse every packed sequence in place: [T]
+    """
+    starts, seqlens = _packed_positions(cu_seqlens, total_len)
+    positions = torch.arange(total_len, device=cu_seqlens.device)
+    return 2 * starts + seqlens - 1 - positions
+
+
+def packed_roll_indices(
+    cu_seqlens: torch.LongTensor, total_len: int, shift: int
+) -> torch.LongTensor:
+    """
+    Indices that roll every packed sequence by `shift`, like `torch.roll(x, shift, dims=1)` on each of them: [T]
+    """
+    starts, seqlens = _packed_positions(cu_seqlens, total_len)
+    positions = torch.arange(total_len, device=cu_seqlens.device)
+    return starts + torch.remainder(positions - starts - shift, seqlens)
+
+
+def prepare_packed_hidden_states_for_scan(
+    hidden_states: torch.Tensor,
+    cu_seqlens: torch.LongTensor,
+    train_scan_type: str = "uni-scan",
+    test_scan_type: str = "uni-scan",
+    training: bool = True,
+) -> Tuple[torch.Tensor, torch.LongTensor]:
+    """
+    `prepare_hidden_states_for_scan` for packed sequences.
+
+    Args:
+        hidden_states: [1, T, D]
+        cu_seqlens: [N + 1], boundaries of the N packed sequences
+
+    Returns:
+        The hidden states to scan, and the `cu_seqlens` to call the token mixer with
+    """
+    scan_type = train_scan_type if training else test_scan_type
+    if scan_type not in PACKED_SCAN_TYPES:
+        raise ValueError(
+            f"{scan_type} is not supported for packed sequences, expected one of {PACKED_SCAN_TYPES}"
+        )
+    total_len = hidden_states.shape[1]
+    if scan_type == "random-scan":
+        # a random permutation within every sequence
+        starts, _ = _packed_positions(cu_seqlens, total_len)
+        noise = torch.rand(total_len, device=hidden_states.device)
+        return hidden_states[:, torch.argsort(starts + noise)], cu_seqlens
+    elif scan_type == "flip-scan":
+        return hidden_states[:, packed_flip_indices(cu_seqlens, total_len)], cu_seqlens
+    elif scan_type == "bi-scan":
+        # the flipped copies are packed after the originals, instead of stacked along the batch
+        flipped_hidden_states = hidden_states[:, packed_flip_indices(cu_seqlens, total_len)]
+        hidden_states = torch.cat([hidden_states, flipped_hidden_states], dim=1)
+        cu_seqlens = torch.cat([cu_seqlens, cu_seqlens[1:] + total_len])
+        return hidden_states, cu_seqlens
+    # uni-scan and 1d-shift-scan
+    return hidden_states, cu_seqlens
+
+
+def prepare_packed_hidden_states_for_merge(
+    hidden_states: torch.Tensor,
+    cu_seqlens: torch.LongTensor,
+    train_scan_type: str = "uni-scan",
+    test_scan_type: str = "uni-scan",
+    training: bool = True,
+    layer_idx: Optional[int] = None,
+) -> torch.Tensor:
+    """
+    `prepare_hidden_states_for_merge` for packed sequences.
+
+    Args:
+        hidden_states: output of the token mixer
+        cu_seqlens: [N + 1], boundaries of the N packed sequences, as given to `prepare_packed_hidden_states_for_scan`
+
+    Returns:
+        [1, T, D]
+    """
+    scan_type = train_scan_type if training else test_scan_type
+    if scan_type == "1d-shift-scan":
+        return hidden_states[
+            :, packed_roll_indices(cu_seqlens, hidden_states.shape[1], layer_idx)
+        ]
+    elif scan_type == "bi-scan":
+        total_len = hidden_states.shape[1] // 2
+        return hidden_states[:, :total_len] + hidden_states[:, total_len:]
+    return hidden_states
+
+
 """
 Copied from https://github.com/MoonshotAI/MoBA/blob/master/moba/moba_efficient.py
 Huge thanks to MoonshotAI for their great work!
@@ -305,3 +416,334 @@ def decompress_seq(compressed_seq: torch.Tensor, block_size: int) -> torch.Tenso
     # Reshape back to original sequence shape
     # [B, L, D]
     return repeated.reshape(B, num_blocks * block_size, D)
+
+
+def fold_video_tokens(
+    hidden_states: torch.Tensor, grid_thw: Tuple[int, int, int], axis: str
+) -> torch.Tensor:
+    """
+    Fold a clip [B, T*H*W, D] (frame-major) into shorter sequences for the factorized blocks:
+        "spatial": one sequence per frame, [B*T, H*W, D]
+        "temporal": one sequence over time per spatial location, [B*H*W, T, D]
+    """
+    t, h, w = grid_thw
+    if axis == "spatial":
+        return einops.rearrange(hidden_states, "b (t hw) d -> (b t) hw d", t=t)
+    return einops.rearrange(hidden_states, "b (t hw) d -> (b hw) t d", t=t)
+
+
+def unfold_video_tokens(
+    hidden_states: torch.Tensor, grid_thw: Tuple[int, int, int], axis: str
+) -> torch.Tensor:
+    """
+    Inverse of `fold_video_tokens`, back to [B, T*H*W, D].
+    """
+    t, h, w = grid_thw
+    if axis == "spatial":
+        return einops.rearrange(hidden_states, "(b t) hw d -> b (t hw) d", t=t)
+    return einops.rearrange(hidden_states, "(b hw) t d -> b (t hw) d", hw=h * w)
+
+
+def add_norm(
+    norm: nn.Module, hidden_states: torch.Tensor, residual: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Residual add followed by a norm: returns `norm(residual + hidden_states)` and `residual + hidden_states`.
+    The fla LayerNorm / RMSNorm prenorm-residual kernels do both in one pass over the tensors,
+    other norms and non-CUDA tensors fall back to pure torch.
+
+    The blocks use it for the residual add of the token mixer before ln_2. The residual add after the channel mixer
+    stays a separate pass: the block outputs are read between blocks (hidden states, taps, token merging,
+    patch merging, exit heads, routing), so it is not deferred into the ln_1 of the next block.
+    """
+    if isinstance(norm, (FLALayerNorm, FLARMSNorm)) and hidden_states.is_cuda:
+        return norm(hidden_states, residual=residual, prenorm=True)
+    residual = residual + hidden_states
+    if isinstance(norm, FLALayerNorm):
+        return (
+            nn.functional.layer_norm(
+                residual, (norm.hidden_size,), norm.weight, norm.bias, norm.eps
+            ),
+            residual,
+        )
+    if isinstance(norm, FLARMSNorm):
+        x = residual.float()
+        x = x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + norm.eps)
+        if norm.weight is not None:
+            x = x * norm.weight.float()
+        if norm.bias is not None:
+            x = x + norm.bias.float()
+        return x.to(residual.dtype), residual
+    return norm(residual), residual
+
+
+"""
+Index-based token selection, used for masking and token dropping.
+Gathering by index keeps the shapes static, whereas boolean indexing needs a device-to-host sync to size its output.
+"""
+
+
+def mask_to_indices(
+    bool_masked_pos: torch.BoolTensor,
+) -> Tuple[torch.LongTensor, torch.LongTensor]:
+    """
+    Split a boolean mask into sorted index tensors of the visible and masked tokens.
+    Every sample must have the same number of masked tokens. Sizing the outputs needs one host sync.
+
+    Args:
+        bool_masked_pos: [B, L], True for masked tokens
+    Returns:
+        visible_indices: [B, L - num_masked]
+        masked_indices: [B, num_masked]
+    """
+    seq_len = bool_masked_pos.shape[1]
+    num_masked = int(bool_masked_pos[0].sum())
+    # a stable sort keeps the visible (0) tokens first, each group in increasing position
+    order = torch.argsort(bool_masked_pos.int(), dim=1, stable=True)
+    return order[:, : seq_len - num_masked], order[:, seq_len - num_masked :]
+
+
+def gather_tokens(hidden_states: torch.Tensor, indices: torch.LongTensor) -> torch.Tensor:
+    """
+    Select tokens by index.
+
+    Args:
+        hidden_states: [B, L, D], or [1, L, D] shared by the batch (e.g. position embeddings)
+        indices: [B, n]
+    Returns:
+        [B, n, D]
+    """
+    batch_size, num_tokens = indices.shape
+    hidden_states = hidden_states.expand(batch_size, -1, -1)
+    return hidden_states.gather(
+        1, indices.unsqueeze(-1).expand(batch_size, num_tokens, hidden_states.shape[-1])
+    )
+
+
+def scatter_tokens(
+    hidden_states: torch.Tensor, indices: torch.LongTensor, updates: torch.Tensor
+) -> torch.Tensor:
+    """
+    Write tokens back by index, the inverse of `gather_tokens`. Out of place, so that autograd goes through both inputs.
+
+    Args:
+        hidden_states: [B, L, D]
+        indices: [B, n]
+        updates: [B, n, D]
+    Returns:
+        [B, L, D]
+    """
+    return hidden_states.scatter(
+        1, indices.unsqueeze(-1).expand_as(updates), updates.to(hidden_states.dtype)
+    )
+
+
+def sample_patch_dropout_indices(
+    batch_size: int,
+    seq_len: int,
+    drop_ratio: float,
+    generator: Optional[torch.Generator] = None,
+    device: Optional[torch.device] = None,
+) -> torch.LongTensor:
+    """
+    Patch dropout: keep a random subset of the tokens of each sample.
+
+    Returns:
+        [B, seq_len - int(drop_ratio * seq_len)], sorted so that the kept tokens stay in scan order
+    """
+    num_kept = seq_len - int(drop_ratio * seq_len)
+    noise = torch.rand(batch_size, seq_len, generator=generator, device=device)
+    return noise.argsort(dim=1)[:, :num_kept].sort(dim=1).values
+
+
+def bipartite_merge(
+    hidden_states: torch.Tensor,
+    size: torch.Tensor,
+    token_map: torch.LongTensor,
+    r: int,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.LongTensor]:
+    """
+    Token merging (ToMe) with bipartite soft matching, see https://arxiv.org/abs/2210.09461
+    The tokens are split into alternating sets A and B, and the r tokens of A most similar to B are averaged into
+    their best match, weighted by the number of original tokens each of them holds.
+    Unlike ToMe, the remaining tokens stay in scan order, which matters to the recurrent token mixers.
+
+    Args:
+        hidden_states: [B, L, D]
+        size: [B, L, 1], number of original tokens merged into each token
+        token_map: [B, L0], index of the token that every original token has been merged into
+        r: number of tokens to remove, at most L // 2
+
+    Returns:
+        hidden_states: [B, L - r, D]
+        size: [B, L - r, 1]
+        token_map: [B, L0], gather the outputs with it to unmerge them
+    """
+    batch_size, seq_len, hidden_size = hidden_states.shape
+    r = min(r, seq_len // 2)
+    if r <= 0:
+        return hidden_states, size, token_map
+
+    metric = nn.functional.normalize(hidden_states, dim=-1)
+    scores = metric[:, ::2] @ metric[:, 1::2].transpose(-1, -2)
+    node_max, node_idx = scores.max(dim=-1)
+    edge_idx = node_max.argsort(dim=-1, descending=True)
+    unm_idx = edge_idx[:, r:]  # tokens of A that are kept
+    src_idx = edge_idx[:, :r]  # tokens of A that are merged
+    dst_idx = node_idx.gather(1, src_idx)  # and the tokens of B they are merged into
+
+    # size weighted average
+    weighted = hidden_states * size
+    x_a, x_b = weighted[:, ::2], weighted[:, 1::2]
+    size_a, size_b = size[:, ::2], size[:, 1::2]
+    x_b = x_b.scatter_add(
+        1,
+        dst_idx[..., None].expand(-1, -1, hidden_size),
+        x_a.gather(1, src_idx[..., None].expand(-1, -1, hidden_size)),
+    )
+    size_b = size_b.scatter_add(1, dst_idx[..., None], size_a.gather(1, src_idx[..., None]))
+
+    # restore the scan order of the kept tokens, by their position before merging
+    num_b = x_b.shape[1]
+    positions = torch.cat(
+        [
+            2 * unm_idx,
+            2 * torch.arange(num_b, device=unm_idx.device).expand(batch_size, -1) + 1,
+        ],
+        dim=1,
+    )
+    order = positions.argsort(dim=1)
+    x = torch.cat(
+        [x_a.gather(1, unm_idx[..., None].expand(-1, -1, hidden_size)), x_b], dim=1
+    )
+    size = torch.cat([size_a.gather(1, unm_idx[..., None]), size_b], dim=1)
+    x = gather_tokens(x, order)
+    size = size.gather(1, order[..., None])
+
+    # position before merging -> position after merging
+    new_positions = order.argsort(dim=1)
+    index_map = torch.empty(
+        batch_size, seq_len, dtype=torch.long, device=hidden_states.device
+    )
+    index_map.scatter_(1, positions, new_positions)
+    num_unm = unm_idx.shape[1]
+    index_map.scatter_(1, 2 * src_idx, new_positions.gather(1, num_unm + dst_idx))
+    return x / size, size, index_map.gather(1, token_map)
+
+
+def early_exit_forward(
+    hidden_states: torch.Tensor,
+    blocks: nn.ModuleList,
+    exit_heads: nn.ModuleDict,
+    classify: Callable[[torch.Tensor], torch.Tensor],
+    threshold: float,
+) -> Tuple[torch.Tensor, torch.LongTensor]:
+    """
+    Early-exit inference with batch compaction. After every block with an exit head, the samples whose softmax
+    confidence reaches `threshold` keep the logits of that head and are removed from the batch,
+    so the remaining blocks only run on the samples that still need them.
+
+    Args:
+        hidden_states: [B, L, D], the embeddings
+        blocks: the encoder blocks
+        exit_heads: exit classifiers, keyed by the index of the block they follow
+        classify: the final head, from the last hidden states to the logits
+        threshold: confidence threshold, shared by all the exits
+    Returns:
+        logits: [B, num_classes]
+        exit_layers: [B], index of the block each sample exited after
+    """
+    batch_size = hidden_states.shape[0]
+    device = hidden_states.device
+    active = torch.arange(batch_size, device=device)
+    exit_layers = torch.full((batch_size,), len(blocks) - 1, dtype=torch.long, device=device)
+    logits = None
+
+    for i, block in enumerate(blocks):
+        hidden_states = block(hidden_states)[0]
+        if str(i) not in exit_heads:
+            continue
+        exit_logits = exit_heads[str(i)](hidden_states)
+        if logits is None:
+            logits = exit_logits.new_zeros(batch_size, exit_logits.shape[-1])
+        done = exit_logits.softmax(dim=-1).amax(dim=-1) >= threshold
+        logits[active[done]] = exit_logits[done]
+        exit_layers[active[done]] = i
+        # sizing the compacted batch needs one host sync per exit
+        keep = (~done).nonzero().squeeze(-1)
+        active, hidden_states = active[keep], hidden_states[keep]
+        if active.numel() == 0:
+            return logits, exit_layers
+
+    final_logits = classify(hidden_states)
+    if logits is None:
+        logits = final_logits.new_zeros(batch_size, final_logits.shape[-1])
+    logits[active] = final_logits.to(logits.dtype)
+    return logits, exit_layers
+
+
+def route_top_k(
+    router_logits: torch.Tensor, capacity_ratio: float
+) -> Tuple[torch.LongTensor, torch.Tensor]:
+    """
+    Mixture-of-Depths routing, see https://arxiv.org/abs/2404.02258
+    The top `capacity_ratio` fraction of the tokens of each sequence goes through the block, the others skip it.
+
+    Args:
+        router_logits: [B, L]
+        capacity_ratio: fraction of the tokens routed through the block
+    Returns:
+        indices: [B, k], sorted so that the routed tokens stay in scan order
+        weights: [B, k, 1], sigmoid of their logits, scaling the block update so that the router is trained
+    """
+    num_routed = max(1, int(capacity_ratio * router_logits.shape[1]))
+    indices = router_logits.topk(num_routed, dim=-1).indices.sort(dim=-1).values
+    weights = torch.sigmoid(router_logits.gather(1, indices)).unsqueeze(-1)
+    return indices, weights
+
+
+# scans that fold the sequence into a square grid, or permute a fixed number of tokens
+FULL_GRID_SCAN_TYPES = (
+    "2d-shift-scan",
+    "switch-scan",
+    "mh2d-scan",
+    "mh3d-scan",
+    "cross-scan",
+    "learnable-scan",
+)
+
+
+def scan_requires_full_grid(config) -> bool:
+    """
+    Whether the scans of `config` only work on the full token grid, so that tokens cannot be dropped before the encoder.
+    """
+    return any(
+        getattr(config, name, None) in FULL_GRID_SCAN_TYPES
+        for name in ("train_scan_type", "test_scan_type")
+    )
+
+
+def sample_decoder_indices(
+    masked_indices: torch.LongTensor,
+    decoder_mask_ratio: float = 0.0,
+    generator: Optional[torch.Generator] = None,
+) -> torch.LongTensor:
+    """
+    Decoder masking (VideoMAE v2): keep a random subset of the masked tokens for the decoder to reconstruct.
+    The subset is uniform per sample, so the loss over it is an unbiased estimate of the loss over all masked tokens.
+
+    Args:
+        masked_indices: [B, num_masked]
+        decoder_mask_ratio: fraction of the masked tokens that are not reconstructed
+    Returns:
+        [B, num_masked - int(decoder_mask_ratio * num_masked)], sorted
+    """
+    batch_size, num_masked = masked_indices.shape
+    num_decoded = num_masked - int(decoder_mask_ratio * num_masked)
+    if num_decoded == num_masked:
+        return masked_indices
+    noise = torch.rand(
+        batch_size, num_masked, generator=generator, device=masked_indices.device
+    )
+    keep = noise.argsort(dim=1)[:, :num_decoded].sort(dim=1).values
+    return masked_indices.gather(1, keep)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import math
+
+import torch
+import torch.nn as nn
+
+from flazoo.helpers.cascade import ModelCascade, calibrate_threshold, max_softmax_confidence
+
+
+def test_max_softmax_confidence():
+    logits = torch.tensor([[0.0, 0.0], [10.0, 0.0]])
+    confidence = max_softmax_confidence(logits)
+    assert confidence[0].item() == 0.5
+    assert confidence[1].item() > 0.99
+
+
+def test_calibrate_threshold_selective_accuracy():
+    confidence = torch.tensor([0.9, 0.8, 0.7, 0.6])
+    small_correct = torch.tensor([True, True, False, True])
+    stats = calibrate_threshold(confidence, small_correct, target_accuracy=1.0)
+    # keeping the two most confident samples is the largest set that is always right
+    assert math.isclose(stats["threshold"], 0.8, rel_tol=1e-6)
+    assert stats["accuracy"] == 1.0
+    assert stats["escalation_rate"] == 0.5
+
+
+def test_calibrate_threshold_with_large_model():
+    confidence = torch.tensor([0.9, 0.8, 0.7, 0.6])
+    small_correct = torch.tensor([True, False, True, False])
+    large_correct = torch.tensor([True, True, True, True])
+    stats = calibrate_threshold(confidence, small_correct, 1.0, large_correct=large_correct)
+    assert math.isclose(stats["threshold"], 0.9, rel_tol=1e-6)
+    assert stats["escalation_rate"] == 0.75
+
+
+def test_calibrate_threshold_ties():
+    # a threshold keeps every sample with the same confidence, the tie cannot be split
+    confidence = torch.tensor([0.9, 0.8, 0.8])
+    small_correct = torch.tensor([True, True, False])
+    stats = calibrate_threshold(confidence, small_correct, 1.0)
+    assert math.isclose(stats["threshold"], 0.9, rel_tol=1e-6)
+
+
+def test_calibrate_threshold_unreachable():
+    confidence = torch.tensor([0.9, 0.8])
+    small_correct = torch.tensor([False, False])
+    large_correct = torch.tensor([True, False])
+    stats = calibrate_threshold(confidence, small_correct, 1.0, large_correct=large_correct)
+    assert stats["threshold"] == float("inf")
+    assert stats["escalation_rate"] == 1.0
+    assert stats["accuracy"] == 0.5
+
+
+def _cascade(large_batch_size=None):
+    torch.manual_seed(0)
+    return ModelCascade(
+        nn.Linear(8, 5), nn.Linear(8, 5), threshold=0.3, large_batch_size=large_batch_size
+    )
+
+
+def test_cascade_escalates_low_confidence():
+    cascade = _cascade()
+    pixel_values = torch.randn(16, 8)
+    output = cascade(pixel_values)
+    small_logits = cascade.small_model(pixel_values)
+    large_logits = cascade.large_model(pixel_values)
+    assert output.escalated.any() and not output.escalated.all()
+    expected = torch.where(output.escalated[:, None], large_logits, small_logits)
+    torch.testing.assert_close(output.logits, expected)
+
+
+def test_cascade_run_matches_call():
+    cascade = _cascade(large_batch_size=3)
+    batches = [torch.randn(4, 8) for _ in range(5)]
+    outputs = list(cascade.run(batches))
+    assert len(outputs) == len(batches)
+    for output, pixel_values in zip(outputs, batches):
+        expected = cascade(pixel_values)
+        torch.testing.assert_close(output.logits, expected.logits)
+        assert torch.equal(output.escalated, expected.escalated)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import torch
+import torch.nn as nn
+
+from flazoo.layers.checkpointing import CheckpointPolicy, sequence_chunked_forward
+
+
+def test_policy_validation():
+    with pytest.raises(ValueError):
+        CheckpointPolicy(channel_mixer="drop")
+    assert CheckpointPolicy.from_config(None) is None
+    policy = CheckpointPolicy.from_config({"token_mixer": "recompute"})
+    assert policy.token_mixer == "recompute" and policy.channel_mixer == "save"
+    assert CheckpointPolicy.from_config(policy) is policy
+    with pytest.raises(ValueError):
+        CheckpointPolicy.from_config("recompute")
+
+
+def _branch_grads(policy, residual):
+    torch.manual_seed(0)
+    norm = nn.LayerNorm(8)
+    mlp = nn.Sequential(nn.Linear(8, 32), nn.GELU(), nn.Linear(32, 8))
+    hidden_states = torch.randn(2, 6, 8, requires_grad=True)
+    residual_states = torch.randn(2, 6, 8, requires_grad=True) if residual else None
+    out = policy.run_branch(
+        "channel_mixer", norm, mlp, hidden_states, residual=residual_states
+    )
+    if residual:
+        out, new_residual = out
+        (out.sum() + new_residual.pow(2).sum()).backward()
+    else:
+        out.pow(2).sum().backward()
+    params = [p.grad for p in list(norm.parameters()) + list(mlp.parameters())]
+    return [out.detach(), hidden_states.grad] + params
+
+
+@pytest.mark.parametrize("residual", [False, True])
+@pytest.mark.parametrize(
+    "modes",
+    [("recompute", "recompute"), ("recompute", "save"), ("offload", "save"), ("save", "offload")],
+)
+def test_run_branch_matches_save(modes, residual):
+    channel_mixer, norms = modes
+    reference = _branch_grads(CheckpointPolicy(), residual)
+    grads = _branch_grads(CheckpointPolicy(channel_mixer=channel_mixer, norms=norms), residual)
+    for a, b in zip(grads, reference):
+        torch.testing.assert_close(a, b)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 2, 3, 100])
+def test_sequence_chunked_forward(chunk_size):
+    torch.manual_seed(0)
+    mlp = nn.Sequential(nn.LayerNorm(4), nn.Linear(4, 16), nn.GELU(), nn.Linear(16, 4))
+    hidden_states = torch.randn(2, 7, 4, requires_grad=True)
+
+    out = sequence_chunked_forward(mlp, hidden_states, chunk_size)
+    out.pow(2).sum().backward()
+    grads = [hidden_states.grad.clone()] + [p.grad.clone() for p in mlp.parameters()]
+
+    hidden_states.grad = None
+    mlp.zero_grad()
+    expected = mlp(hidden_states)
+    expected.pow(2).sum().backward()
+    torch.testing.assert_close(out, expected)
+    for a, b in zip(grads, [hidden_states.grad] + [p.grad for p in mlp.parameters()]):
+        torch.testing.assert_close(a, b)
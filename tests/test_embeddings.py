@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import torch
+
+from flazoo.models.configs import FLAVisionConfig
+from flazoo.models.und.utils import ImageEmbeddings
+
+
+def _embeddings(**kwargs):
+    config = FLAVisionConfig(hidden_size=8, num_heads=2, image_size=16, patch_size=4, **kwargs)
+    return ImageEmbeddings(config)
+
+
+def test_pos_encoding_cache_hit():
+    embeddings = _embeddings()
+    x = torch.zeros(1, 1, 8)
+    with torch.no_grad():
+        first = embeddings.interpolate_pos_encoding(x, 32, 32)
+        assert embeddings.interpolate_pos_encoding(x, 32, 32) is first
+    assert first.shape == (1, 64, 8)
+
+
+def test_pos_encoding_cache_invalidation():
+    embeddings = _embeddings()
+    x = torch.zeros(1, 1, 8)
+    with torch.no_grad():
+        first = embeddings.interpolate_pos_encoding(x, 32, 32)
+        # in-place updates (optimizer steps, load_state_dict) bump the version of the parameter
+        embeddings.position_embeddings.add_(1.0)
+        second = embeddings.interpolate_pos_encoding(x, 32, 32)
+    assert second is not first
+    torch.testing.assert_close(second, first + 1.0)
+
+
+def test_pos_encoding_cache_lru_eviction():
+    embeddings = _embeddings(pos_encoding_cache_size=2)
+    x = torch.zeros(1, 1, 8)
+    with torch.no_grad():
+        for size in (20, 24, 28):
+            embeddings.interpolate_pos_encoding(x, size, size)
+        assert [key[:2] for key in embeddings._pos_encoding_cache] == [(6, 6), (7, 7)]
+        # a hit moves the entry to the end
+        embeddings.interpolate_pos_encoding(x, 24, 24)
+        embeddings.interpolate_pos_encoding(x, 32, 32)
+    assert [key[:2] for key in embeddings._pos_encoding_cache] == [(6, 6), (8, 8)]
+
+
+def test_pos_encoding_not_cached_with_grad():
+    embeddings = _embeddings()
+    out = embeddings.interpolate_pos_encoding(torch.zeros(1, 1, 8), 32, 32)
+    assert out.requires_grad
+    assert len(embeddings._pos_encoding_cache) == 0
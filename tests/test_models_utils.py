@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import torch
+import torch.nn as nn
+
+from flazoo.models.utils import (
+    add_norm,
+    bipartite_merge,
+    compress_seq,
+    decompress_seq,
+    early_exit_forward,
+    fold_video_tokens,
+    gather_tokens,
+    mask_to_indices,
+    packed_flip_indices,
+    packed_roll_indices,
+    route_top_k,
+    sample_decoder_indices,
+    sample_patch_dropout_indices,
+    scatter_tokens,
+    unfold_video_tokens,
+)
+
+
+def test_mask_to_indices():
+    mask = torch.tensor([[True, False, False, True, False], [False, True, True, False, False]])
+    visible, masked = mask_to_indices(mask)
+    assert visible.tolist() == [[1, 2, 4], [0, 3, 4]]
+    assert masked.tolist() == [[0, 3], [1, 2]]
+
+
+def test_gather_scatter_tokens():
+    hidden_states = torch.randn(2, 6, 4)
+    indices = torch.tensor([[0, 2, 5], [1, 3, 4]])
+    gathered = gather_tokens(hidden_states, indices)
+    assert torch.equal(gathered[1, 2], hidden_states[1, 4])
+    # writing the gathered tokens back is the identity
+    assert torch.equal(scatter_tokens(hidden_states, indices, gathered), hidden_states)
+    # a [1, L, D] table is shared by the batch
+    table = torch.randn(1, 6, 4)
+    assert torch.equal(gather_tokens(table, indices)[1], table[0, indices[1]])
+
+
+def test_scatter_tokens_gradients():
+    hidden_states = torch.randn(1, 4, 3, requires_grad=True)
+    updates = torch.randn(1, 2, 3, requires_grad=True)
+    indices = torch.tensor([[1, 3]])
+    scatter_tokens(hidden_states, indices, updates).sum().backward()
+    assert hidden_states.grad[0, :, 0].tolist() == [1.0, 0.0, 1.0, 0.0]
+    assert torch.equal(updates.grad, torch.ones_like(updates))
+
+
+def test_sample_patch_dropout_indices():
+    generator = torch.Generator().manual_seed(0)
+    indices = sample_patch_dropout_indices(3, 10, 0.25, generator=generator)
+    assert indices.shape == (3, 8)
+    for row in indices:
+        assert torch.equal(row, row.unique())
+
+
+def test_sample_decoder_indices():
+    masked = torch.tensor([[1, 4, 6, 7], [0, 2, 3, 5]])
+    assert sample_decoder_indices(masked, 0.0) is masked
+    kept = sample_decoder_indices(masked, 0.5, generator=torch.Generator().manual_seed(0))
+    assert kept.shape == (2, 2)
+    for row, source in zip(kept, masked):
+        assert set(row.tolist()) <= set(source.tolist())
+        assert row.tolist() == sorted(row.tolist())
+
+
+def test_bipartite_merge_unmerge():
+    torch.manual_seed(0)
+    hidden_states = torch.randn(2, 8, 4)
+    # tokens 0 and 1 are duplicates, so they are the first pair to be merged
+    hidden_states[:, 1] = hidden_states[:, 0]
+    size = torch.ones(2, 8, 1)
+    token_map = torch.arange(8).expand(2, -1)
+    merged, merged_size, token_map = bipartite_merge(hidden_states, size, token_map, r=1)
+
+    assert merged.shape == (2, 7, 4)
+    assert merged_size.sum(dim=1).flatten().tolist() == [8.0, 8.0]
+    # size weighted averaging preserves the sum of the tokens
+    torch.testing.assert_close((merged * merged_size).sum(dim=1), hidden_states.sum(dim=1))
+    # unmerging gives every original token the value of the token it was merged into
+    unmerged = gather_tokens(merged, token_map)
+    assert unmerged.shape == hidden_states.shape
+    torch.testing.assert_close(unmerged, hidden_states)
+
+
+def test_bipartite_merge_keeps_scan_order():
+    hidden_states = torch.randn(1, 10, 4)
+    token_map = torch.arange(10)[None]
+    merged, size, token_map = bipartite_merge(hidden_states, torch.ones(1, 10, 1), token_map, r=3)
+    assert merged.shape == (1, 7, 4)
+    # the tokens that were not merged keep their values and their relative order
+    targets = token_map[0]
+    alone = (targets[:, None] == targets[None, :]).sum(dim=1) == 1
+    assert targets[alone].tolist() == sorted(targets[alone].tolist())
+    torch.testing.assert_close(merged[0, targets[alone]], hidden_states[0, alone])
+
+
+def test_bipartite_merge_noop():
+    hidden_states = torch.randn(1, 5, 4)
+    size = torch.ones(1, 5, 1)
+    token_map = torch.arange(5)[None]
+    out = bipartite_merge(hidden_states, size, token_map, r=0)
+    assert out[0] is hidden_states and out[2] is token_map
+
+
+def test_compress_decompress_seq():
+    seq = torch.randn(2, 8, 3)
+    compressed = compress_seq(seq, 4)
+    torch.testing.assert_close(compressed[:, 1], seq[:, 4:].mean(dim=1))
+    assert torch.equal(decompress_seq(compressed, 4)[:, 4], compressed[:, 1])
+    with pytest.raises(AssertionError):
+        compress_seq(seq, 3)
+
+
+@pytest.mark.parametrize("axis", ["spatial", "temporal"])
+def test_fold_unfold_video_tokens(axis):
+    grid_thw = (2, 3, 4)
+    hidden_states = torch.randn(2, 24, 5)
+    folded = fold_video_tokens(hidden_states, grid_thw, axis)
+    if axis == "spatial":
+        assert folded.shape == (4, 12, 5)
+        assert torch.equal(folded[1], hidden_states[0, 12:])
+    else:
+        assert folded.shape == (24, 2, 5)
+        assert torch.equal(folded[3], hidden_states[0, [3, 15]])
+    assert torch.equal(unfold_video_tokens(folded, grid_thw, axis), hidden_states)
+
+
+def test_packed_indices():
+    cu_seqlens = torch.tensor([0, 3, 7])
+    x = torch.arange(7)
+    flipped = x[packed_flip_indices(cu_seqlens, 7)]
+    assert flipped.tolist() == [2, 1, 0, 6, 5, 4, 3]
+    rolled = x[packed_roll_indices(cu_seqlens, 7, 1)]
+    expected = torch.cat([torch.roll(x[:3], 1), torch.roll(x[3:], 1)])
+    assert torch.equal(rolled, expected)
+
+
+def test_route_top_k():
+    router_logits = torch.tensor([[0.1, 3.0, -1.0, 2.0], [5.0, 0.0, 1.0, 4.0]])
+    indices, weights = route_top_k(router_logits, 0.5)
+    assert indices.tolist() == [[1, 3], [0, 3]]
+    torch.testing.assert_close(weights[..., 0], torch.sigmoid(router_logits.gather(1, indices)))
+
+
+class _Block(nn.Module):
+    def __init__(self, scale):
+        super().__init__()
+        self.scale = scale
+
+    def forward(self, hidden_states):
+        return hidden_states * self.scale, None
+
+
+class _Head(nn.Module):
+    def __init__(self, logits):
+        super().__init__()
+        self.logits = logits
+
+    def forward(self, hidden_states):
+        return self.logits[: hidden_states.shape[0]]
+
+
+def test_early_exit_forward():
+    blocks = nn.ModuleList([_Block(2.0), _Block(3.0)])
+    exit_logits = torch.tensor([[10.0, 0.0], [0.0, 0.0]])
+    exit_heads = nn.ModuleDict({"0": _Head(exit_logits)})
+
+    def classify(hidden_states):
+        return hidden_states.mean(dim=1)[:, :2]
+
+    hidden_states = torch.ones(2, 3, 4)
+    logits, exit_layers = early_exit_forward(hidden_states, blocks, exit_heads, classify, 0.9)
+    # the first sample is confident at the exit, the second one runs through every block
+    assert exit_layers.tolist() == [0, 1]
+    assert torch.equal(logits[0], exit_logits[0])
+    assert logits[1].tolist() == [6.0, 6.0]
+
+    _, exit_layers = early_exit_forward(hidden_states, blocks, exit_heads, classify, 0.0)
+    assert exit_layers.tolist() == [0, 0]
+
+
+def test_add_norm():
+    norm = nn.LayerNorm(4)
+    hidden_states, residual = torch.randn(2, 3, 4), torch.randn(2, 3, 4)
+    out, new_residual = add_norm(norm, hidden_states, residual)
+    torch.testing.assert_close(new_residual, hidden_states + residual)
+    torch.testing.assert_close(out, norm(hidden_states + residual))
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+import warnings
+
+import pytest
+import torch
+import torch.nn as nn
+
+from flazoo.layers.reversible import (
+    ReversibleFunction,
+    get_autocast_state,
+    reversible_forward,
+)
+
+
+class _Block(nn.Module):
+    """Minimal block with the two branches used by the reversible encoder."""
+
+    def __init__(self, hidden_size, dropout=0.0):
+        super().__init__()
+        self.f = nn.Linear(hidden_size, hidden_size)
+        self.g = nn.Linear(hidden_size, hidden_size)
+        self.dropout = nn.Dropout(dropout)
+
+    def token_mixer_forward(self, hidden_states, output_attentions=False, **kwargs):
+        return self.dropout(torch.tanh(self.f(hidden_states))), None, None
+
+    def channel_mixer_forward(self, hidden_states):
+        return self.dropout(torch.tanh(self.g(hidden_states)))
+
+
+class _Tap:
+    def __init__(self, layer):
+        self.layer = layer
+
+    def __call__(self, hidden_states, cu_seqlens=None):
+        return hidden_states
+
+
+def _reference(blocks, hidden_states):
+    x1 = x2 = hidden_states
+    states = []
+    for block in blocks:
+        x1 = x1 + block.token_mixer_forward(x2)[0]
+        x2 = x2 + block.channel_mixer_forward(x1)
+        states.append((x1 + x2) / 2)
+    return states
+
+
+def _grads(blocks, hidden_states, loss_fn):
+    blocks.zero_grad()
+    hidden_states = hidden_states.detach().requires_grad_(True)
+    loss_fn(hidden_states).backward()
+    return [hidden_states.grad] + [p.grad.clone() for p in blocks.parameters()]
+
+
+@pytest.mark.parametrize("dropout", [0.0, 0.2])
+def test_reversible_gradients(dropout):
+    torch.manual_seed(0)
+    blocks = nn.ModuleList([_Block(8, dropout) for _ in range(3)]).double()
+    hidden_states = torch.randn(2, 5, 8, dtype=torch.double)
+
+    torch.manual_seed(1)
+    reversible = _grads(
+        blocks, hidden_states, lambda x: reversible_forward(blocks, x)[0].pow(2).sum()
+    )
+    # dropout masks are replayed in backward from the saved RNG states
+    torch.manual_seed(1)
+    reference = _grads(
+        blocks, hidden_states, lambda x: _reference(blocks, x)[-1].pow(2).sum()
+    )
+    for a, b in zip(reversible, reference):
+        torch.testing.assert_close(a, b)
+
+
+def test_reversible_taps_gradients():
+    torch.manual_seed(0)
+    blocks = nn.ModuleList([_Block(8) for _ in range(4)]).double()
+    hidden_states = torch.randn(2, 5, 8, dtype=torch.double)
+
+    def tapped(x):
+        out, taps, _ = reversible_forward(blocks, x, hidden_state_taps=[_Tap(2), _Tap(0)])
+        return out.sum() + taps[0].pow(2).sum() + taps[1].sum()
+
+    def reference(x):
+        states = _reference(blocks, x)
+        return states[-1].sum() + states[2].pow(2).sum() + states[0].sum()
+
+    with warnings.catch_warnings():
+        # the taps do not need the regular autograd pass
+        warnings.simplefilter("error")
+        tapped_grads = _grads(blocks, hidden_states, tapped)
+    for a, b in zip(tapped_grads, _grads(blocks, hidden_states, reference)):
+        torch.testing.assert_close(a, b)
+
+
+def test_reversible_outputs_without_grad():
+    torch.manual_seed(0)
+    blocks = nn.ModuleList([_Block(8) for _ in range(3)])
+    hidden_states = torch.randn(2, 5, 8)
+    with torch.no_grad():
+        out, all_hidden_states, _ = reversible_forward(
+            blocks, hidden_states, output_hidden_states=True
+        )
+        _, taps, _ = reversible_forward(blocks, hidden_states, hidden_state_taps=[_Tap(1)])
+        states = _reference(blocks, hidden_states)
+    assert len(all_hidden_states) == 4
+    torch.testing.assert_close(out, states[-1])
+    torch.testing.assert_close(all_hidden_states[2], states[1])
+    torch.testing.assert_close(taps[0], states[1])
+
+
+def test_reversible_warns_when_activations_are_kept():
+    blocks = nn.ModuleList([_Block(8)])
+    hidden_states = torch.randn(1, 3, 8, requires_grad=True)
+    with pytest.warns(UserWarning):
+        reversible_forward(blocks, hidden_states, output_hidden_states=True)
+
+
+def test_reversible_function_keeps_no_block_activations():
+    blocks = nn.ModuleList([_Block(8) for _ in range(2)])
+    x = torch.randn(1, 3, 8, requires_grad=True)
+    y1, y2 = ReversibleFunction.apply(x, x, blocks, {})
+    # only the two outputs are saved for backward
+    assert len(y1.grad_fn.saved_tensors) == 2
+
+
+def test_get_autocast_state():
+    with torch.autocast("cpu", dtype=torch.bfloat16):
+        state = get_autocast_state(torch.device("cpu"))
+    assert state["device_type"] == "cpu"
+    assert state["enabled"] and state["dtype"] == torch.bfloat16
+    assert not get_autocast_state(torch.device("cpu"))["enabled"]
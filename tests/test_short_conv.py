@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from flazoo.layers.short_conv import FusedShortConvolution
+
+
+class _Parent(nn.Module):
+    def __init__(self, conv, legacy_names):
+        super().__init__()
+        self.kv_conv1d = conv
+        conv.register_legacy_state_dict_hook(self, "kv_conv1d", legacy_names=legacy_names)
+
+
+def test_legacy_state_dict_hook():
+    conv = FusedShortConvolution(
+        split_sizes=(4, 6), kernel_size=3, bias=True, activations=("silu", "silu")
+    )
+    parent = _Parent(conv, legacy_names=("k_conv1d", "v_conv1d"))
+    k_weight, v_weight = torch.randn(4, 1, 3), torch.randn(6, 1, 3)
+    k_bias, v_bias = torch.randn(4), torch.randn(6)
+    parent.load_state_dict(
+        {
+            "k_conv1d.weight": k_weight,
+            "v_conv1d.weight": v_weight,
+            "k_conv1d.bias": k_bias,
+            "v_conv1d.bias": v_bias,
+        }
+    )
+    assert torch.equal(conv.weight, torch.cat([k_weight, v_weight]))
+    assert torch.equal(conv.bias, torch.cat([k_bias, v_bias]))
+
+    # fused state dicts load unchanged
+    state_dict = {k: torch.randn_like(v) for k, v in parent.state_dict().items()}
+    parent.load_state_dict(state_dict)
+    assert torch.equal(conv.weight, state_dict["kv_conv1d.weight"])
+
+
+def test_split_forward_of_different_lengths():
+    torch.manual_seed(0)
+    conv = FusedShortConvolution(split_sizes=(4, 6), kernel_size=3, activations=("silu", None))
+    q, k = torch.randn(2, 5, 4), torch.randn(2, 7, 6)
+    (y_q, y_k), cache = conv.split_forward(q, k)
+    assert cache is None
+
+    # one causal depthwise conv per split, with the slices of the fused filters
+    w_q, w_k = conv.weight.split([4, 6])
+    expected_q = F.silu(F.conv1d(q.transpose(1, 2), w_q, padding=2, groups=4)[..., :5]).transpose(1, 2)
+    expected_k = F.conv1d(k.transpose(1, 2), w_k, padding=2, groups=6)[..., :7].transpose(1, 2)
+    torch.testing.assert_close(y_q, expected_q)
+    torch.testing.assert_close(y_k, expected_k)